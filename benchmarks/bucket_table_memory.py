@@ -0,0 +1,73 @@
+"""
+.. module: benchmarks.bucket_table_memory
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Memory benchmark of the Bucket -> Account table: a plain `dict` (how the table used to be stored) vs.
+the `CompactBucketTable`.
+
+Run with (from the root of the repo, with Bucket Snake installed via `pip install -e .`):
+    python benchmarks/bucket_table_memory.py              # 1M and 10M buckets
+    python benchmarks/bucket_table_memory.py 100000       # Custom sizes
+"""
+import gc
+import random
+import sys
+import time
+import tracemalloc
+
+from bucket_snake.s3.tables import CompactBucketTable
+
+ACCOUNT_COUNT = 3000
+LOOKUPS = 100000
+
+
+def generate_buckets(count, seed=1337):
+    """
+    Yields `(bucket_name, account_id)` pairs that look like a real report. The account IDs are new string objects
+    each time (as they would be when parsed out of the JSON report).
+    """
+    rand = random.Random(seed)
+    accounts = [str(rand.randrange(10 ** 11, 10 ** 12)) for _ in range(ACCOUNT_COUNT)]
+    prefixes = ["prod", "test", "logs", "data", "backup", "artifacts", "cdn", "analytics"]
+
+    for i in range(count):
+        name = "{}-{}-{:x}-{}".format(rand.choice(prefixes), rand.choice(["us-east-1", "us-west-2", "eu-west-1"]),
+                                      rand.getrandbits(40), i)
+        yield name, "".join(list(rand.choice(accounts)))
+
+
+def measure(build, count):
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    table = build(generate_buckets(count))
+    build_time = time.perf_counter() - started
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    names = [name for name, _ in generate_buckets(min(count, LOOKUPS))]
+    started = time.perf_counter()
+    for name in names:
+        table.get(name)
+    lookup_time = (time.perf_counter() - started) / len(names)
+
+    return table, size, build_time, lookup_time
+
+
+def main(sizes):
+    print("{:>12} {:>10} {:>12} {:>12} {:>12} {:>12}".format("buckets", "table", "resident MB", "bytes/bucket",
+                                                             "build s", "lookup us"))
+    for count in sizes:
+        for label, build in [("dict", dict), ("compact", CompactBucketTable.from_items)]:
+            table, size, build_time, lookup_time = measure(build, count)
+            print("{:>12,} {:>10} {:>12.1f} {:>12.1f} {:>12.2f} {:>12.2f}".format(
+                count, label, size / 1024 / 1024, size / count, build_time, lookup_time * 1000000))
+            del table
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or [1000000, 10000000])
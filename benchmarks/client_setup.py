@@ -0,0 +1,68 @@
+"""
+.. module: benchmarks.client_setup
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Benchmark of per-account IAM client setup (assume role + make the client): a fresh `boto3` STS client and
+`boto3.Session` per account (how clients used to be made) vs. the shared `ClientFactory`.
+
+AWS is mocked out with moto, so this measures the client-side cost (loading service models, building clients) and
+not network latency -- the connection reuse of the factory would save more against real endpoints.
+
+Run with (from the root of the repo, with Bucket Snake and moto installed):
+    python benchmarks/client_setup.py              # 50 accounts
+    python benchmarks/client_setup.py 200          # Custom number of accounts
+"""
+import os
+import sys
+import time
+
+import boto3
+from moto import mock_sts
+
+from bucket_snake.config import CONFIG
+from bucket_snake.iam.util import format_role_arn, get_client
+from bucket_snake.util.clients import CLIENT_FACTORY
+
+REGION = "us-east-1"
+
+
+def get_client_per_account(arn, technology, region=REGION):
+    """How `get_client` used to make clients."""
+    sts = boto3.Session().client("sts", region_name=region)
+    ar = sts.assume_role(RoleArn=arn, RoleSessionName=CONFIG.bucket_snake_session_name)
+
+    session = boto3.Session(
+        region_name=region,
+        aws_access_key_id=ar["Credentials"]["AccessKeyId"],
+        aws_secret_access_key=ar["Credentials"]["SecretAccessKey"],
+        aws_session_token=ar["Credentials"]["SessionToken"]
+    )
+
+    return session.client(technology)
+
+
+def measure(make_client, accounts):
+    started = time.perf_counter()
+    for account in accounts:
+        make_client(format_role_arn(CONFIG.bucket_snake_role, account), "iam", region=REGION)
+
+    return (time.perf_counter() - started) / len(accounts)
+
+
+def main(count):
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    accounts = [str(100000000000 + i) for i in range(count)]
+
+    with mock_sts():
+        print("{:>12} {:>10} {:>16}".format("client", "accounts", "ms per account"))
+        for label, make_client in [("per-account", get_client_per_account), ("factory", get_client)]:
+            CLIENT_FACTORY.reset()
+            print("{:>12} {:>10,} {:>16.2f}".format(label, count, measure(make_client, accounts) * 1000))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
@@ -0,0 +1,62 @@
+"""
+.. module: benchmarks.import_time
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Cold-start import benchmark: imports `bucket_snake.entrypoints` (what Lambda loads before the first invocation) in
+fresh interpreters with `-X importtime`, and summarizes where the time goes.
+
+The median import time is checked against a budget -- the exit code is non-zero if it is over, so this can be run
+in CI to keep the cold start from regressing. Modules in `DEFERRED_IMPORTS` must not be imported at all.
+
+Run with (from the root of the repo, with Bucket Snake installed):
+    python benchmarks/import_time.py                   # 5 runs, 400ms budget
+    python benchmarks/import_time.py --runs 10 --budget 250
+"""
+import argparse
+import statistics
+import sys
+from collections import defaultdict
+
+from bucket_snake.util.imports import DEFERRED_IMPORTS, import_times
+
+MODULE = "bucket_snake.entrypoints"
+
+
+def summarize(times, top=10):
+    """Prints the self import time of each top-level package, largest first."""
+    packages = defaultdict(int)
+    for name, (self_time, _) in times.items():
+        packages[name.split(".")[0]] += self_time
+
+    print("{:>30} {:>10}".format("package", "self ms"))
+    for package, self_time in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print("{:>30} {:>10.1f}".format(package, self_time / 1000))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Measures the import time of {}.".format(MODULE))
+    parser.add_argument("--runs", type=int, default=5, help="How many fresh interpreters to measure.")
+    parser.add_argument("--budget", type=float, default=400, help="The most (median) milliseconds allowed.")
+    parser.add_argument("--top", type=int, default=10, help="How many packages to list.")
+    args = parser.parse_args(args)
+
+    runs = [import_times(MODULE) for _ in range(args.runs)]
+    median = statistics.median(times[MODULE][1] for times in runs) / 1000
+
+    summarize(runs[-1], top=args.top)
+
+    deferred = sorted(name for name in runs[-1] if name.split(".")[0] in DEFERRED_IMPORTS)
+    print("\n{} imported in {:.1f}ms (median of {} runs, budget: {:.0f}ms)".format(
+        MODULE, median, args.runs, args.budget))
+
+    if deferred:
+        print("Deferred modules were imported: {}".format(", ".join(deferred)))
+
+    return 1 if deferred or median > args.budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
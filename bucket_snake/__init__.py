@@ -0,0 +1,13 @@
+"""
+.. module: bucket_snake
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+"""
+import logging
+import os
+
+# Logging is set up once, here -- every module just uses `logging.getLogger("bucket_snake")`:
+logging.basicConfig()
+logging.getLogger("bucket_snake").setLevel(os.environ.get("LOG_LEVEL", logging.INFO))
@@ -0,0 +1,450 @@
+"""
+.. module: bucket_snake.aio
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+asyncio execution engine.
+
+The regular path makes blocking boto3 calls from a thread pool -- so a process can only have as many IAM operations in
+flight as it has threads. With `aiobotocore` installed (`pip install bucket_snake[async]`), the core path can instead
+run on an asyncio event loop: assuming roles, checking for and creating roles, updating their trust and inline
+policies, and fetching the Historical S3 report. The operations in each account are bounded by a semaphore of
+`CONFIG.account_concurrency`, so a single process can drive thousands of them across many accounts without a thread
+per call.
+
+To use: `asyncio.run(async_handler(event))` (see `bucket_snake.entrypoints`), or:
+    async with AsyncEngine() as engine:
+        client = await engine.get_iam_client("012345678910")
+        role = await check_for_role("SomeRole", client)
+
+Only the AWS calls differ from the regular path -- what to compare, write and record is shared with it (see
+`bucket_snake.iam.util`, `bucket_snake.util.clients` and `bucket_snake.s3.models`). The IAM clients go through the
+same rate limiter, and the account inventories (when enabled) are used and kept up to date.
+"""
+import asyncio
+import logging
+import time
+from contextlib import AsyncExitStack
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from bucket_snake.config import CONFIG
+from bucket_snake.iam.inventory import get_account_inventory
+from bucket_snake.iam.logic import check_destination_role_path
+from bucket_snake.iam.util import IAM_RATE_LIMITER, aspd_to_write, create_role_arguments, created_role, \
+    format_role_arn, is_missing_entity, role_policy_to_write, wrote_aspd, wrote_role_policy
+from bucket_snake.s3.models import download_report
+from bucket_snake.util.clients import CLIENT_FACTORY
+from bucket_snake.util.exceptions import classify_error
+
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+except ImportError:
+    AioConfig = None
+    get_session = None
+
+log = logging.getLogger("bucket_snake")
+
+
+class AsyncEngine:
+    """
+    Makes (and closes) the aiobotocore clients, caches the IAM clients for each account, and bounds the operations
+    in each account. Use it as an `async with` block -- the clients are closed when it exits.
+    """
+    def __init__(self, endpoint_url=None):
+        """
+        :param endpoint_url: Send every call to this endpoint (i.e. a local moto server) instead of AWS.
+        """
+        if get_session is None:
+            raise ImportError("The asyncio engine needs the `aiobotocore` package: pip install bucket_snake[async]")
+
+        self.endpoint_url = endpoint_url
+        self._session = None
+        self._stack = None
+        self._sts_clients = {}
+        self._iam_clients = {}
+        self._locks = {}
+        self._semaphores = {}
+
+    async def __aenter__(self):
+        self._session = get_session()
+        self._stack = AsyncExitStack()
+        await self._stack.__aenter__()
+
+        return self
+
+    async def __aexit__(self, *args):
+        try:
+            return await self._stack.__aexit__(*args)
+
+        finally:
+            self._sts_clients = {}
+            self._iam_clients = {}
+
+    def client_config(self, **kwargs):
+        """The aiobotocore client configuration for every client."""
+        if self.endpoint_url:
+            kwargs.setdefault("s3", {"addressing_style": "path"})
+
+        return AioConfig(max_pool_connections=CONFIG.max_pool_connections, tcp_keepalive=CONFIG.tcp_keepalive,
+                         **kwargs)
+
+    async def client(self, technology, region=None, credentials=None, endpoint_url=None, config=None):
+        """
+        Makes a client, which is closed when the engine exits.
+        :param technology:
+        :param region:
+        :param credentials: The (assumed role) credentials to use, in the same format as STS returns them. If not
+                            supplied, the default credentials are used.
+        :param endpoint_url:
+        :param config:
+        :return:
+        """
+        credentials = credentials or {}
+
+        return await self._stack.enter_async_context(self._session.create_client(
+            technology, region_name=region,
+            aws_access_key_id=credentials.get("AccessKeyId"),
+            aws_secret_access_key=credentials.get("SecretAccessKey"),
+            aws_session_token=credentials.get("SessionToken"),
+            endpoint_url=self.endpoint_url or endpoint_url,
+            config=config or self.client_config()))
+
+    async def sts(self, region):
+        """Gets the STS client for the region (see `ClientFactory.sts()`)."""
+        client = self._sts_clients.get(region)
+        if client is None:
+            endpoint_url, options = CLIENT_FACTORY.sts_client_options(region)
+            client = self._sts_clients[region] = await self.client("sts", region=region, endpoint_url=endpoint_url,
+                                                                   config=self.client_config(**options))
+
+        return client
+
+    async def assume_role(self, arn, session_name):
+        """
+        Assumes the role, falling back to the next STS region if an endpoint errors or times out. The endpoint
+        statistics are shared with the regular path (see `ClientFactory.assume_role()`).
+        :param arn:
+        :param session_name:
+        :return: The `assume_role` response.
+        """
+        regions = CLIENT_FACTORY.sts_regions()
+
+        for number, region in enumerate(regions):
+            started = time.perf_counter()
+            try:
+                response = await (await self.sts(region)).assume_role(RoleArn=arn, RoleSessionName=session_name)
+
+            except (BotoCoreError, ClientError) as e:
+                CLIENT_FACTORY.sts_failed(regions, number, started, e)
+                continue
+
+            CLIENT_FACTORY.stats_for(region).record(time.perf_counter() - started)
+
+            return response
+
+    async def get_client_with_expiration(self, arn, technology, region="us-east-1"):
+        """
+        Gets a client with the proper assumed role credentials, along with when those credentials expire.
+        :param arn:
+        :param technology:
+        :param region:
+        :return: A tuple of the client, and the expiration of its credentials (as a UNIX timestamp).
+        """
+        ar = await self.assume_role(arn, CONFIG.bucket_snake_session_name)
+
+        expiration = ar["Credentials"].get("Expiration")
+
+        return await self.client(technology, region=region, credentials=ar["Credentials"]), \
+            expiration.timestamp() if expiration else None
+
+    async def get_client(self, arn, technology, region="us-east-1"):
+        """
+        Gets a client with the proper assumed role credentials.
+        :param arn:
+        :param technology:
+        :param region:
+        :return:
+        """
+        return (await self.get_client_with_expiration(arn, technology, region=region))[0]
+
+    async def get_iam_client(self, account_id):
+        """
+        Gets a cached IAM client for the account. The role is only assumed once at a time for each account, and is
+        assumed again once the cached client's credentials are close to expiring.
+        :param account_id:
+        :return:
+        """
+        lock = self._locks.setdefault(account_id, asyncio.Lock())
+        async with lock:
+            entry = self._iam_clients.get(account_id)
+            if entry and (not entry[1] or time.time() < entry[1] - CONFIG.credential_refresh_margin):
+                return entry[0]
+
+            client, expiration = await self.get_client_with_expiration(
+                format_role_arn(CONFIG.bucket_snake_role, account_id), "iam", region=CONFIG.iam_region)
+            self._iam_clients[account_id] = (IAM_RATE_LIMITER.attach_async(client, account_id), expiration)
+
+            return client
+
+    def semaphore(self, account_id):
+        """Bounds the operations in the account to `CONFIG.account_concurrency` at a time."""
+        semaphore = self._semaphores.get(account_id)
+        if semaphore is None:
+            semaphore = self._semaphores[account_id] = asyncio.BoundedSemaphore(CONFIG.account_concurrency)
+
+        return semaphore
+
+
+async def check_for_role(role_name, client, inventory=None):
+    """
+    Checks for an IAM role in a given account (see `bucket_snake.iam.util.check_for_role()`).
+    :param role_name:
+    :param client:
+    :param inventory:
+    :return: The `get_role` response, or `None` if the role does not exist.
+    """
+    if inventory is not None:
+        return inventory.get_role(role_name)
+
+    try:
+        return await client.get_role(RoleName=role_name)
+
+    except ClientError as ce:
+        if is_missing_entity(ce):
+            return None
+
+        raise ce
+
+
+async def put_role_policy(client, role_name, policy_name, document, inventory=None):
+    """
+    Puts the inline policy on the role, unless it already has the same policy (see
+    `bucket_snake.iam.util.put_role_policy()`).
+    :param client:
+    :param role_name:
+    :param policy_name:
+    :param document:
+    :param inventory:
+    :return: True if the policy was written, False if it was unchanged.
+    """
+    if inventory is not None:
+        existing = inventory.get_role_policy(role_name, policy_name)
+
+    else:
+        try:
+            existing = (await client.get_role_policy(RoleName=role_name, PolicyName=policy_name))["PolicyDocument"]
+
+        except ClientError as ce:
+            if not is_missing_entity(ce):
+                raise ce
+
+            existing = None
+
+    policy_document = role_policy_to_write(existing, document)
+    if policy_document is None:
+        return False
+
+    await client.put_role_policy(RoleName=role_name, PolicyName=policy_name, PolicyDocument=policy_document)
+    wrote_role_policy(role_name, policy_name, document, inventory=inventory)
+
+    return True
+
+
+async def create_iam_role(client, role_name, source_arn, description, inventory=None, path="/"):
+    """
+    Creates the IAM role, which only permits the source application to assume into it (see
+    `bucket_snake.iam.util.create_iam_role()`).
+    :param client:
+    :param role_name:
+    :param source_arn:
+    :param description:
+    :param inventory:
+    :param path:
+    :return:
+    """
+    role = await client.create_role(**create_role_arguments(role_name, source_arn, description, path=path))
+    created_role(role, source_arn, inventory=inventory)
+
+    return role
+
+
+async def update_aspd(client, role_name, source_arn, existing_role=None, inventory=None):
+    """
+    Updates the Assume Role Policy Document of the role -- unless it already has the same document (see
+    `bucket_snake.iam.util.update_aspd()`).
+    :param client:
+    :param role_name:
+    :param source_arn:
+    :param existing_role: The `get_role` response for the role.
+    :param inventory:
+    :return: True if the document was written, False if it was unchanged.
+    """
+    policy_document = aspd_to_write(source_arn, existing_role=existing_role)
+    if policy_document is None:
+        return False
+
+    await client.update_assume_role_policy(RoleName=role_name, PolicyDocument=policy_document)
+    wrote_aspd(role_name, source_arn, inventory=inventory)
+
+    return True
+
+
+async def create_destination_role(engine, account, policies, app_name, source_role, source_role_account):
+    """
+    Creates (or updates) the destination IAM role in a single account (see
+    `bucket_snake.iam.logic.create_destination_role()`).
+    :param engine:
+    :param account:
+    :param policies:
+    :param app_name:
+    :param source_role:
+    :param source_role_account:
+    :return:
+    """
+    client = await engine.get_iam_client(account)
+
+    # Taking the inventory (if it is enabled, and isn't already loaded) blocks:
+    inventory = await asyncio.get_running_loop().run_in_executor(None, get_account_inventory, account) \
+        if CONFIG.account_inventory else None
+
+    destination_role_name = "{app}-{account}".format(app=app_name, account=source_role_account)
+    source_arn = format_role_arn(source_role, source_role_account)
+
+    async with engine.semaphore(account):
+        existing_role = await check_for_role(destination_role_name, client, inventory=inventory)
+        if not existing_role:
+            log.debug("\t[@] Destination role does not exist in account {}... Creating...".format(account))
+            try:
+                await create_iam_role(client, destination_role_name, source_arn, CONFIG.dest_role_description,
+                                      inventory=inventory, path=CONFIG.destination_role_path)
+
+            except ClientError as ce:
+                # The role was made after the account's inventory was taken:
+                if inventory is None or ce.response["Error"]["Code"] != "EntityAlreadyExists":
+                    raise ce
+
+                existing_role = await check_for_role(destination_role_name, client)
+                inventory.put_role(existing_role["Role"])
+
+        if existing_role:
+            check_destination_role_path(existing_role, destination_role_name, account)
+            await update_aspd(client, destination_role_name, source_arn, existing_role=existing_role,
+                              inventory=inventory)
+
+        await put_role_policy(client, destination_role_name, CONFIG.bucket_snake_policy_name, policies,
+                              inventory=inventory)
+
+
+async def create_destination_roles(engine, roles):
+    """
+    Creates (or updates) destination roles for any number of source roles, all at once -- bounded in each account
+    by the engine (see `bucket_snake.iam.logic.create_destination_roles_by_account()`).
+    :param engine:
+    :param roles: Dictionary of destination account -> list of tuples of
+                  `(key, policies, app_name, source_role, source_role_account)`.
+    :return: Dictionary of key -> dictionary of destination account -> the exception raised, for each role that
+             failed.
+    """
+    work = [(account, key, policies, app_name, source_role, source_role_account)
+            for account, account_roles in roles.items()
+            for key, policies, app_name, source_role, source_role_account in account_roles]
+
+    outcomes = await asyncio.gather(*(create_destination_role(engine, account, *details)
+                                      for account, _, *details in work), return_exceptions=True)
+
+    errors = {}
+    for (account, key, *_), outcome in zip(work, outcomes):
+        if isinstance(outcome, Exception):
+            log.error("[X] Unable to create the destination role in account {}: {}".format(account, outcome))
+            errors.setdefault(key, {})[account] = classify_error(outcome)
+
+    return errors
+
+
+class BlockingClient:
+    """
+    Lets the regular (blocking) code make S3 calls with an aiobotocore client, from threads other than the event
+    loop's: each call (and each read of a response body) is run on the event loop, and waited for.
+
+    This is how the report is fetched -- so that the conditional, ranged, streamed and decompressed GETs of the regular
+    path (see `bucket_snake.s3.download`) are used as-is.
+    """
+    def __init__(self, client, loop):
+        """
+        :param client: The aiobotocore S3 client.
+        :param loop: The event loop that the client belongs to.
+        """
+        self._client = client
+        self.loop = loop
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def get_object(self, **kwargs):
+        s3_obj = self.run(self._client.get_object(**kwargs))
+
+        return dict(s3_obj, Body=BlockingBody(s3_obj["Body"], self))
+
+
+class BlockingBody:
+    """Read-only, file-like wrapper around an aiobotocore response body (see `BlockingClient`)."""
+    def __init__(self, body, client):
+        self._body = body
+        self._client = client
+
+    def read(self, size=-1):
+        return self._client.run(self._body.read(size if size is not None and size >= 0 else None))
+
+    def close(self):
+        self._client.loop.call_soon_threadsafe(self._body.close)
+
+
+async def fetch_report(engine, etag=None, last_modified=None):
+    """
+    Fetches the Historical S3 report (see `bucket_snake.s3.models.download_report()`). The report is parsed in a
+    thread as it streams in -- the S3 calls themselves are made on the event loop.
+    :param engine:
+    :param etag:
+    :param last_modified:
+    :return: Tuple of the table, the report's ETag, and its last modified time -- or `None` if the report has not
+             changed.
+    """
+    loop = asyncio.get_running_loop()
+    client = BlockingClient(await engine.client("s3", region=CONFIG.reports_region), loop)
+
+    report = await loop.run_in_executor(None, lambda: download_report(client, etag=etag,
+                                                                      last_modified=last_modified))
+    if not report:
+        log.debug("[+] The Historical S3 report has not changed.")
+
+    return report
+
+
+async def refresh_bucket_table(engine, bucket_table):
+    """
+    Loads (or revalidates) the bucket table with `fetch_report()`. Pre-compiled bucket indexes and sharded reports
+    are loaded the regular way (in a thread), as they are read lazily.
+    :param engine:
+    :param bucket_table: i.e. `BUCKET_TABLE`.
+    :return:
+    """
+    if CONFIG.bucket_index_path or CONFIG.reports_shard_manifest:
+        await asyncio.get_running_loop().run_in_executor(None, lambda: bucket_table.buckets)
+        return
+
+    if bucket_table.loaded and not bucket_table.is_stale():
+        return
+
+    try:
+        bucket_table.load_report(await fetch_report(engine, *bucket_table.report_version))
+
+    except Exception as e:
+        if not bucket_table.loaded:
+            raise
+
+        log.error("[X] Unable to revalidate the Historical S3 report -- continuing with the current table: {}"
+                  .format(e))
@@ -5,15 +5,23 @@
     :license: Apache, see LICENSE for more details.
 .. author:: Mike Grima <mgrima@netflix.com>
 """
+import inspect
 import os
 import logging
 from functools import wraps
 
 from bucket_snake.util.exceptions import MissingRequiredConfigurationItemException
 
-logging.basicConfig()
 log = logging.getLogger("bucket_snake")
-log.setLevel(os.environ.get("LOG_LEVEL", logging.INFO))
+
+
+def normalize_iam_path(path):
+    """
+    IAM paths begin and end with a `/`.
+    :param path:
+    :return:
+    """
+    return "/{}/".format(path.strip("/")) if path.strip("/") else "/"
 
 
 class Config:
@@ -39,6 +47,46 @@ class Config:
         self._bucket_snake_session_name = os.environ.get("BUCKET_SNAKE_SESSION_NAME", "BucketSnake")
         self._iam_region = os.environ.get("IAM_REGION", "us-east-1")
 
+        # Connection settings for every boto3 client:
+        self._max_pool_connections = int(os.environ.get("MAX_POOL_CONNECTIONS", 10))
+        self._tcp_keepalive = os.environ.get("TCP_KEEPALIVE", "true").lower() == "true"
+
+        # Regional STS endpoints to assume roles with (in order of preference -- the runtime region first):
+        self._sts_regions = os.environ["STS_REGIONS"].split(",") if os.environ.get("STS_REGIONS") \
+            else list(dict.fromkeys([os.environ.get("AWS_REGION", "us-east-1"), "us-east-1"]))
+        self._sts_timeout = float(os.environ.get("STS_TIMEOUT", 2))
+        self._sts_slow_threshold = float(os.environ.get("STS_SLOW_THRESHOLD", 1))
+        self._sts_endpoint_cooldown = int(os.environ.get("STS_ENDPOINT_COOLDOWN", 60))
+
+        # How fast to make IAM calls (per second -- in each account, and in total), and how many times to retry them:
+        self._iam_rate_limit = float(os.environ.get("IAM_RATE_LIMIT", 10))
+        self._iam_global_rate_limit = float(os.environ.get("IAM_GLOBAL_RATE_LIMIT", 40))
+        self._iam_max_retries = int(os.environ.get("IAM_MAX_RETRIES", 5))
+
+        # Clients made with assumed role credentials are cached (per account) until shortly before they expire:
+        self._client_cache_size = int(os.environ.get("CLIENT_CACHE_SIZE", 1000))
+        self._credential_refresh_margin = int(os.environ.get("CREDENTIAL_REFRESH_MARGIN", 300))
+
+        # Where to remember completed requests, so identical repeats can be skipped (see `bucket_snake.util.state`):
+        self._request_state_store = os.environ.get("REQUEST_STATE_STORE", "role_tag")
+
+        # How many IAM operations to run at once (in all accounts), and in any one account (see
+        # `bucket_snake.util.scheduler`):
+        self._destination_role_concurrency = int(os.environ.get("DESTINATION_ROLE_CONCURRENCY", 8))
+        self._account_concurrency = int(os.environ.get("ACCOUNT_CONCURRENCY", 2))
+
+        # The accounts whose IAM clients (and inventories) a warm-up event loads ahead of time:
+        self._warm_up_accounts = os.environ["WARM_UP_ACCOUNTS"].split(",") \
+            if os.environ.get("WARM_UP_ACCOUNTS") else []
+
+        # The IAM path that destination roles are made at (i.e. `/bucketsnake/`), so they can be listed on their own:
+        self._destination_role_path = normalize_iam_path(os.environ.get("DESTINATION_ROLE_PATH", "/"))
+
+        # Snapshot the roles of each account with one paginated sweep (see `bucket_snake.iam.inventory`):
+        self._account_inventory = os.environ.get("ACCOUNT_INVENTORY", "false").lower() == "true"
+        self._account_inventory_ttl = int(os.environ.get("ACCOUNT_INVENTORY_TTL", 300))
+        self._account_inventory_cache_dir = os.environ.get("ACCOUNT_INVENTORY_CACHE_DIR")
+
         # Buckets that contain the historical report -- Just give the application access to all of them
         # (At some point in the future we could probably pair down to region, but assume the app could be deployed
         #  to multiple regions and that the app would pick the bucket within the same region)
@@ -51,12 +99,35 @@ class Config:
         self._swag_bucket = os.environ.get("SWAG_BUCKET")
         self._swag_region = os.environ.get("SWAG_REGION")
         self._swag_data_file = os.environ.get("SWAG_DATA_FILE")
+        self._swag_revalidate_interval = int(os.environ.get("SWAG_REVALIDATE_INTERVAL", 300))
 
         # Historical S3 reports dump:
         self._reports_bucket = os.environ.get("REPORTS_BUCKET")  # REQUIRED FIELD
         self._reports_region = os.environ.get("REPORTS_REGION")  # REQUIRED FIELD
         self._reports_prefix = os.environ.get("REPORTS_PREFIX", "historical-s3-report.json")
 
+        # Local cache of the Historical S3 report (persists across warm invocations):
+        self._report_cache_dir = os.environ.get("REPORT_CACHE_DIR", "/tmp")
+        self._report_revalidate_interval = int(os.environ.get("REPORT_REVALIDATE_INTERVAL", 300))
+
+        # Large reports are downloaded with concurrent byte-range GETs (set the concurrency to 1 to disable):
+        self._report_download_part_size = int(os.environ.get("REPORT_DOWNLOAD_PART_SIZE", 16 * 1024 * 1024))
+        self._report_download_concurrency = int(os.environ.get("REPORT_DOWNLOAD_CONCURRENCY", 8))
+
+        # Sharded Historical S3 report -- if set, only the shards covering the requested buckets are fetched:
+        self._reports_shard_manifest = os.environ.get("REPORTS_SHARD_MANIFEST")
+        self._report_shard_concurrency = int(os.environ.get("REPORT_SHARD_CONCURRENCY", 8))
+
+        # Pre-compiled (i.e. bundled in a Lambda layer) bucket index -- if set, this is used instead of the report:
+        self._bucket_index_path = os.environ.get("BUCKET_INDEX_PATH")
+
+        # Looks up buckets that are missing from the report individually (see `bucket_snake.s3.resolvers`):
+        self._bucket_resolver = os.environ.get("BUCKET_RESOLVER")
+        self._bucket_resolver_ttl = int(os.environ.get("BUCKET_RESOLVER_TTL", 3600))
+        self._bucket_resolver_negative_ttl = int(os.environ.get("BUCKET_RESOLVER_NEGATIVE_TTL", 300))
+        self._historical_s3_table = os.environ.get("HISTORICAL_S3_TABLE", "HistoricalS3CurrentTable")
+        self._historical_s3_table_region = os.environ.get("HISTORICAL_S3_TABLE_REGION")
+
         # Required Fields:
         self.required_fields = [
             "app_reports_buckets",
@@ -123,6 +194,158 @@ class Config:
     def iam_region(self, region):
         self._iam_region = region
 
+    @property
+    def max_pool_connections(self):
+        return self._max_pool_connections
+
+    @max_pool_connections.setter
+    def max_pool_connections(self, connections):
+        self._max_pool_connections = int(connections)
+
+    @property
+    def tcp_keepalive(self):
+        return self._tcp_keepalive
+
+    @tcp_keepalive.setter
+    def tcp_keepalive(self, keepalive):
+        self._tcp_keepalive = keepalive
+
+    @property
+    def sts_regions(self):
+        return self._sts_regions
+
+    @sts_regions.setter
+    def sts_regions(self, regions):
+        self._sts_regions = regions
+
+    @property
+    def sts_timeout(self):
+        return self._sts_timeout
+
+    @sts_timeout.setter
+    def sts_timeout(self, seconds):
+        self._sts_timeout = float(seconds)
+
+    @property
+    def sts_slow_threshold(self):
+        return self._sts_slow_threshold
+
+    @sts_slow_threshold.setter
+    def sts_slow_threshold(self, seconds):
+        self._sts_slow_threshold = float(seconds)
+
+    @property
+    def sts_endpoint_cooldown(self):
+        return self._sts_endpoint_cooldown
+
+    @sts_endpoint_cooldown.setter
+    def sts_endpoint_cooldown(self, seconds):
+        self._sts_endpoint_cooldown = int(seconds)
+
+    @property
+    def iam_rate_limit(self):
+        return self._iam_rate_limit
+
+    @iam_rate_limit.setter
+    def iam_rate_limit(self, rate):
+        self._iam_rate_limit = float(rate)
+
+    @property
+    def iam_global_rate_limit(self):
+        return self._iam_global_rate_limit
+
+    @iam_global_rate_limit.setter
+    def iam_global_rate_limit(self, rate):
+        self._iam_global_rate_limit = float(rate)
+
+    @property
+    def iam_max_retries(self):
+        return self._iam_max_retries
+
+    @iam_max_retries.setter
+    def iam_max_retries(self, retries):
+        self._iam_max_retries = int(retries)
+
+    @property
+    def client_cache_size(self):
+        return self._client_cache_size
+
+    @client_cache_size.setter
+    def client_cache_size(self, size):
+        self._client_cache_size = int(size)
+
+    @property
+    def credential_refresh_margin(self):
+        return self._credential_refresh_margin
+
+    @credential_refresh_margin.setter
+    def credential_refresh_margin(self, seconds):
+        self._credential_refresh_margin = int(seconds)
+
+    @property
+    def request_state_store(self):
+        return self._request_state_store
+
+    @request_state_store.setter
+    def request_state_store(self, store):
+        self._request_state_store = store
+
+    @property
+    def destination_role_concurrency(self):
+        return self._destination_role_concurrency
+
+    @destination_role_concurrency.setter
+    def destination_role_concurrency(self, concurrency):
+        self._destination_role_concurrency = int(concurrency)
+
+    @property
+    def account_concurrency(self):
+        return self._account_concurrency
+
+    @account_concurrency.setter
+    def account_concurrency(self, concurrency):
+        self._account_concurrency = int(concurrency)
+
+    @property
+    def warm_up_accounts(self):
+        return self._warm_up_accounts
+
+    @warm_up_accounts.setter
+    def warm_up_accounts(self, accounts):
+        self._warm_up_accounts = accounts
+
+    @property
+    def destination_role_path(self):
+        return self._destination_role_path
+
+    @destination_role_path.setter
+    def destination_role_path(self, path):
+        self._destination_role_path = normalize_iam_path(path)
+
+    @property
+    def account_inventory(self):
+        return self._account_inventory
+
+    @account_inventory.setter
+    def account_inventory(self, enabled):
+        self._account_inventory = enabled
+
+    @property
+    def account_inventory_ttl(self):
+        return self._account_inventory_ttl
+
+    @account_inventory_ttl.setter
+    def account_inventory_ttl(self, ttl):
+        self._account_inventory_ttl = int(ttl)
+
+    @property
+    def account_inventory_cache_dir(self):
+        return self._account_inventory_cache_dir
+
+    @account_inventory_cache_dir.setter
+    def account_inventory_cache_dir(self, cache_dir):
+        self._account_inventory_cache_dir = cache_dir
+
     @property
     def swag_bucket(self):
         return self._swag_bucket
@@ -147,6 +370,14 @@ class Config:
     def swag_data_file(self, swag_data_file):
         self._swag_data_file = swag_data_file
 
+    @property
+    def swag_revalidate_interval(self):
+        return self._swag_revalidate_interval
+
+    @swag_revalidate_interval.setter
+    def swag_revalidate_interval(self, seconds):
+        self._swag_revalidate_interval = int(seconds)
+
     @property
     def reports_bucket(self):
         return self._reports_bucket
@@ -171,6 +402,103 @@ class Config:
     def reports_prefix(self, reports_prefix):
         self._reports_prefix = reports_prefix
 
+    @property
+    def report_cache_dir(self):
+        return self._report_cache_dir
+
+    @report_cache_dir.setter
+    def report_cache_dir(self, cache_dir):
+        self._report_cache_dir = cache_dir
+
+    @property
+    def report_revalidate_interval(self):
+        return self._report_revalidate_interval
+
+    @report_revalidate_interval.setter
+    def report_revalidate_interval(self, seconds):
+        self._report_revalidate_interval = int(seconds)
+
+    @property
+    def report_download_part_size(self):
+        return self._report_download_part_size
+
+    @report_download_part_size.setter
+    def report_download_part_size(self, part_size):
+        self._report_download_part_size = int(part_size)
+
+    @property
+    def report_download_concurrency(self):
+        return self._report_download_concurrency
+
+    @report_download_concurrency.setter
+    def report_download_concurrency(self, concurrency):
+        self._report_download_concurrency = int(concurrency)
+
+    @property
+    def reports_shard_manifest(self):
+        return self._reports_shard_manifest
+
+    @reports_shard_manifest.setter
+    def reports_shard_manifest(self, manifest):
+        self._reports_shard_manifest = manifest
+
+    @property
+    def report_shard_concurrency(self):
+        return self._report_shard_concurrency
+
+    @report_shard_concurrency.setter
+    def report_shard_concurrency(self, concurrency):
+        self._report_shard_concurrency = int(concurrency)
+
+    @property
+    def bucket_index_path(self):
+        return self._bucket_index_path
+
+    @bucket_index_path.setter
+    def bucket_index_path(self, path):
+        self._bucket_index_path = path
+
+    @property
+    def bucket_resolver(self):
+        return self._bucket_resolver
+
+    @bucket_resolver.setter
+    def bucket_resolver(self, resolver):
+        self._bucket_resolver = resolver
+
+    @property
+    def bucket_resolver_ttl(self):
+        return self._bucket_resolver_ttl
+
+    @bucket_resolver_ttl.setter
+    def bucket_resolver_ttl(self, seconds):
+        self._bucket_resolver_ttl = int(seconds)
+
+    @property
+    def bucket_resolver_negative_ttl(self):
+        return self._bucket_resolver_negative_ttl
+
+    @bucket_resolver_negative_ttl.setter
+    def bucket_resolver_negative_ttl(self, seconds):
+        self._bucket_resolver_negative_ttl = int(seconds)
+
+    @property
+    def historical_s3_table(self):
+        return self._historical_s3_table
+
+    @historical_s3_table.setter
+    def historical_s3_table(self, table):
+        self._historical_s3_table = table
+
+    @property
+    def historical_s3_table_region(self):
+        # Defaults to the region of the reports bucket:
+        return self._historical_s3_table_region or self._reports_region
+
+    @historical_s3_table_region.setter
+    def historical_s3_table_region(self, region):
+        self._historical_s3_table_region = region
+
     @property
     def bucket_snake_role(self):
         return self._bucket_snake_role
@@ -191,11 +519,34 @@ class Config:
 CONFIG = Config()
 
 
+def load_and_verify(event):
+    """
+    Sets the attributes on the configuration based on the input to the lambda function (if the env var
+    `CONFIG_FROM_INPUT` is set), and verifies that the required values are properly configured.
+    :param event:
+    :return:
+    """
+    # Only execute this if the environment variable is set (default should be False)
+    if os.environ.get("CONFIG_FROM_INPUT", False):
+        if event.get("config"):
+            for attribute, value in event["config"].items():
+                if hasattr(CONFIG, attribute):
+                    setattr(CONFIG, attribute, value)
+                else:
+                    log.error("[X] Config Attribute: {} is not valid.".format(attribute))
+
+    # Verify that all required configuration items have been set:
+    for required in CONFIG.required_fields:
+        if not getattr(CONFIG, required):
+            raise MissingRequiredConfigurationItemException(
+                "Item: {} is required, but not specified.".format(required))
+
+
 def load_and_verify_config(func):
     """
     Decorator that sets the attributes on the configuration based on the input to the lambda function (if the env
     var `CONFIG_FROM_INPUT` is set). This will also verify that the configuration is correct and that required
-    values are properly configured.
+    values are properly configured. Works on both regular and `async` functions.
 
     The values need to be set to the raw values that the configuration needs. For example, if the env var
     would take in a comma-separated-list, you would supply an actual list of the items in the JSON, not the
@@ -203,23 +554,18 @@ def load_and_verify_config(func):
     :param func:
     :return:
     """
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(event, context=None, **kwargs):
+            load_and_verify(event)
+
+            return await func(event, context, **kwargs)
+
+        return async_wrapper
 
     @wraps(func)
     def wrapper(event, context):
-        # Only execute this if the environment variable is set (default should be False)
-        if os.environ.get("CONFIG_FROM_INPUT", False):
-            if event.get("config"):
-                for attribute, value in event["config"].items():
-                    if hasattr(CONFIG, attribute):
-                        setattr(CONFIG, attribute, value)
-                    else:
-                        log.error("[X] Config Attribute: {} is not valid.".format(attribute))
-
-        # Verify that all required configuration items have been set:
-        for required in CONFIG.required_fields:
-            if not getattr(CONFIG, required):
-                raise MissingRequiredConfigurationItemException(
-                    "Item: {} is required, but not specified.".format(required))
+        load_and_verify(event)
 
         return func(event, context)
 
@@ -6,24 +6,28 @@
 .. author:: Mike Grima <mgrima@netflix.com>
 """
 import logging
-import os
+import re
+from functools import partial
 
-from marshmallow import ValidationError
-from raven_python_lambda import RavenLambdaWrapper
-
-from bucket_snake.config import load_and_verify_config
+from bucket_snake.config import CONFIG, load_and_verify_config
 from bucket_snake.iam.logic import update_instance_profile_s3_permissions, create_destination_roles, \
-    update_source_assume_role_policy
-from bucket_snake.iam.util import get_iam_client, check_for_role
-from bucket_snake.request_schemas import incoming_request
+    create_destination_roles_by_account, make_assume_role_policy, update_source_assume_role_policy
+from bucket_snake.iam.inventory import get_account_inventory
+from bucket_snake.iam.util import get_iam_client, check_for_role, WRITE_STATS
 from bucket_snake.s3.models import BUCKET_TABLE
 from bucket_snake.s3.permissions import build_bucket_account_mapping, collect_policies, create_s3_role_policies, \
     create_access_to_reports
-from bucket_snake.util.exceptions import InvalidRequestException, SourceRoleDoesNotExistException
+from bucket_snake.util.exceptions import InvalidRequestException, SourceRoleDoesNotExistException, \
+    DestinationRoleException, is_retryable_error
+from bucket_snake.util.dag import SKIP, TaskGraph
+from bucket_snake.util.imports import lazy_decorator
+from bucket_snake.util.scheduler import AccountScheduler
+from bucket_snake.util.state import get_state_store, request_hash
 
-logging.basicConfig()
 log = logging.getLogger("bucket_snake")
-log.setLevel(os.environ.get("LOG_LEVEL", logging.INFO))
+
+# Only source accounts that could be valid are prefetched:
+SOURCE_ACCOUNT = re.compile(r"^\d{12}$")
 
 
 def validate_request(payload):
@@ -32,6 +36,10 @@ def validate_request(payload):
     :param payload:
     :return:
     """
+    # Marshmallow is only needed once there is a request to validate:
+    from marshmallow import ValidationError
+    from bucket_snake.request_schemas import incoming_request
+
     try:
         request_data = incoming_request.load(payload).data
 
@@ -42,29 +50,79 @@ def validate_request(payload):
     return request_data
 
 
-def main_logic(request_data):
+def verify_source_role(request_data):
     """
-    The main logic for the Lambda. This assumes that the input request has been properly validated.
-    This means that all buckets requested exist and are properly permissible.
+    Checks that the source IAM role exists.
     :param request_data:
-    :return:
+    :return: The source role (as `get_role` returns it).
     """
-    # STEP 1: VERIFY THAT SOURCE IAM ROLES EXISTS #
     log.debug("[~] Checking if the source IAM role: {} exists in {}...".format(request_data["role_name"],
                                                                                  request_data["account_number"]))
     iam_client = get_iam_client(request_data["account_number"])
-    if not check_for_role(request_data["role_name"], iam_client):
+    source_role = check_for_role(request_data["role_name"], iam_client,
+                                 inventory=get_account_inventory(request_data["account_number"]))
+    if not source_role:
         log.debug("[X] Source IAM role does NOT exist. That must be created first before this lambda is called.")
         raise SourceRoleDoesNotExistException("Source IAM Role: {} does not exist. This must exist before running "
                                               "this script.".format(request_data["role_name"]))
 
-    # STEP 2: BUILD THE S3 PERMISSIONS MATRIX #
-    # Need to determine which buckets are in the same account, and which are not
+    return source_role
+
+
+def map_buckets(request_data):
+    """
+    Works out which of the requested buckets are in the same account as the source role, and which are not.
+    :param request_data:
+    :return: Tuple of the same account, and the cross-account buckets (see `build_bucket_account_mapping()`).
+    """
     log.debug("[~] Building the account->bucket mapping...")
-    buckets_same, buckets_cross = build_bucket_account_mapping(request_data)
+    mapping = build_bucket_account_mapping(request_data)
     log.debug("[+] Completed the account->bucket mapping.")
 
-    # Calculate the S3 permissions that are required:
+    return mapping
+
+
+def check_request_state(request_data, source_role, mapping):
+    """
+    Checks whether this exact request has already been applied.
+    :param request_data:
+    :param source_role: See `verify_source_role()`.
+    :param mapping: See `map_buckets()`.
+    :return: Tuple of the state store and the request's hash (`None`s if there is no state store) -- or `None` if
+             the request has already been applied.
+    """
+    state_store = get_state_store(CONFIG.request_state_store)
+    if not state_store:
+        return None, None
+
+    buckets_same, buckets_cross = mapping
+    current_hash = request_hash(request_data, {
+        bucket: details["account_number"] for bucket, details in list(buckets_same.items()) +
+        list(buckets_cross.items())
+    })
+
+    if not request_data.get("force") and \
+            state_store.get(request_data["account_number"], request_data["role_name"], role=source_role) == \
+            current_hash:
+        log.info("[+] Permissionsss already in place for sssource role: {source}, app: {app}, "
+                 "account: {account}. Nothing to do.".format(source=request_data["role_name"],
+                                                             app=request_data["app_name"],
+                                                             account=request_data["account_number"]))
+        return None
+
+    return state_store, current_hash
+
+
+def build_plan(request_data, mapping, state):
+    """
+    Calculates the S3 permissions that the request needs.
+    :param request_data:
+    :param mapping: See `map_buckets()`.
+    :param state: See `check_request_state()`.
+    :return: See `plan_request()`.
+    """
+    buckets_same, buckets_cross = mapping
+
     log.debug("[~] Calculating the same account S3 permissions required...")
     policies_same_account = create_s3_role_policies(collect_policies(buckets_same))
     log.debug("[+] Completed calculation of same account S3 permissions.")
@@ -77,55 +135,531 @@ def main_logic(request_data):
     policies_cross_account = create_s3_role_policies(collect_policies(buckets_cross))
     log.debug("[+] Completed calculation of cross-account S3 permissions.")
 
-    # STEP 3: CREATE ROLES AND GRANT THE PERMISSIONS #
-    # Grant the same-account access:
+    return {
+        "request": request_data,
+        "same_account": policies_same_account,
+        "cross_account": policies_cross_account,
+        "state_store": state[0],
+        "hash": state[1]
+    }
+
+
+def plan_request(request_data):
+    """
+    Verifies the source role, and works out all of the S3 permissions that the (validated) request needs -- without
+    writing anything.
+    :param request_data:
+    :return: Dictionary of the request, its same account and cross-account policies, and its state -- or `None` if
+             this exact request has already been applied.
+    """
+    # STEP 1: VERIFY THAT SOURCE IAM ROLES EXISTS #
+    source_role = verify_source_role(request_data)
+
+    # STEP 2: BUILD THE S3 PERMISSIONS MATRIX #
+    # Need to determine which buckets are in the same account, and which are not
+    mapping = map_buckets(request_data)
+
+    # Has this exact request already been applied?
+    state = check_request_state(request_data, source_role, mapping)
+    if state is None:
+        return None
+
+    return build_plan(request_data, mapping, state)
+
+
+def prepare_destination_accounts(mapping):
+    """
+    Assumes the roles into (and takes the inventories of) the destination accounts ahead of time. Failures are left
+    for the destination role creation to report -- per account.
+    :param mapping: See `map_buckets()`.
+    :return:
+    """
+    for account in {details["account_number"] for details in mapping[1].values()}:
+        try:
+            get_iam_client(account)
+            get_account_inventory(account)
+
+        except Exception as e:
+            log.debug("[-] Unable to prepare destination account {} ahead of time: {}".format(account, e))
+
+
+def update_source_permissions(plan):
+    """
+    Grants the source role its same account S3 access.
+    :param plan: See `plan_request()`.
+    :return:
+    """
+    request_data = plan["request"]
+
     log.debug("[~] Updating the source role ({source_role})'s S3 permissions "
               "(in account: {source_account})...".format(source_role=request_data["app_name"],
                                                          source_account=request_data["account_number"]))
-    update_instance_profile_s3_permissions(policies_same_account, request_data["app_name"],
+    update_instance_profile_s3_permissions(plan["same_account"], request_data["app_name"],
                                            request_data["role_name"], request_data["account_number"])
     log.debug("[+] Updated the source role ({})'s S3 Permissions.".format(request_data["app_name"]))
 
-    # Create the cross-account roles:
-    log.debug("[~] Creating the destination roles...")
-    create_destination_roles(policies_cross_account, request_data["app_name"],
-                             request_data["role_name"], request_data["account_number"])
-    log.debug("[+] Completed destination role creation...")
+
+def complete_request(plan):
+    """
+    Once the destination roles are in place: permits the source role to assume them, and remembers the request (so
+    that it can be skipped if it is made again).
+    :param plan: See `plan_request()`.
+    :return:
+    """
+    request_data = plan["request"]
 
     # Update the assume role permissions:
     log.debug("[~] Updating the source role's role assumption permissions...")
-    update_source_assume_role_policy(policies_cross_account, request_data["app_name"],
+    update_source_assume_role_policy(plan["cross_account"], request_data["app_name"],
                                      request_data["role_name"], request_data["account_number"])
     log.debug("[+] Completed updating the source role's role assumption permissions...")
 
+    finish_request(plan)
+
+
+def finish_request(plan):
+    """
+    Remembers the request (so that it can be skipped if it is made again) -- once it has been completely applied.
+    :param plan: See `plan_request()`.
+    :return:
+    """
+    request_data = plan["request"]
+
+    # Remember this request, so that it can be skipped if it is made again:
+    if plan["state_store"]:
+        try:
+            plan["state_store"].put(request_data["account_number"], request_data["role_name"], plan["hash"])
+        except Exception as e:
+            log.error("[X] Unable to save the request hash for the source role: {}".format(e))
+
     # DONE!
     log.info("[+] Permissionsss fixed for sssource role: {source}, app: {app}, account: {account}!".format(
         source=request_data["role_name"], app=request_data["app_name"], account=request_data["account_number"]
     ))
 
 
-@RavenLambdaWrapper()
+def main_logic(request_data):
+    """
+    The main logic for the Lambda. This assumes that the input request has been properly validated.
+    This means that all buckets requested exist and are properly permissible.
+
+    The steps run as a graph (see `bucket_snake.util.dag`) -- each one as soon as the steps it needs are done. The
+    source role check overlaps with the bucket mapping, and the source role's S3 access is granted while the destination
+    accounts are prepared and the destination roles are created. Nothing touches the destination accounts until the
+    request is known to not have been applied already.
+    :param request_data:
+    :return:
+    """
+    written, skipped = WRITE_STATS.snapshot()
+
+    graph = TaskGraph("request")
+
+    # STEP 1: VERIFY THAT SOURCE IAM ROLES EXISTS -- AND BUILD THE S3 PERMISSIONS MATRIX #
+    graph.add("source_role", lambda: verify_source_role(request_data))
+    graph.add("mapping", lambda: map_buckets(request_data))
+
+    # Has this exact request already been applied? If so, everything after this is skipped:
+    def check_state(source_role, mapping):
+        state = check_request_state(request_data, source_role, mapping)
+        return SKIP if state is None else state
+
+    graph.add("state", check_state, "source_role", "mapping")
+    graph.add("plan", lambda mapping, state: build_plan(request_data, mapping, state), "mapping", "state")
+    graph.add("destination_accounts", lambda mapping, _: prepare_destination_accounts(mapping), "mapping", "state")
+
+    # STEP 3: CREATE ROLES AND GRANT THE PERMISSIONS #
+    # Grant the same-account access:
+    graph.add("source_permissions", update_source_permissions, "plan")
+
+    # Create the cross-account roles (once the destination accounts are ready):
+    graph.add("destination_roles", lambda plan, _: create_request_destination_roles(plan), "plan",
+              "destination_accounts")
+
+    graph.add("complete", lambda plan, *_: complete_request(plan), "plan", "source_permissions", "destination_roles")
+
+    if graph.run()["complete"] is SKIP:
+        return
+
+    log.debug("[+] Made {} IAM policy writes, and skipped {} that were unchanged.".format(
+        WRITE_STATS.written - written, WRITE_STATS.skipped - skipped))
+
+
+def create_request_destination_roles(plan):
+    """
+    Creates the cross-account roles for the request.
+    :param plan: See `plan_request()`.
+    :return:
+    """
+    request_data = plan["request"]
+
+    log.debug("[~] Creating the destination roles...")
+    create_destination_roles(plan["cross_account"], request_data["app_name"],
+                             request_data["role_name"], request_data["account_number"])
+    log.debug("[+] Completed destination role creation...")
+
+
+def run_by_source_account(plans, function):
+    """
+    Runs the function for each of the plans, with their source accounts taking turns (see
+    `bucket_snake.util.scheduler`).
+    :param plans: Dictionary of key -> plan (see `plan_request()`).
+    :param function: Called with each plan.
+    :return: Dictionary of key -> the exception raised (or `None`).
+    """
+    with AccountScheduler(CONFIG.destination_role_concurrency, CONFIG.account_concurrency) as scheduler:
+        futures = {key: scheduler.submit(plan["request"]["account_number"], function, plan)
+                   for key, plan in plans.items()}
+
+    return {key: future.exception() for key, future in futures.items()}
+
+
+def new_results(payloads):
+    """
+    :param payloads: The (unvalidated) requests of a batch.
+    :return: List of the (not yet filled in) result of each request.
+    """
+    results = []
+    for index, payload in enumerate(payloads):
+        payload = payload if isinstance(payload, dict) else {}
+        results.append({
+            "index": index,
+            "account_number": payload.get("account_number"),
+            "role_name": payload.get("role_name"),
+            "app_name": payload.get("app_name")
+        })
+
+    return results
+
+
+def fail_result(result, error):
+    """Marks the result of a request in a batch as failed."""
+    log.error("[X] Request {} in the batch failed: {}".format(result["index"], error))
+    result.update(status="failed", error=str(error), error_type=type(error).__name__,
+                  retryable=error.retryable if isinstance(error, DestinationRoleException)
+                  else is_retryable_error(error))
+
+
+def batch_logic(payloads):
+    """
+    The logic for a batch of requests. They are validated together, and all of the destination roles (for every
+    request) are created grouped by destination account. A request that fails does not stop the others.
+    :param payloads: The (unvalidated) requests.
+    :return: List of the result of each request (in the same order) -- with a `status` of `updated`, `unchanged`,
+             or `failed` (with the `error`).
+    """
+    written, skipped = WRITE_STATS.snapshot()
+
+    results = new_results(payloads)
+
+    def fail(index, error):
+        fail_result(results[index], error)
+
+    # Only fetch the parts of the Historical S3 report that cover all of the batch's buckets -- all at once:
+    try:
+        BUCKET_TABLE.prefetch({name for payload in payloads if isinstance(payload, dict) and
+                               isinstance(payload.get("buckets"), dict) for name in payload["buckets"]})
+    except Exception as e:
+        log.error("[X] Unable to prefetch the buckets for the batch -- they will be fetched per request: {}".format(e))
+
+    plans = {}
+    for index, payload in enumerate(payloads):
+        try:
+            plan = plan_request(validate_request(payload))
+
+        except Exception as e:
+            fail(index, e)
+            continue
+
+        if plan:
+            plans[index] = plan
+        else:
+            results[index]["status"] = "unchanged"
+
+    # Grant the same-account access:
+    for index, error in run_by_source_account(plans, update_source_permissions).items():
+        if error:
+            fail(index, error)
+            del plans[index]
+
+    # Create the cross-account roles for every request, account by account:
+    log.debug("[~] Creating the destination roles...")
+    roles = {}
+    for index, plan in plans.items():
+        for account, policies in plan["cross_account"].items():
+            roles.setdefault(account, []).append((index, policies, plan["request"]["app_name"],
+                                                  plan["request"]["role_name"], plan["request"]["account_number"]))
+
+    for index, errors in create_destination_roles_by_account(roles).items():
+        fail(index, DestinationRoleException(errors, sorted(set(plans[index]["cross_account"]) - set(errors))))
+        del plans[index]
+    log.debug("[+] Completed destination role creation...")
+
+    for index, error in run_by_source_account(plans, complete_request).items():
+        if error:
+            fail(index, error)
+        else:
+            results[index]["status"] = "updated"
+
+    log.info("[+] Completed a batch of {} requests: {} updated, {} unchanged, and {} failed. Made {} IAM policy "
+             "writes, and skipped {} that were unchanged.".format(
+                 len(results), *[sum(1 for result in results if result["status"] == status)
+                                 for status in ["updated", "unchanged", "failed"]],
+                 WRITE_STATS.written - written, WRITE_STATS.skipped - skipped))
+
+    return results
+
+
+async def async_batch_logic(engine, payloads):
+    """
+    The logic for a batch of requests, on the asyncio engine (see `bucket_snake.aio`). Every request is run at once
+    -- the engine bounds the IAM operations in each account. A request that fails does not stop the others.
+
+    The IAM calls are all made with the engine. Validation (which may load the SWAG data) and the request state
+    store are blocking, and so are run in threads.
+    :param engine: The `AsyncEngine`.
+    :param payloads: The (unvalidated) requests.
+    :return: Tuple of the result of each request (see `batch_logic()`), and a dictionary of the index -> the
+             exception raised, for each request that failed.
+    """
+    import asyncio
+    from bucket_snake.aio import check_for_role as async_check_for_role, create_destination_roles as \
+        async_create_destination_roles, put_role_policy as async_put_role_policy
+
+    loop = asyncio.get_running_loop()
+    written, skipped = WRITE_STATS.snapshot()
+    results = new_results(payloads)
+    errors = {}
+
+    async def run(index, payload):
+        request_data = await loop.run_in_executor(None, validate_request, payload)
+        account = request_data["account_number"]
+        client = await engine.get_iam_client(account)
+
+        async with engine.semaphore(account):
+            source_role = await async_check_for_role(request_data["role_name"], client)
+        if not source_role:
+            raise SourceRoleDoesNotExistException("Source IAM Role: {} does not exist. This must exist before running "
+                                                  "this script.".format(request_data["role_name"]))
+
+        mapping = await loop.run_in_executor(None, map_buckets, request_data)
+        state = await loop.run_in_executor(None, check_request_state, request_data, source_role, mapping)
+        if state is None:
+            return "unchanged"
+
+        plan = build_plan(request_data, mapping, state)
+
+        if plan["same_account"].get(account):
+            async with engine.semaphore(account):
+                await async_put_role_policy(client, request_data["role_name"], CONFIG.bucket_snake_policy_name,
+                                            plan["same_account"][account])
+
+        role_errors = (await async_create_destination_roles(engine, {
+            destination: [(index, policies, request_data["app_name"], request_data["role_name"], account)]
+            for destination, policies in plan["cross_account"].items()
+        })).get(index)
+        if role_errors:
+            raise DestinationRoleException(role_errors, sorted(set(plan["cross_account"]) - set(role_errors)))
+
+        async with engine.semaphore(account):
+            await async_put_role_policy(client, request_data["role_name"], CONFIG.sts_policy_name,
+                                        make_assume_role_policy(plan["cross_account"], request_data["app_name"],
+                                                                account))
+
+        await loop.run_in_executor(None, finish_request, plan)
+
+        return "updated"
+
+    outcomes = await asyncio.gather(*(run(index, payload) for index, payload in enumerate(payloads)),
+                                    return_exceptions=True)
+    for result, outcome in zip(results, outcomes):
+        if isinstance(outcome, Exception):
+            errors[result["index"]] = outcome
+            fail_result(result, outcome)
+        else:
+            result["status"] = outcome
+
+    log.info("[+] Completed a batch of {} requests: {} updated, {} unchanged, and {} failed. Made {} IAM policy "
+             "writes, and skipped {} that were unchanged.".format(
+                 len(results), *[sum(1 for result in results if result["status"] == status)
+                                 for status in ["updated", "unchanged", "failed"]],
+                 WRITE_STATS.written - written, WRITE_STATS.skipped - skipped))
+
+    return results, errors
+
+
+def prefetch(event):
+    """
+    Starts loading the Historical S3 report, the SWAG data, and the IAM clients for the source account(s) of the
+    request (or batch) -- concurrently, in the background. None of these depend on each other, so a cold invocation
+    waits for the slowest of them rather than all of them in turn.
+    :param event: The (unvalidated) event.
+    :return: Dictionary of name -> future (see `wait_for_prefetch()`).
+    """
+    requests = event.get("requests") if "requests" in event else [event]
+    if not isinstance(requests, list):
+        requests = []
+
+    return load_in_background({request["account_number"] for request in requests if isinstance(request, dict) and
+                               SOURCE_ACCOUNT.match(str(request.get("account_number", "")))}, "source-{}")
+
+
+def load_in_background(accounts, name):
+    """
+    Starts loading the Historical S3 report, the SWAG data, and the IAM clients (and inventories, if enabled) for the
+    accounts -- concurrently, in the background.
+    :param accounts:
+    :param name: What to call each account's future (formatted with the account ID).
+    :return: Dictionary of name -> future.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def load_swag():
+        # Validation uses the registry in `request_schemas` -- which imports marshmallow, so it is imported here:
+        from bucket_snake import request_schemas
+        return request_schemas.ACCOUNT_REGISTRY.accounts
+
+    def load_account(account):
+        client = get_iam_client(account)
+        get_account_inventory(account)
+
+        return client
+
+    tasks = {
+        "report": lambda: BUCKET_TABLE.buckets,
+        "swag": load_swag
+    }
+    for account in sorted(accounts):
+        tasks[name.format(account)] = partial(load_account, account)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(len(tasks), CONFIG.destination_role_concurrency)),
+                                  thread_name_prefix="bucket-snake-prefetch")
+    futures = {task_name: executor.submit(task) for task_name, task in tasks.items()}
+    executor.shutdown(wait=False)
+
+    return futures
+
+
+def warm_up():
+    """
+    Handles a warm-up event (`{"warmup": true}` -- i.e. sent on a schedule, or when provisioned concurrency is
+    initialized). The Historical S3 report, the SWAG data, and the IAM clients (and inventories, if enabled) for
+    `CONFIG.warm_up_accounts` are all loaded at once, so that the requests that follow start warm. Nothing is
+    written.
+    :return: Dictionary of what was loaded -> `"loaded"`, or the error.
+    """
+    log.debug("[~] Warming up for accounts: {}...".format(", ".join(CONFIG.warm_up_accounts) or "none"))
+
+    loaded = {}
+    for task_name, future in load_in_background(set(CONFIG.warm_up_accounts), "account-{}").items():
+        try:
+            future.result()
+            loaded[task_name] = "loaded"
+
+        except Exception as e:
+            log.error("[X] Unable to warm up the {}: {}".format(task_name, e))
+            loaded[task_name] = str(e)
+
+    log.info("[+] Warmed up: {} of {} loaded.".format(sum(1 for status in loaded.values() if status == "loaded"),
+                                                      len(loaded)))
+
+    return loaded
+
+
+def wait_for_prefetch(futures, *names):
+    """
+    Waits for the prefetched items. Failures are only logged -- the step that needs the item loads it again, and
+    raises the error from there.
+    :param futures: See `prefetch()`.
+    :param names: What to wait for (defaults to everything).
+    :return:
+    """
+    for name in names or list(futures):
+        try:
+            futures[name].result()
+
+        except Exception as e:
+            log.debug("[-] Unable to prefetch the {}: {}".format(name, e))
+
+
+# Raven is only imported (and set up) on the first invocation -- it is a large part of the cold start otherwise:
+@lazy_decorator("raven_python_lambda", "RavenLambdaWrapper")
 @load_and_verify_config
 def handler(event, context):
     """
     The main Lambda entrypoint. Validates that all is well before continuing on.
+
+    The event is either a single request, a batch of them: `{"requests": [...]}`, or a warm-up: `{"warmup": true}`.
     :param event:
     :param context:
-    :return:
+    :return: For a batch, the result of each request (see `batch_logic()`). For a warm-up, what was loaded (see
+             `warm_up()`).
     """
     log.debug("[~] SSSSSSSSSSSSSSsssssssSSSSSSSSSS")
 
     # Set up the config first:
     # set_config_from_input(event)
 
-    # Fetch the Historical S3 Reports data
+    # Warm-up events only load what the requests that follow will need:
+    if event.get("warmup"):
+        return {"warmup": warm_up()}
+
+    # Start loading everything that only depends on the event -- all at once:
+    prefetched = prefetch(event)
+
+    # Fetch the Historical S3 Reports data (and the SWAG data, for validation):
+    wait_for_prefetch(prefetched, "report", "swag")
     _ = BUCKET_TABLE.buckets
 
+    if "requests" in event:
+        if not isinstance(event["requests"], list):
+            raise InvalidRequestException("The batch `requests` must be a list of requests.")
+
+        log.debug("[~] Processing a batch of {} requests...".format(len(event["requests"])))
+        wait_for_prefetch(prefetched)
+        results = batch_logic(event["requests"])
+        log.debug("[+] Function complete")
+
+        return {"results": results}
+
     # Parse and validate that the payload is correct:
     log.debug("[~] Parsing request data...")
     request_data = validate_request(event)
     log.debug("[+] Successfully loaded incoming request data.")
 
-    # Continue:
+    # Continue (once the source account's IAM client is ready):
+    wait_for_prefetch(prefetched)
     main_logic(request_data)
     log.debug("[+] Function complete")
+
+
+@load_and_verify_config
+async def async_handler(event, context=None, endpoint_url=None):
+    """
+    The asyncio entrypoint (see `bucket_snake.aio`) -- for driving large batches (i.e. bulk reconciles) from a single
+    process. This takes the same events as `handler()`, and needs the `aiobotocore` package.
+
+    To use: `asyncio.run(async_handler(event))`
+    :param event:
+    :param context:
+    :param endpoint_url: Send every AWS call to this endpoint (i.e. a local moto server) instead of AWS.
+    :return: For a batch, the result of each request (see `batch_logic()`).
+    """
+    from bucket_snake.aio import AsyncEngine, refresh_bucket_table
+
+    batch = "requests" in event
+    if batch and not isinstance(event["requests"], list):
+        raise InvalidRequestException("The batch `requests` must be a list of requests.")
+
+    async with AsyncEngine(endpoint_url=endpoint_url) as engine:
+        # Fetch the Historical S3 Reports data
+        await refresh_bucket_table(engine, BUCKET_TABLE)
+
+        results, errors = await async_batch_logic(engine, event["requests"] if batch else [event])
+
+    log.debug("[+] Function complete")
+
+    if batch:
+        return {"results": results}
+
+    if errors:
+        raise errors[0]
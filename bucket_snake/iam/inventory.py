@@ -0,0 +1,275 @@
+"""
+.. module: bucket_snake.iam.inventory
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Account inventory snapshots.
+
+Checking a role costs a `get_role` call, and diffing its policies a `get_role_policy` call each -- so a batch that
+touches many roles in an account makes O(roles) calls to it. With `ACCOUNT_INVENTORY` enabled, each account is
+instead swept once with a paginated `get_account_authorization_details`, which returns every role along with its
+trust policy, tags, and inline policies -- O(pages) calls. Role and policy lookups are answered from that snapshot,
+and everything that Bucket Snake writes is applied to it as well, so it stays current.
+
+Snapshots are kept for `ACCOUNT_INVENTORY_TTL` seconds -- in memory, and also on disk in
+`ACCOUNT_INVENTORY_CACHE_DIR` (if set). The file is rewritten after every change, so that other containers reading
+it do not skip writes based on what was there before.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from bucket_snake.config import CONFIG
+from bucket_snake.iam.util import get_iam_client
+from bucket_snake.s3.tables import write_atomically
+
+log = logging.getLogger("bucket_snake")
+
+# Bump this whenever the format of the inventory files changes:
+INVENTORY_VERSION = 1
+
+
+class AccountInventory:
+    """
+    Snapshot of the IAM roles (and their inline policies) in an account.
+    """
+    def __init__(self, account, roles, taken=None, path=None):
+        """
+        :param account:
+        :param roles: The `RoleDetailList` from `get_account_authorization_details`.
+        :param taken: When the snapshot was taken (as a UNIX timestamp).
+        :param path: Where to save the snapshot to on disk (if anywhere).
+        """
+        self.account = account
+        self.taken = taken or time.time()
+        self.path = path
+        self._roles = {role["RoleName"]: role for role in roles}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def sweep(cls, account, client):
+        """
+        Takes a snapshot of the account with a paginated `get_account_authorization_details`.
+        :param account:
+        :param client: The IAM client for the account.
+        :return:
+        """
+        taken = time.time()
+        roles = []
+        pages = 0
+        for page in client.get_paginator("get_account_authorization_details").paginate(Filter=["Role"]):
+            roles.extend(page.get("RoleDetailList", []))
+            pages += 1
+
+        log.debug("[+] Took the inventory of {} roles in account {} in {} call(s).".format(len(roles), account, pages))
+
+        return cls(account, roles, taken=taken)
+
+    @property
+    def expired(self):
+        return time.time() - self.taken >= CONFIG.account_inventory_ttl
+
+    def get_role(self, role_name):
+        """
+        :param role_name:
+        :return: The role in the same format as `get_role` returns it, or `None` if it does not exist.
+        """
+        role = self._roles.get(role_name)
+        if role is None:
+            return None
+
+        return {"Role": {key: value for key, value in role.items() if key != "RolePolicyList"}}
+
+    def get_role_policy(self, role_name, policy_name):
+        """
+        :param role_name:
+        :param policy_name:
+        :return: The inline policy document, or `None` if the role does not have it.
+        """
+        for policy in self._roles.get(role_name, {}).get("RolePolicyList", []):
+            if policy["PolicyName"] == policy_name:
+                return policy["PolicyDocument"]
+
+        return None
+
+    def put_role(self, role):
+        """
+        Adds a role that was just created.
+        :param role: The role from the `create_role` response.
+        :return:
+        """
+        with self._lock:
+            self._roles[role["RoleName"]] = dict(role, RolePolicyList=[])
+            self.__changed()
+
+    def put_role_policy(self, role_name, policy_name, document):
+        with self._lock:
+            role = self._roles.get(role_name)
+            if role is None:
+                return
+
+            role["RolePolicyList"] = [policy for policy in role.get("RolePolicyList", [])
+                                      if policy["PolicyName"] != policy_name] + \
+                [{"PolicyName": policy_name, "PolicyDocument": document}]
+            self.__changed()
+
+    def put_assume_role_policy(self, role_name, document):
+        with self._lock:
+            if role_name in self._roles:
+                self._roles[role_name]["AssumeRolePolicyDocument"] = document
+                self.__changed()
+
+    def put_tags(self, role_name, tags):
+        with self._lock:
+            role = self._roles.get(role_name)
+            if role is None:
+                return
+
+            keys = {tag["Key"] for tag in tags}
+            role["Tags"] = [tag for tag in role.get("Tags", []) if tag["Key"] not in keys] + list(tags)
+            self.__changed()
+
+    def __changed(self):
+        """Keeps the snapshot on disk (if any) in step with the one in memory. The lock must be held."""
+        if self.path:
+            self.__save()
+
+    def save(self):
+        """Saves the snapshot to disk (if it has a path)."""
+        if self.path:
+            with self._lock:
+                self.__save()
+
+    def __save(self):
+        try:
+            write_atomically(self.path, lambda file: file.write(json.dumps(self.to_dict(), default=str)
+                                                                .encode("utf-8")))
+
+        except OSError as oe:
+            log.error("[X] Unable to cache the inventory of account {}: {}".format(self.account, oe))
+
+    def to_dict(self):
+        return {
+            "version": INVENTORY_VERSION,
+            "account": self.account,
+            "taken": self.taken,
+            "roles": list(self._roles.values())
+        }
+
+    @classmethod
+    def from_dict(cls, data, path=None):
+        if data.get("version") != INVENTORY_VERSION:
+            raise ValueError("Unsupported account inventory version: {}".format(data.get("version")))
+
+        return cls(data["account"], data["roles"], taken=data["taken"], path=path)
+
+    def __len__(self):
+        return len(self._roles)
+
+
+class InventoryCache:
+    """
+    Thread-safe cache of account inventories. Each account is only swept by one thread at a time.
+    """
+    def __init__(self):
+        self._inventories = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_path(account):
+        """Where the account's inventory is cached on disk -- or `None` if the disk cache is disabled."""
+        if not CONFIG.account_inventory_cache_dir:
+            return None
+
+        return os.path.join(CONFIG.account_inventory_cache_dir, "bucket-snake-inventory-{}.json".format(account))
+
+    def get(self, account):
+        """
+        Gets the inventory for the account -- sweeping it if there is no current snapshot. If the sweep fails, the
+        failure is remembered for the TTL (so that callers go back to making individual calls).
+        :param account:
+        :return: The inventory, or `None` if the account could not be swept.
+        """
+        entry = self._inventories.get(account)
+        if entry is not None and time.time() - entry[1] < CONFIG.account_inventory_ttl:
+            return entry[0]
+
+        with self._lock:
+            lock = self._locks.setdefault(account, threading.Lock())
+
+        with lock:
+            entry = self._inventories.get(account)
+            if entry is not None and time.time() - entry[1] < CONFIG.account_inventory_ttl:
+                return entry[0]
+
+            inventory = self.__load(account)
+            if inventory is None:
+                try:
+                    inventory = AccountInventory.sweep(account, get_iam_client(account))
+                    inventory.path = self.cache_path(account)
+                    inventory.save()
+
+                except Exception as e:
+                    log.error("[X] Unable to take the inventory of account {} -- looking up roles individually "
+                              "instead: {}".format(account, e))
+
+            self._inventories[account] = (inventory, inventory.taken if inventory else time.time())
+
+            return inventory
+
+    def __load(self, account):
+        """Loads the account's inventory from the disk cache (if it is enabled, and the file is current)."""
+        path = self.cache_path(account)
+        if not path:
+            return None
+
+        try:
+            with open(path) as file:
+                inventory = AccountInventory.from_dict(json.load(file), path=path)
+
+        except FileNotFoundError:
+            return None
+
+        except Exception as e:
+            log.error("[X] Unable to load the cached inventory of account {}: {}".format(account, e))
+            return None
+
+        return None if inventory.expired else inventory
+
+    def invalidate(self, account):
+        """Drops the account's inventory (in memory and on disk), so that it is swept again when next needed."""
+        with self._lock:
+            self._inventories.pop(account, None)
+
+        path = self.cache_path(account)
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+
+            except OSError as oe:
+                log.error("[X] Unable to remove the cached inventory of account {}: {}".format(account, oe))
+
+    def clear(self):
+        with self._lock:
+            self._inventories.clear()
+
+
+# Use this for all account inventories:
+ACCOUNT_INVENTORIES = InventoryCache()
+
+
+def get_account_inventory(account):
+    """
+    Gets the inventory for the account.
+    :param account:
+    :return: The inventory, or `None` if `ACCOUNT_INVENTORY` is disabled (or the account could not be swept).
+    """
+    if not CONFIG.account_inventory:
+        return None
+
+    return ACCOUNT_INVENTORIES.get(account)
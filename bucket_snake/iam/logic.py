@@ -5,53 +5,147 @@
     :license: Apache, see LICENSE for more details.
 .. author:: Mike Grima <mgrima@netflix.com>
 """
-import json
 import logging
-import os
+
+from botocore.exceptions import ClientError
 
 from bucket_snake.config import CONFIG
-from bucket_snake.iam.util import get_iam_client, check_for_role, create_iam_role, format_role_arn, update_aspd
+from bucket_snake.iam.inventory import get_account_inventory
+from bucket_snake.iam.util import get_iam_client, check_for_role, create_iam_role, format_role_arn, update_aspd, \
+    put_role_policy
+from bucket_snake.util.exceptions import DestinationRoleException, classify_error
+from bucket_snake.util.scheduler import AccountScheduler
 
-logging.basicConfig()
 log = logging.getLogger("bucket_snake")
-log.setLevel(os.environ.get("LOG_LEVEL", logging.INFO))
 
 
-def create_destination_roles(bucket_policies, app_name, source_role, source_role_account):
+def create_destination_role(account, policies, app_name, source_role, source_role_account):
     """
-    This will create the destination IAM roles for which the source application can assume into.
-    These roles only permit S3 access.
-    :param bucket_policies:
+    This will create (or update) the destination IAM role in a single account, which the source application can
+    assume into. This role only permits S3 access.
+    :param account:
+    :param policies:
     :param app_name:
     :param source_role:
     :param source_role_account:
     :return:
     """
-    for account, policies in bucket_policies.items():
-        client = get_iam_client(account)
+    client = get_iam_client(account)
+    inventory = get_account_inventory(account)
 
-        # Check if the destination role exists:
-        destination_role_name = "{app}-{account}".format(app=app_name, account=source_role_account)
+    # Check if the destination role exists:
+    destination_role_name = "{app}-{account}".format(app=app_name, account=source_role_account)
 
-        log.debug("\t[ ] Checking for destination role in {}...".format(account))
+    log.debug("\t[ ] Checking for destination role in {}...".format(account))
 
-        if not check_for_role(destination_role_name, client):
-            log.debug("\t[@] Destination role does not exist... Creating...")
-            # Create the role:
+    existing_role = check_for_role(destination_role_name, client, inventory=inventory)
+    if not existing_role:
+        log.debug("\t[@] Destination role does not exist in account {}... Creating...".format(account))
+        # Create the role:
+        try:
             create_iam_role(client, destination_role_name,
                             format_role_arn(source_role, source_role_account),
-                            CONFIG.dest_role_description)
+                            CONFIG.dest_role_description, inventory=inventory, path=CONFIG.destination_role_path)
+
+        except ClientError as ce:
+            # The role was made after the account's inventory was taken:
+            if inventory is None or ce.response["Error"]["Code"] != "EntityAlreadyExists":
+                raise ce
+
+            existing_role = check_for_role(destination_role_name, client)
+            inventory.put_role(existing_role["Role"])
 
-            log.debug("\t[+] Created the destination role in account {}".format(account))
+        log.debug("\t[+] Created the destination role in account {}".format(account))
 
-        else:
-            log.debug("\t[ ] Updating the ASPD of the role in account {}...".format(account))
-            update_aspd(client, destination_role_name, format_role_arn(source_role, source_role_account))
+    if existing_role:
+        check_destination_role_path(existing_role, destination_role_name, account)
 
-        log.debug("\t[ ] Updating the role policy...")
-        client.put_role_policy(RoleName=destination_role_name, PolicyName=CONFIG.bucket_snake_policy_name,
-                               PolicyDocument=json.dumps(policies, indent=4, sort_keys=True))
+        log.debug("\t[ ] Updating the ASPD of the role in account {}...".format(account))
+        update_aspd(client, destination_role_name, format_role_arn(source_role, source_role_account),
+                    existing_role=existing_role, inventory=inventory)
+
+    log.debug("\t[ ] Updating the role policy in account {}...".format(account))
+    if put_role_policy(client, destination_role_name, CONFIG.bucket_snake_policy_name, policies,
+                       inventory=inventory):
         log.debug("\t[+] Updated the role policy in account {}".format(account))
+    else:
+        log.debug("\t[+] The role policy in account {} is already up to date".format(account))
+
+
+def check_destination_role_path(existing_role, role_name, account):
+    """
+    Points out destination roles that are not at `CONFIG.destination_role_path` (i.e. that were made before it was
+    set), and how to move them.
+    :param existing_role: The `get_role` response for the role.
+    :param role_name:
+    :param account:
+    :return:
+    """
+    if existing_role["Role"].get("Path", "/") != CONFIG.destination_role_path:
+        log.info("[-] The destination role {role} in account {account} is at path {path} rather than {expected}. "
+                 "Move it with: bucket-snake-migrate-roles {account}".format(
+                     role=role_name, account=account, path=existing_role["Role"].get("Path", "/"),
+                     expected=CONFIG.destination_role_path))
+
+
+def create_destination_roles(bucket_policies, app_name, source_role, source_role_account):
+    """
+    This will create the destination IAM roles for which the source application can assume into.
+    These roles only permit S3 access.
+
+    The accounts are done in parallel (see `create_destination_roles_by_account`). A failure in one account does
+    not stop the others -- once they have all finished, a `DestinationRoleException` is raised with the error for
+    each account that failed.
+    :param bucket_policies:
+    :param app_name:
+    :param source_role:
+    :param source_role_account:
+    :return: The accounts that were updated.
+    """
+    errors = create_destination_roles_by_account({
+        account: [(None, policies, app_name, source_role, source_role_account)]
+        for account, policies in bucket_policies.items()
+    }).get(None, {})
+
+    updated = sorted(set(bucket_policies) - set(errors))
+    if errors:
+        raise DestinationRoleException(errors, updated)
+
+    return updated
+
+
+def create_destination_roles_by_account(roles):
+    """
+    Creates (or updates) destination roles for any number of source roles, grouped by destination account. The
+    accounts take turns (see `bucket_snake.util.scheduler`) -- up to `CONFIG.destination_role_concurrency` roles are
+    done at once, and at most `CONFIG.account_concurrency` in any one account. A failure for one role does not stop
+    the others.
+    :param roles: Dictionary of destination account -> list of tuples of
+                  `(key, policies, app_name, source_role, source_role_account)`. The key identifies who the role is
+                  for in the returned errors.
+    :return: Dictionary of key -> dictionary of destination account -> the exception raised, for each role that
+             failed. Errors that are worth retrying are wrapped (see `classify_error`).
+    """
+    if not roles:
+        return {}
+
+    futures = []
+    with AccountScheduler(CONFIG.destination_role_concurrency, CONFIG.account_concurrency) as scheduler:
+        for account, account_roles in roles.items():
+            for key, policies, app_name, source_role, source_role_account in account_roles:
+                futures.append((key, account, scheduler.submit(account, create_destination_role, account, policies,
+                                                               app_name, source_role, source_role_account)))
+
+    errors = {}
+    for key, account, future in futures:
+        error = future.exception()
+        if error:
+            log.error("[X] Unable to create the destination role in account {}: {}".format(account, error))
+
+            # Throttles (that outlasted the backoff) and other transient errors can be retried later:
+            errors.setdefault(key, {})[account] = classify_error(error)
+
+    return errors
 
 
 def update_instance_profile_s3_permissions(bucket_policies, app_name, source_role, source_role_account):
@@ -67,17 +161,15 @@ def update_instance_profile_s3_permissions(bucket_policies, app_name, source_rol
     if bucket_policies.get(source_role_account):
         client = get_iam_client(source_role_account)
 
-        client.put_role_policy(RoleName=source_role, PolicyName=CONFIG.bucket_snake_policy_name,
-                               PolicyDocument=json.dumps(bucket_policies[source_role_account], indent=4,
-                                                         sort_keys=True))
+        put_role_policy(client, source_role, CONFIG.bucket_snake_policy_name, bucket_policies[source_role_account],
+                        inventory=get_account_inventory(source_role_account))
 
 
-def update_source_assume_role_policy(cross_account_policies, app_name, source_role, source_account):
+def make_assume_role_policy(cross_account_policies, app_name, source_account):
     """
-    This permits the source application the ability to assume into the destination S3 roles.
+    Makes the policy that permits the source application to assume into its destination S3 roles.
     :param cross_account_policies:
     :param app_name:
-    :param source_role:
     :param source_account:
     :return:
     """
@@ -91,15 +183,33 @@ def update_source_assume_role_policy(cross_account_policies, app_name, source_ro
         ]
     }
 
-    client = get_iam_client(source_account)
-
     for account in cross_account_policies.keys():
         destination_role_name = "{app}-{account}".format(app=app_name, account=source_account)
 
         # Is this where we should do the diff logic for old role cleanup?
         assume_role_perm["Statement"][0]["Resource"].append(
-            format_role_arn(destination_role_name, account)
+            format_role_arn(destination_role_name, account, path=CONFIG.destination_role_path)
         )
 
-    client.put_role_policy(RoleName=source_role, PolicyName=CONFIG.sts_policy_name,
-                           PolicyDocument=json.dumps(assume_role_perm, indent=4, sort_keys=True))
+        # Roles that have not been moved to the destination role path yet are still at `/` (role names are unique
+        # within an account, so this is the same role either way):
+        if CONFIG.destination_role_path != "/":
+            assume_role_perm["Statement"][0]["Resource"].append(format_role_arn(destination_role_name, account))
+
+    return assume_role_perm
+
+
+def update_source_assume_role_policy(cross_account_policies, app_name, source_role, source_account):
+    """
+    This permits the source application the ability to assume into the destination S3 roles.
+    :param cross_account_policies:
+    :param app_name:
+    :param source_role:
+    :param source_account:
+    :return:
+    """
+    client = get_iam_client(source_account)
+
+    put_role_policy(client, source_role, CONFIG.sts_policy_name,
+                    make_assume_role_policy(cross_account_policies, app_name, source_account),
+                    inventory=get_account_inventory(source_account))
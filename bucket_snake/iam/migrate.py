@@ -0,0 +1,303 @@
+"""
+.. module: bucket_snake.iam.migrate
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Moves destination roles to the destination role path.
+
+With `DESTINATION_ROLE_PATH` set (i.e. to `/bucketsnake/`), new destination roles are made under it -- so that
+Bucket Snake's roles can be listed with `list_roles(PathPrefix=...)`, without paging through every other role in
+the account. Roles that were made at `/` before then can be moved with this.
+
+IAM can't change the path of a role, and role names are unique within an account, so a role is moved by deleting it
+and re-creating it (with the same trust policy, description, tags, and inline policies) at the new path. The role
+does not exist for a moment while this happens, so it is best done when the applications are quiet.
+
+Moving a role changes its ARN. Source roles whose requests were applied before `DESTINATION_ROLE_PATH` was set may
+only assume the role at its old ARN -- so before a role is deleted, its new ARN is added to the STS policy of each
+source role that its trust policy permits. The role's details and policies are logged before it is deleted, so that
+it can be restored by hand if it can't be re-created.
+
+To use:
+    bucket-snake-migrate-roles 012345678911 012345678912 --dry-run
+    bucket-snake-migrate-roles 012345678911 012345678912
+"""
+import argparse
+import json
+import logging
+import re
+from urllib.parse import unquote
+
+from botocore.exceptions import ClientError
+
+from bucket_snake.config import CONFIG, normalize_iam_path
+from bucket_snake.iam.inventory import ACCOUNT_INVENTORIES
+from bucket_snake.iam.util import format_role_arn, get_iam_client, is_missing_entity, put_role_policy
+from bucket_snake.util.exceptions import RoleMigrationException
+
+log = logging.getLogger("bucket_snake")
+
+# Destination roles are named `AppName-12DigitSourceAccountNumber`:
+DESTINATION_ROLE_NAME = re.compile(r"^.+-\d{12}$")
+
+# Role ARNs look like `arn:aws:iam::012345678910:role/some/path/RoleName`:
+ROLE_ARN = re.compile(r"^arn:aws[\w-]*:iam::(\d{12}):role/(?:.*/)?([^/]+)$")
+
+
+def as_json(document):
+    """IAM policy documents come back as (URL-encoded) JSON strings or dictionaries -- this makes them JSON."""
+    if isinstance(document, str):
+        return unquote(document) if document.lstrip().startswith("%") else document
+
+    return json.dumps(document, indent=4, sort_keys=True)
+
+
+def list_roles(client, path):
+    """
+    Lists the roles at (or below) the IAM path.
+    :param client:
+    :param path:
+    :return:
+    """
+    for page in client.get_paginator("list_roles").paginate(PathPrefix=path):
+        for role in page["Roles"]:
+            if role["Path"].startswith(path):
+                yield role
+
+
+def list_destination_roles(client, path=None):
+    """
+    Lists the roles at the destination role path -- only the roles that Bucket Snake owns (unless the path is `/`).
+    :param client:
+    :param path: Defaults to `CONFIG.destination_role_path`.
+    :return:
+    """
+    return list_roles(client, normalize_iam_path(path or CONFIG.destination_role_path))
+
+
+def find_roles_to_migrate(client, path=None):
+    """
+    Finds the destination roles that are at `/` rather than the destination role path. These are the roles that
+    are named like destination roles, and have the Bucket Snake inline policy.
+    :param client:
+    :param path: Defaults to `CONFIG.destination_role_path`.
+    :return: List of the roles (as `list_roles` returns them).
+    """
+    if normalize_iam_path(path or CONFIG.destination_role_path) == "/":
+        return []
+
+    roles = []
+    for role in list_roles(client, "/"):
+        if role["Path"] != "/" or not DESTINATION_ROLE_NAME.match(role["RoleName"]) or \
+                role.get("Description", CONFIG.dest_role_description) != CONFIG.dest_role_description:
+            continue
+
+        policies = client.list_role_policies(RoleName=role["RoleName"])["PolicyNames"]
+        if CONFIG.bucket_snake_policy_name in policies:
+            roles.append(role)
+
+    return roles
+
+
+def as_list(value):
+    """Policy elements can be a single item or a list -- this makes them a list."""
+    return [value] if isinstance(value, (str, dict)) else list(value or [])
+
+
+def source_roles(role):
+    """
+    The source roles that the role's trust policy permits to assume into it.
+    :param role: The role (as `list_roles` or `get_role` returns it).
+    :return: List of tuples of (account, role name).
+    """
+    sources = []
+    for statement in as_list(json.loads(as_json(role["AssumeRolePolicyDocument"])).get("Statement")):
+        principal = statement.get("Principal")
+        for arn in as_list(principal.get("AWS") if isinstance(principal, dict) else None):
+            match = ROLE_ARN.match(arn)
+            if match and match.groups() not in sources:
+                sources.append(match.groups())
+
+    return sources
+
+
+def permit_moved_role(role, old_arn, new_arn):
+    """
+    Adds the role's new ARN to the STS policy of each source role that may assume it at its current ARN -- so that
+    the source roles can still assume it once it has been moved.
+    :param role: The role (as `list_roles` or `get_role` returns it).
+    :param old_arn: The current ARN of the role.
+    :param new_arn: The ARN of the role once it has been moved.
+    :return: The source roles whose STS policies were updated (as `account/role name`).
+    """
+    updated = []
+    for account, role_name in source_roles(role):
+        client = get_iam_client(account)
+
+        try:
+            document = client.get_role_policy(RoleName=role_name, PolicyName=CONFIG.sts_policy_name)["PolicyDocument"]
+
+        except ClientError as ce:
+            if not is_missing_entity(ce):
+                raise ce
+
+            # Without the role (or its policy), nothing depends on the old ARN:
+            log.debug("[-] The source role {} in account {} has no {} policy -- skipping it.".format(
+                role_name, account, CONFIG.sts_policy_name))
+            continue
+
+        document = json.loads(as_json(document))
+        for statement in as_list(document.get("Statement")):
+            resources = as_list(statement.get("Resource"))
+            if old_arn in resources and new_arn not in resources:
+                statement["Resource"] = resources + [new_arn]
+
+        if put_role_policy(client, role_name, CONFIG.sts_policy_name, document):
+            ACCOUNT_INVENTORIES.invalidate(account)
+            updated.append("{}/{}".format(account, role_name))
+            log.info("[+] Permitted the source role {} in account {} to assume {}.".format(
+                role_name, account, new_arn))
+
+    return updated
+
+
+def migrate_role(client, role, path, account=None):
+    """
+    Moves the role to the path, by deleting it and re-creating it there. If it can't be re-created, it is put back
+    where it was -- and if that fails too, a `RoleMigrationException` is raised (the role has to be restored by hand,
+    from the details that were logged before it was deleted).
+    :param client:
+    :param role: The role (as `list_roles` or `get_role` returns it).
+    :param path:
+    :param account: The account that the role is in (defaults to the account in its ARN).
+    :return: The source roles whose STS policies were updated (see `permit_moved_role()`).
+    """
+    role_name = role["RoleName"]
+    account = account or role["Arn"].split(":")[4]
+
+    if client.list_attached_role_policies(RoleName=role_name)["AttachedPolicies"] or \
+            client.list_instance_profiles_for_role(RoleName=role_name)["InstanceProfiles"]:
+        raise ValueError("The role {} has managed policies or instance profiles -- it was not made by Bucket Snake, "
+                         "and must be moved by hand.".format(role_name))
+
+    details = client.get_role(RoleName=role_name)["Role"]
+    policies = {
+        policy_name: client.get_role_policy(RoleName=role_name, PolicyName=policy_name)["PolicyDocument"]
+        for policy_name in client.list_role_policies(RoleName=role_name)["PolicyNames"]
+    }
+    tags = client.list_role_tags(RoleName=role_name).get("Tags", [])
+
+    def create(at_path):
+        extra = {"Tags": tags} if tags else {}
+        client.create_role(Path=at_path, RoleName=role_name,
+                           AssumeRolePolicyDocument=as_json(details["AssumeRolePolicyDocument"]),
+                           Description=details.get("Description", CONFIG.dest_role_description), **extra)
+
+        for policy_name, document in policies.items():
+            client.put_role_policy(RoleName=role_name, PolicyName=policy_name, PolicyDocument=as_json(document))
+
+    # The source roles must be able to assume the role at its new ARN before it is moved:
+    updated = permit_moved_role(details, format_role_arn(role_name, account, path=details["Path"]),
+                                format_role_arn(role_name, account, path=path))
+
+    # Everything needed to restore the role by hand, should it not be possible to re-create it:
+    backup = json.dumps({
+        "Role": details,
+        "Policies": {policy_name: json.loads(as_json(document)) for policy_name, document in policies.items()},
+        "Tags": tags
+    }, sort_keys=True, default=str)
+    log.info("[~] Deleting the role {} to move it. Its details are: {}".format(role_name, backup))
+
+    for policy_name in policies:
+        client.delete_role_policy(RoleName=role_name, PolicyName=policy_name)
+    client.delete_role(RoleName=role_name)
+
+    try:
+        create(path)
+
+    except Exception as e:
+        log.error("[X] Unable to re-create the role {} at {} -- putting it back at {}: {}".format(
+            role_name, path, details["Path"], e))
+
+        # The role may have been partially re-created:
+        try:
+            for policy_name in client.list_role_policies(RoleName=role_name)["PolicyNames"]:
+                client.delete_role_policy(RoleName=role_name, PolicyName=policy_name)
+            client.delete_role(RoleName=role_name)
+
+        except Exception:
+            pass
+
+        try:
+            create(details["Path"])
+
+        except Exception as rollback_error:
+            log.error("[X] Unable to put the role {} back at {}: {}. It NO LONGER EXISTS, and must be re-created by "
+                      "hand from: {}".format(role_name, details["Path"], rollback_error, backup))
+            raise RoleMigrationException(
+                "The role {role} was deleted, but could not be re-created at {path} ({error}) or put back at "
+                "{old_path} ({rollback_error}). Re-create it by hand from: {backup}".format(
+                    role=role_name, path=path, error=e, old_path=details["Path"], rollback_error=rollback_error,
+                    backup=backup)) from rollback_error
+
+        raise
+
+    return updated
+
+
+def migrate_destination_roles(account, path=None, dry_run=False):
+    """
+    Moves the destination roles in the account that are at `/` to the destination role path.
+    :param account:
+    :param path: Defaults to `CONFIG.destination_role_path`.
+    :param dry_run: Only find the roles -- don't move them.
+    :return: The names of the roles that were moved (or would have been, for a dry run).
+    """
+    path = normalize_iam_path(path or CONFIG.destination_role_path)
+    client = get_iam_client(account)
+
+    roles = find_roles_to_migrate(client, path=path)
+    if dry_run:
+        return [role["RoleName"] for role in roles]
+
+    migrated = []
+    try:
+        for role in roles:
+            log.info("[~] Moving the role {} in account {} to {}...".format(role["RoleName"], account, path))
+            migrate_role(client, role, path, account=account)
+            migrated.append(role["RoleName"])
+
+    finally:
+        if migrated:
+            ACCOUNT_INVENTORIES.invalidate(account)
+
+    return migrated
+
+
+def main(args=None):
+    """
+    Command line entrypoint for moving the destination roles.
+    :param args:
+    :return:
+    """
+    parser = argparse.ArgumentParser(description="Moves Bucket Snake destination roles from / to the destination "
+                                                 "role path.")
+    parser.add_argument("accounts", nargs="+", help="The accounts to move the destination roles in.")
+    parser.add_argument("--path", help="The path to move them to (defaults to DESTINATION_ROLE_PATH).")
+    parser.add_argument("--dry-run", action="store_true", help="Only list the roles that would be moved.")
+    args = parser.parse_args(args)
+
+    if not args.dry_run:
+        print("Moving a role changes its ARN: the {} policy of each source role that may assume it is updated to "
+              "permit the new ARN before it is moved.".format(CONFIG.sts_policy_name))
+
+    for account in args.accounts:
+        roles = migrate_destination_roles(account, path=args.path, dry_run=args.dry_run)
+        print("{}: {} {} role(s){}".format(account, "Would move" if args.dry_run else "Moved", len(roles),
+                                           ": " + ", ".join(roles) if roles else ""))
+
+
+if __name__ == "__main__":
+    main()
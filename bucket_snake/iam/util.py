@@ -6,13 +6,113 @@
 .. author:: Mike Grima <mgrima@netflix.com>
 """
 import json
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import unquote
 
-import boto3
 from botocore.exceptions import ClientError
 
 from bucket_snake.config import CONFIG
+from bucket_snake.util.clients import CLIENT_FACTORY
+from bucket_snake.util.ratelimit import RateLimiter
 
-IAM_CLIENTS = {}
+
+# Policy elements whose values are unordered (and can be a single string or a list):
+UNORDERED_POLICY_ELEMENTS = ["Action", "NotAction", "Resource", "NotResource"]
+
+
+class WriteStats:
+    """Thread-safe count of the IAM policy writes that were made, and that were skipped (as nothing changed)."""
+    def __init__(self):
+        self.written = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def record(self, written):
+        with self._lock:
+            if written:
+                self.written += 1
+            else:
+                self.skipped += 1
+
+    def snapshot(self):
+        return self.written, self.skipped
+
+
+WRITE_STATS = WriteStats()
+
+
+class ExpiringClientCache:
+    """
+    Thread-safe LRU cache of boto3 clients that were made with (expiring) assumed role credentials.
+
+    A client is only handed back out if its credentials are good for at least another
+    `CONFIG.credential_refresh_margin` seconds -- otherwise it is dropped, so that the caller makes a new one before
+    the old credentials expire mid-request. Once there are more than `CONFIG.client_cache_size` clients, the least
+    recently used ones are evicted.
+
+    This behaves like a dictionary of account ID -> client. Use `put()` to add a client along with its expiration
+    (clients added with `cache[account] = client` never expire).
+    """
+    def __init__(self):
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is None:
+                return default
+
+            client, expiration = entry
+            if expiration and time.time() >= expiration - CONFIG.credential_refresh_margin:
+                del self._clients[key]
+                return default
+
+            self._clients.move_to_end(key)
+            return client
+
+    def put(self, key, client, expiration=None):
+        """
+        Caches the client.
+        :param key:
+        :param client:
+        :param expiration: When the client's credentials expire (as a UNIX timestamp).
+        :return:
+        """
+        with self._lock:
+            self._clients.pop(key, None)
+            self._clients[key] = (client, expiration)
+
+            while len(self._clients) > CONFIG.client_cache_size:
+                self._clients.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+
+    def __getitem__(self, key):
+        client = self.get(key)
+        if client is None:
+            raise KeyError(key)
+
+        return client
+
+    def __setitem__(self, key, client):
+        self.put(key, client)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._clients)
+
+
+IAM_CLIENTS = ExpiringClientCache()
+
+# Every IAM client goes through this (see `get_iam_client`), so the IAM rate limits are shared across threads:
+IAM_RATE_LIMITER = RateLimiter("iam_rate_limit", "iam_global_rate_limit", "iam_max_retries")
 
 
 def get_client(arn, technology, region="us-east-1"):
@@ -23,77 +123,197 @@ def get_client(arn, technology, region="us-east-1"):
     :param region:
     :return:
     """
-    sts = boto3.client("sts", region_name=region)
-    ar = sts.assume_role(RoleArn=arn, RoleSessionName=CONFIG.bucket_snake_session_name)
+    return get_client_with_expiration(arn, technology, region=region)[0]
 
-    session = boto3.Session(
-        region_name=region,
-        aws_access_key_id=ar["Credentials"]["AccessKeyId"],
-        aws_secret_access_key=ar["Credentials"]["SecretAccessKey"],
-        aws_session_token=ar["Credentials"]["SessionToken"]
-    )
 
-    return session.client(technology)
+def get_client_with_expiration(arn, technology, region="us-east-1"):
+    """
+    Gets a boto3 client with the proper assumed role credentials, along with when those credentials expire.
+    The role is assumed with the regional STS endpoints (see `CONFIG.sts_regions`) -- `region` is the region of
+    the client that is made.
+    :param arn:
+    :param technology:
+    :param region:
+    :return: A tuple of the client, and the expiration of its credentials (as a UNIX timestamp).
+    """
+    ar = CLIENT_FACTORY.assume_role(arn, CONFIG.bucket_snake_session_name)
+
+    expiration = ar["Credentials"].get("Expiration")
 
+    return CLIENT_FACTORY.client(technology, region=region, credentials=ar["Credentials"]), \
+        expiration.timestamp() if expiration else None
 
-def format_role_arn(role_name, account_id):
+
+def format_role_arn(role_name, account_id, path="/"):
     """
     Gets an IAM ARN string.
     :param role_name:
     :param account_id:
+    :param path: The IAM path of the role.
     :return:
     """
-    return "arn:aws:iam::{}:role/{}".format(account_id, role_name)
+    return "arn:aws:iam::{}:role{}{}".format(account_id, path, role_name)
 
 
 def get_iam_client(account_id):
     """
-    Gets a cached IAM client for all the Bucket Snake IAM actions.
+    Gets a cached IAM client for all the Bucket Snake IAM actions. The role is assumed again once the cached
+    client's credentials are close to expiring.
     :param account_id:
     :return:
     """
-    if IAM_CLIENTS.get(account_id):
-        return IAM_CLIENTS[account_id]
+    client = IAM_CLIENTS.get(account_id)
+    if client:
+        return client
 
-    client = get_client(format_role_arn(CONFIG.bucket_snake_role, account_id), "iam", region=CONFIG.iam_region)
-    IAM_CLIENTS[account_id] = client
+    client, expiration = get_client_with_expiration(format_role_arn(CONFIG.bucket_snake_role, account_id), "iam",
+                                                    region=CONFIG.iam_region)
+    IAM_RATE_LIMITER.attach(client, account_id)
+    IAM_CLIENTS.put(account_id, client, expiration)
 
     return client
 
 
-def check_for_role(role_name, client):
+def check_for_role(role_name, client, inventory=None):
     """
     Checks for an IAM role in a given account
     :param role_name:
     :param client:
+    :param inventory: The account's inventory (see `bucket_snake.iam.inventory`) -- if supplied, the role is looked
+                      up in it rather than with a `get_role` call.
     :return:
     """
+    if inventory is not None:
+        return inventory.get_role(role_name)
+
     try:
         role = client.get_role(RoleName=role_name)
 
         return role
 
     except ClientError as ce:
-        errors = ["Not Found", "NoSuchEntity"]
-
-        for error in errors:
-            if error in str(ce):
-                return
+        if is_missing_entity(ce):
+            return
 
         raise ce
 
 
-def create_iam_role(client, role_name, source_arn, description):
+def is_missing_entity(error):
     """
-    Creates an IAM role (the S3-specific IAM role for the application), which only permits the
-    source application access to assume into it.
+    Whether the IAM error means that the role (or policy) being looked up does not exist.
+    :param error: The `ClientError`.
+    :return:
+    """
+    return any(message in str(error) for message in ["Not Found", "NoSuchEntity"])
+
+
+def canonicalize_policy(document):
+    """
+    Puts an IAM policy document into a canonical form, so that two documents that mean the same thing compare equal.
+    This URL-decodes and parses documents that are strings (as IAM returns them), makes the unordered elements
+    (i.e. `Resource`) sorted lists, and puts the statements in a stable order.
+    :param document: The policy document, as a dictionary or (possibly URL-encoded) JSON string.
+    :return: The canonical JSON string of the policy.
+    """
+    if isinstance(document, str):
+        document = json.loads(unquote(document) if document.lstrip().startswith("%") else document)
+
+    def canonicalize(item):
+        if isinstance(item, list):
+            return [canonicalize(value) for value in item]
+
+        if not isinstance(item, dict):
+            return item
+
+        canonical = {}
+        for key, value in item.items():
+            if key in UNORDERED_POLICY_ELEMENTS:
+                canonical[key] = sorted([value] if isinstance(value, str) else value)
+            else:
+                canonical[key] = canonicalize(value)
+
+        return canonical
+
+    document = canonicalize(document)
+    statements = document.get("Statement")
+    if isinstance(statements, list):
+        document["Statement"] = sorted(statements, key=lambda statement: json.dumps(statement, sort_keys=True))
+
+    return json.dumps(document, sort_keys=True)
+
+
+def put_role_policy(client, role_name, policy_name, document, inventory=None):
+    """
+    Puts the inline policy on the role -- unless the role already has the same policy, in which case nothing is
+    written. The result is counted in `WRITE_STATS`.
     :param client:
     :param role_name:
+    :param policy_name:
+    :param document: The policy document (dictionary).
+    :param inventory: The account's inventory -- if supplied, the existing policy is taken from it (rather than
+                      with a `get_role_policy` call), and it is kept up to date.
+    :return: True if the policy was written, False if it was unchanged.
+    """
+    if inventory is not None:
+        existing = inventory.get_role_policy(role_name, policy_name)
+
+    else:
+        try:
+            existing = client.get_role_policy(RoleName=role_name, PolicyName=policy_name)["PolicyDocument"]
+
+        except ClientError as ce:
+            if not is_missing_entity(ce):
+                raise ce
+
+            existing = None
+
+    policy_document = role_policy_to_write(existing, document)
+    if policy_document is None:
+        return False
+
+    client.put_role_policy(RoleName=role_name, PolicyName=policy_name, PolicyDocument=policy_document)
+    wrote_role_policy(role_name, policy_name, document, inventory=inventory)
+
+    return True
+
+
+def role_policy_to_write(existing, document):
+    """
+    Compares the role's existing inline policy with the one to put. If they are the same, then nothing needs to be
+    written (and that is counted in `WRITE_STATS`).
+    :param existing: The existing policy document -- or `None` if the role doesn't have the policy.
+    :param document: The policy document (dictionary) to put.
+    :return: The JSON policy document to write, or `None` if it is unchanged.
+    """
+    if existing is not None and canonicalize_policy(existing) == canonicalize_policy(document):
+        WRITE_STATS.record(False)
+        return None
+
+    return json.dumps(document, indent=4, sort_keys=True)
+
+
+def wrote_role_policy(role_name, policy_name, document, inventory=None):
+    """
+    Counts an inline policy write in `WRITE_STATS`, and keeps the account's inventory (if any) up to date.
+    :param role_name:
+    :param policy_name:
+    :param document:
+    :param inventory:
+    :return:
+    """
+    WRITE_STATS.record(True)
+
+    if inventory is not None:
+        inventory.put_role_policy(role_name, policy_name, document)
+
+
+def make_aspd(source_arn):
+    """
+    Makes the Assume Role Policy Document that permits the source application to assume into a role.
     :param source_arn:
-    :param description:
     :return:
     """
-    aspd = {
+    return {
         "Statement": [
             {
                 "Effect": "Allow",
@@ -104,28 +324,107 @@ def create_iam_role(client, role_name, source_arn, description):
             }
         ]
     }
-    return client.create_role(Path="/", RoleName=role_name,
-                              AssumeRolePolicyDocument=json.dumps(aspd, indent=4), Description=description)
 
 
-def update_aspd(client, role_name, source_arn):
+def create_iam_role(client, role_name, source_arn, description, inventory=None, path="/"):
+    """
+    Creates an IAM role (the S3-specific IAM role for the application), which only permits the
+    source application access to assume into it.
+    :param client:
+    :param role_name:
+    :param source_arn:
+    :param description:
+    :param inventory: The account's inventory -- the new role is added to it.
+    :param path: The IAM path to create the role at.
+    :return:
+    """
+    role = client.create_role(**create_role_arguments(role_name, source_arn, description, path=path))
+    created_role(role, source_arn, inventory=inventory)
+
+    return role
+
+
+def create_role_arguments(role_name, source_arn, description, path="/"):
+    """
+    The arguments for the `create_role` call that creates the application's S3-specific IAM role.
+    :param role_name:
+    :param source_arn:
+    :param description:
+    :param path:
+    :return:
+    """
+    return {
+        "Path": path,
+        "RoleName": role_name,
+        "AssumeRolePolicyDocument": json.dumps(make_aspd(source_arn), indent=4),
+        "Description": description
+    }
+
+
+def created_role(role, source_arn, inventory=None):
+    """
+    Adds a newly created role to the account's inventory (if any).
+    :param role: The `create_role` response.
+    :param source_arn:
+    :param inventory:
+    :return:
+    """
+    if inventory is not None:
+        inventory.put_role(dict(role["Role"], AssumeRolePolicyDocument=make_aspd(source_arn)))
+
+
+def update_aspd(client, role_name, source_arn, existing_role=None, inventory=None):
     """
     This updates the existing Assume Role Policy Document for the application's S3-specific IAM role if it already
     exists. This is for idempotence.
+
+    If the existing role (from `check_for_role`) is supplied, and it already has the same document, then nothing
+    is written.
     :param client:
     :param role_name:
     :param source_arn:
+    :param existing_role: The `get_role` response for the role.
+    :param inventory: The account's inventory -- it is kept up to date.
+    :return: True if the document was written, False if it was unchanged.
+    """
+    policy_document = aspd_to_write(source_arn, existing_role=existing_role)
+    if policy_document is None:
+        return False
+
+    client.update_assume_role_policy(RoleName=role_name, PolicyDocument=policy_document)
+    wrote_aspd(role_name, source_arn, inventory=inventory)
+
+    return True
+
+
+def aspd_to_write(source_arn, existing_role=None):
+    """
+    Compares the role's existing Assume Role Policy Document with the one that permits the source application. If
+    they are the same, then nothing needs to be written (and that is counted in `WRITE_STATS`).
+    :param source_arn:
+    :param existing_role: The `get_role` response for the role.
+    :return: The JSON document to write, or `None` if it is unchanged.
+    """
+    aspd = make_aspd(source_arn)
+
+    if existing_role and canonicalize_policy(existing_role["Role"]["AssumeRolePolicyDocument"]) == \
+            canonicalize_policy(aspd):
+        WRITE_STATS.record(False)
+        return None
+
+    return json.dumps(aspd, indent=4)
+
+
+def wrote_aspd(role_name, source_arn, inventory=None):
+    """
+    Counts an Assume Role Policy Document write in `WRITE_STATS`, and keeps the account's inventory (if any) up to
+    date.
+    :param role_name:
+    :param source_arn:
+    :param inventory:
     :return:
     """
-    aspd = {
-        "Statement": [
-            {
-                "Effect": "Allow",
-                "Action": "sts:AssumeRole",
-                "Principal": {
-                    "AWS": source_arn
-                }
-            }
-        ]
-    }
-    client.update_assume_role_policy(RoleName=role_name, PolicyDocument=json.dumps(aspd, indent=4))
+    WRITE_STATS.record(True)
+
+    if inventory is not None:
+        inventory.put_assume_role_policy(role_name, make_aspd(source_arn))
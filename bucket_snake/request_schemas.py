@@ -7,29 +7,12 @@
 """
 from marshmallow import Schema, fields, validates_schema, ValidationError, validate
 from marshmallow.validate import OneOf
-from swag_client.backend import SWAGManager
-from swag_client.util import parse_swag_config_options
 
-from bucket_snake.config import CONFIG
 from bucket_snake.s3.models import BUCKET_TABLE
+from bucket_snake.util.accounts import ACCOUNT_REGISTRY
 from bucket_snake.util.exceptions import BlacklistedAccountException, S3BucketDoesNotExistException
 
 
-def get_swag():
-    """
-    Get account data from SWAG (via S3)
-    :return:
-    """
-    swag_opts = {
-        'swag.type': 's3',
-        'swag.bucket_name': CONFIG.swag_bucket,
-        'swag.data_file': CONFIG.swag_data_file,
-        'swag.region': CONFIG.swag_region,
-        'swag.cache_expires': 0
-    }
-    return SWAGManager(**parse_swag_config_options(swag_opts))
-
-
 class BucketPermission(Schema):
     """Permission schema for buckets.  Needs a prefix and the corresponding permission"""
     prefix = fields.Str(required=True)
@@ -56,16 +39,19 @@ class BucketDict(fields.Field):
     def _deserialize(self, value, attr, data):
         un_serialized_dict = {}
 
+        # Only fetch the parts of the Historical S3 report that cover the requested buckets:
+        BUCKET_TABLE.prefetch(value.keys())
+
         # K is a string -- The bucket name in the permissions dict
         for k, v in value.items():
             k = self.bucket_name_field.deserialize(k)
             v = self.bucket_permissions_field.deserialize(v)
 
             # Does this bucket even exist?
-            bucket_account = BUCKET_TABLE.buckets.get(k)
+            bucket_account = BUCKET_TABLE.lookup(k)
             if not bucket_account:
                 raise S3BucketDoesNotExistException(k)
-            elif bucket_account in CONFIG.blacklisted_bucket_accounts:
+            elif ACCOUNT_REGISTRY.is_blacklisted_bucket_account(bucket_account):
                 raise BlacklistedAccountException("Bucket: {bucket} resides in blacklisted bucket "
                                                   "account: {account}".format(bucket=k, account=bucket_account))
 
@@ -83,19 +69,17 @@ class IncomingRequest(Schema):
         fields.Str(),
         fields.Nested(BucketPermission, many=True)
     )
+    force = fields.Boolean()  # Apply the request, even if it is identical to the last one
 
     @validates_schema
     def validate_account_number(self, data):
         if data.get("account_number"):
             # Make sure the AWS account number exists...
-            swag = get_swag()
-            result = swag.get("[?id=='{}']".format(data["account_number"]))
-
-            if not result:
+            if data["account_number"] not in ACCOUNT_REGISTRY:
                 raise ValidationError("Unknown AWS account ID passed in: {}".format(data["account_number"]))
 
             # Check that the account is not in our blacklisted accounts:
-            if data["account_number"] in CONFIG.blacklisted_source_accounts:
+            if ACCOUNT_REGISTRY.is_blacklisted_source(data["account_number"]):
                 raise BlacklistedAccountException("This tool does NOT service account: {}".format(
                     data["account_number"]))
 
@@ -0,0 +1,244 @@
+"""
+.. module: bucket_snake.s3.download
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+"""
+import gzip
+from collections import deque
+
+from botocore.exceptions import ClientError
+
+from bucket_snake.util.exceptions import InvalidS3ReportException
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Content-Encodings and file extensions of the compressed formats that we can stream-decompress:
+COMPRESSION_ENCODINGS = {
+    "gzip": "gzip",
+    "x-gzip": "gzip",
+    "zstd": "zstd"
+}
+COMPRESSION_EXTENSIONS = {
+    ".gz": "gzip",
+    ".gzip": "gzip",
+    ".zst": "zstd",
+    ".zstd": "zstd"
+}
+
+
+class RangedObjectReader:
+    """
+    Read-only, file-like object for an S3 object that is downloaded with concurrent byte-range GETs.
+
+    The parts are fetched on a thread pool, but are handed back out of `read()` in order -- so this can be fed
+    straight into the report parser. At most `concurrency` parts are in flight (or waiting to be read) at once,
+    so memory use is bounded by `concurrency * part_size` regardless of the size of the object.
+
+    Every part is requested with `IfMatch` on the object's ETag, so a report that is replaced mid-download fails
+    (and can be retried) instead of being stitched together from two different reports.
+    """
+    def __init__(self, client, bucket, key, size, etag, part_size, concurrency, first_part=None):
+        """
+        :param client: The S3 client.
+        :param bucket:
+        :param key:
+        :param size: The size of the object.
+        :param etag: The ETag of the object.
+        :param part_size: The size of each byte-range GET.
+        :param concurrency: The most byte-range GETs to have in flight at once.
+        :param first_part: The (unread) body of an already-issued GET of the first part (if any).
+        """
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._etag = etag
+        self._size = size
+        self._part_size = part_size
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._pending = deque()
+        self._buffer = b""
+        self._position = 0
+
+        self._next_start = 0
+        if first_part:
+            self._pending.append(self._executor.submit(first_part.read))
+            self._next_start = part_size
+
+        while len(self._pending) < concurrency and self._submit_next():
+            pass
+
+    def _submit_next(self):
+        """Starts fetching the next part (if there is one)."""
+        if self._next_start >= self._size:
+            return False
+
+        start, end = self._next_start, min(self._next_start + self._part_size, self._size) - 1
+        self._next_start = end + 1
+        self._pending.append(self._executor.submit(self._fetch_part, start, end))
+
+        return True
+
+    def _fetch_part(self, start, end):
+        conditions = {"IfMatch": self._etag} if self._etag else {}
+        s3_obj = self._client.get_object(Bucket=self._bucket, Key=self._key, Range="bytes={}-{}".format(start, end),
+                                         **conditions)
+        return s3_obj["Body"].read()
+
+    def read(self, size=-1):
+        chunks = []
+        remaining = size
+
+        while size < 0 or remaining > 0:
+            if self._position >= len(self._buffer):
+                if not self._pending:
+                    break
+
+                self._buffer = self._pending.popleft().result()
+                self._position = 0
+                self._submit_next()
+                continue
+
+            end = len(self._buffer) if size < 0 else min(self._position + remaining, len(self._buffer))
+            chunks.append(self._buffer[self._position:end])
+            remaining -= end - self._position
+            self._position = end
+
+        return b"".join(chunks)
+
+    def close(self):
+        for future in self._pending:
+            future.cancel()
+
+        self._pending.clear()
+        self._executor.shutdown(wait=False)
+
+
+class DecompressedStream:
+    """
+    Read-only, file-like wrapper around a decompressing reader that also closes the (compressed) stream under it.
+    """
+    def __init__(self, reader, stream):
+        self._reader = reader
+        self._stream = stream
+
+    def read(self, size=-1):
+        return self._reader.read(size)
+
+    def close(self):
+        try:
+            self._reader.close()
+        finally:
+            self._stream.close()
+
+
+def get_compression(name=None, content_encoding=None):
+    """
+    Determines how an object is compressed -- from its Content-Encoding if it has one, otherwise from the
+    extension of its name.
+    :param name:
+    :param content_encoding:
+    :return: "gzip", "zstd", or `None` if it is not compressed.
+    """
+    if content_encoding:
+        # An object can list multiple encodings -- the last one applied is the outermost:
+        encoding = content_encoding.split(",")[-1].strip().lower()
+        if encoding in COMPRESSION_ENCODINGS:
+            return COMPRESSION_ENCODINGS[encoding]
+
+    for extension, compression in COMPRESSION_EXTENSIONS.items():
+        if name and name.lower().endswith(extension):
+            return compression
+
+
+def decompress_stream(stream, name=None, content_encoding=None):
+    """
+    Wraps the stream so that it is decompressed as it is read, if it is compressed (see `get_compression()`).
+    Nothing is buffered beyond what the decompressor needs, so no decompressed copy of the object is ever held.
+    :param stream: A (binary) file-like object.
+    :param name: The name (key or path) of the object.
+    :param content_encoding: The Content-Encoding of the object.
+    :return: A file-like object of the decompressed body.
+    """
+    compression = get_compression(name=name, content_encoding=content_encoding)
+
+    if compression == "gzip":
+        return DecompressedStream(gzip.GzipFile(fileobj=stream, mode="rb"), stream)
+
+    if compression == "zstd":
+        if not zstandard:
+            raise InvalidS3ReportException("{} is zstd compressed, but the `zstandard` package is not installed."
+                                           .format(name or "The report"))
+
+        return DecompressedStream(zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True,
+                                                                             closefd=False), stream)
+
+    return stream
+
+
+def get_object_stream(client, bucket, key, etag=None, last_modified=None, part_size=None, concurrency=1,
+                      decompress=False):
+    """
+    Fetches an S3 object, and returns a (file-like) stream of its body. If `concurrency` is more than 1, then the
+    object is downloaded with concurrent byte-range GETs of `part_size` bytes.
+
+    The first part is a regular (ranged) GET -- so an object smaller than a single part costs the same single
+    request as a plain GET, and its response tells us how big the rest of the object is.
+
+    If an ETag or last modified time is supplied, this is a conditional GET -- if the object has not changed,
+    then nothing is downloaded and `None` is returned.
+    :param client:
+    :param bucket:
+    :param key:
+    :param etag:
+    :param last_modified:
+    :param part_size:
+    :param concurrency:
+    :param decompress: Transparently decompress gzip or zstd compressed objects (by Content-Encoding or extension).
+    :return: A tuple of the stream, the object's ETag, and its last modified time.
+    """
+    conditions = {}
+    if etag:
+        conditions["IfNoneMatch"] = etag
+    if last_modified:
+        conditions["IfModifiedSince"] = last_modified
+
+    ranged = concurrency > 1 and part_size
+
+    try:
+        if ranged:
+            s3_obj = client.get_object(Bucket=bucket, Key=key, Range="bytes=0-{}".format(part_size - 1), **conditions)
+        else:
+            s3_obj = client.get_object(Bucket=bucket, Key=key, **conditions)
+
+    except ClientError as ce:
+        if ce.response["Error"]["Code"] in ["304", "NotModified"]:
+            return
+
+        # Empty objects can't be fetched with a range:
+        if ranged and ce.response["Error"]["Code"] == "InvalidRange":
+            return get_object_stream(client, bucket, key, etag=etag, last_modified=last_modified,
+                                     decompress=decompress)
+
+        raise ce
+
+    stream = s3_obj["Body"]
+
+    # ContentRange looks like: "bytes 0-8388607/123456789"
+    if ranged and s3_obj.get("ContentRange"):
+        size = int(s3_obj["ContentRange"].rsplit("/", 1)[1])
+
+        if size > part_size:
+            stream = RangedObjectReader(client, bucket, key, size, s3_obj.get("ETag"), part_size, concurrency,
+                                        first_part=s3_obj["Body"])
+
+    if decompress:
+        stream = decompress_stream(stream, name=key, content_encoding=s3_obj.get("ContentEncoding"))
+
+    return stream, s3_obj.get("ETag"), s3_obj.get("LastModified")
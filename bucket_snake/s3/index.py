@@ -0,0 +1,150 @@
+"""
+.. module: bucket_snake.s3.index
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Offline compiler for the binary bucket index.
+
+This turns the Historical S3 report JSON into a memory-mappable bucket index file (see `bucket_snake.s3.tables`).
+Point `BUCKET_INDEX_PATH` at the compiled index (i.e. in a Lambda layer) to have Bucket Snake map it instead of
+downloading and parsing the report.
+
+It can also split the report into N bucket index shards plus a manifest (see `bucket_snake.s3.shards`). Upload the
+output directory to the reports bucket (the manifest last), and point `REPORTS_SHARD_MANIFEST` at the manifest to
+have Bucket Snake only fetch the shards that a request needs.
+
+To use:
+    bucket-snake-compile-index historical-s3-report.json bucket-index.idx
+    bucket-snake-compile-index s3://historical-reports/historical-s3-report.json bucket-index.idx --region us-east-1
+    bucket-snake-compile-index historical-s3-report.json sharded-report/ --shards 64
+"""
+import argparse
+import json
+import logging
+import os
+from datetime import datetime
+
+import boto3
+
+from bucket_snake.s3.download import decompress_stream
+from bucket_snake.s3.models import load_bucket_table, iter_report_buckets
+from bucket_snake.s3.shards import shard_for_bucket, MANIFEST_VERSION
+from bucket_snake.s3.tables import CompactBucketTable, write_bucket_index
+
+log = logging.getLogger("bucket_snake")
+
+
+def compile_bucket_index(report, path, metadata=None):
+    """
+    Compiles the Historical S3 report into a binary bucket index file.
+    :param report: A (binary) file-like object of the Historical S3 report JSON.
+    :param path: Where to write the index to.
+    :param metadata: Optional dictionary of details to store with the index.
+    :return: The compiled table.
+    """
+    table = load_bucket_table(report)
+    write_bucket_index(table, path, metadata=metadata)
+
+    return table
+
+
+def compile_sharded_index(report, output_dir, shard_count, generation=None):
+    """
+    Compiles the Historical S3 report into `shard_count` bucket index shards, and a `manifest.json` describing them.
+    The shards are placed in a `generation` sub-directory, so that a new set of shards can be uploaded alongside
+    the old one without affecting anyone reading it. The manifest is written last.
+    :param report: A (binary) file-like object of the Historical S3 report JSON.
+    :param output_dir:
+    :param shard_count:
+    :param generation: The name of the sub-directory for the shards (defaults to the current UTC time).
+    :return: The manifest.
+    """
+    generation = generation or datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    shards = [[] for _ in range(shard_count)]
+
+    bucket_count = 0
+    for name, account in iter_report_buckets(report):
+        shards[shard_for_bucket(name, shard_count)].append((name, account))
+        bucket_count += 1
+
+    os.makedirs(os.path.join(output_dir, generation), exist_ok=True)
+
+    keys = []
+    for number in range(shard_count):
+        key = "{}/shard-{:05d}.idx".format(generation, number)
+        write_bucket_index(CompactBucketTable.from_items(shards[number]), os.path.join(output_dir, *key.split("/")),
+                           metadata={"shard": number, "shard_count": shard_count})
+        shards[number] = None
+        keys.append(key)
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "hash": "crc32",
+        "shard_count": shard_count,
+        "bucket_count": bucket_count,
+        "shards": keys
+    }
+
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    return manifest
+
+
+def open_report(location, region=None):
+    """
+    Opens the Historical S3 report -- either from a local path, or from S3 (`s3://bucket/key`). Compressed reports
+    (gzip or zstd) are decompressed as they are read.
+    :param location:
+    :param region:
+    :return: A tuple of the report stream, and the metadata to store in the index.
+    """
+    if not location.startswith("s3://"):
+        return decompress_stream(open(location, "rb"), name=location), {"source": os.path.abspath(location)}
+
+    bucket, _, key = location[len("s3://"):].partition("/")
+    s3_obj = boto3.client("s3", region_name=region).get_object(Bucket=bucket, Key=key)
+
+    return decompress_stream(s3_obj["Body"], name=key, content_encoding=s3_obj.get("ContentEncoding")), {
+        "source": location,
+        "etag": s3_obj.get("ETag"),
+        "last_modified": s3_obj["LastModified"].timestamp() if s3_obj.get("LastModified") else None
+    }
+
+
+def main(args=None):
+    """
+    Command line entrypoint for compiling the bucket index.
+    :param args:
+    :return:
+    """
+    parser = argparse.ArgumentParser(description="Compiles the Historical S3 report into a memory-mappable "
+                                                 "Bucket Snake bucket index.")
+    parser.add_argument("report", help="Path to the Historical S3 report JSON, or an s3://bucket/key location.")
+    parser.add_argument("output", help="Where to write the compiled bucket index (a directory if sharding).")
+    parser.add_argument("--region", help="The region of the S3 bucket containing the report.")
+    parser.add_argument("--shards", type=int, help="Split the index into this many shards (plus a manifest).")
+    args = parser.parse_args(args)
+
+    report, metadata = open_report(args.report, region=args.region)
+    try:
+        if args.shards:
+            manifest = compile_sharded_index(report, args.output, args.shards)
+            log.info("[+] Compiled {} buckets into {} shards in: {}".format(manifest["bucket_count"],
+                                                                            manifest["shard_count"], args.output))
+            return
+
+        table = compile_bucket_index(report, args.output, metadata=metadata)
+
+    finally:
+        report.close()
+
+    log.info("[+] Compiled {} buckets in {} accounts to: {}".format(len(table), len(table.accounts), args.output))
+
+
+if __name__ == "__main__":
+    main()
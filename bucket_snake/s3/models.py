@@ -5,30 +5,135 @@
     :license: Apache, see LICENSE for more details.
 .. author:: Mike Grima <mgrima@netflix.com>
 """
+import hashlib
+import json
 import logging
 import os
+import posixpath
+import threading
+import time
+from datetime import datetime, timezone
 
-import boto3
-from marshmallow import Schema
-from marshmallow.fields import Field
-from retrying import retry
+from botocore.exceptions import ClientError
 
 from bucket_snake.config import CONFIG
+from bucket_snake.s3.download import get_object_stream
+from bucket_snake.s3.resolvers import ResolvedBucketCache, get_resolver
+from bucket_snake.s3.shards import ShardedBucketTable, verify_manifest
+from bucket_snake.s3.tables import CompactBucketTable, MappedBucketTable, write_bucket_index, write_atomically
+from bucket_snake.util.clients import CLIENT_FACTORY
+from bucket_snake.util.exceptions import InvalidS3ReportException, InvalidBucketIndexException, \
+    BucketLookupException
+from bucket_snake.util.imports import lazy_decorator
 
-logging.basicConfig()
 log = logging.getLogger("bucket_snake")
-log.setLevel(os.environ.get("LOG_LEVEL", logging.INFO))
 
 
-class BucketField(Field):
-    """Field for the bucket dictionary. It's `bucket_name: bucket_account`"""
-    def _deserialize(self, value, attr, data):
-        return {name: details["AccountId"] for name, details in data["buckets"].items()}
+# How much of the report body to pull off of the stream at a time:
+REPORT_READ_SIZE = 64 * 1024
 
+# How long (in seconds) to wait before trying again after the report could not be revalidated:
+REPORT_RETRY_INTERVAL = 60
 
-class S3ReportSchema(Schema):
-    """Schema for the S3 Historical report, which only cares about the buckets."""
-    buckets = BucketField(required=True, load_from="buckets", load_only=True)
+
+def iter_report_buckets(stream):
+    """
+    Incrementally parses the Historical S3 report from a file-like object, and yields `(bucket_name, account_id)`
+    for each bucket in it.
+
+    Only `buckets.<name>.AccountId` is kept -- the rest of the bucket details are skipped over as they stream by, so
+    neither the raw report nor the full parsed document is ever held in memory.
+    :param stream:
+    :return:
+    """
+    # Only needed when a report is parsed -- not when the table is loaded from a cached (or pre-built) index:
+    import ijson
+
+    depth = 0
+    root_key = None
+    in_buckets = False
+    found_buckets = False
+    bucket_name = None
+    bucket_key = None
+
+    for event, value in ijson.basic_parse(stream, buf_size=REPORT_READ_SIZE):
+        if event == "map_key":
+            if depth == 1:
+                root_key = value
+            elif in_buckets and depth == 2:
+                bucket_name = value
+            elif in_buckets and depth == 3:
+                bucket_key = value
+
+        elif event in ("start_map", "start_array"):
+            depth += 1
+            if depth == 2 and root_key == "buckets":
+                if event != "start_map":
+                    raise InvalidS3ReportException("The report's `buckets` item is not a dictionary.")
+                in_buckets = found_buckets = True
+
+            bucket_key = None
+
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+            if depth == 1:
+                in_buckets = False
+
+            bucket_key = None
+
+        elif in_buckets and depth == 3 and bucket_key == "AccountId":
+            yield bucket_name, value
+
+    if not found_buckets:
+        raise InvalidS3ReportException("The report is missing the `buckets` dictionary.")
+
+
+def load_bucket_table(stream):
+    """
+    Incrementally parses the Historical S3 report from a file-like object, and returns the (compact) mapping of
+    Bucket -> Account.
+    :param stream:
+    :return:
+    """
+    return CompactBucketTable.from_items(iter_report_buckets(stream))
+
+
+def download_report(client, etag=None, last_modified=None):
+    """
+    Downloads the Historical S3 report with the client, and parses it as it streams in (see
+    `BucketTable.__fetch_report()`).
+    :param client: The S3 client.
+    :param etag:
+    :param last_modified:
+    :return: Tuple of the table, the report's ETag, and its last modified time -- or `None` if the report has not
+             changed.
+    """
+    log.debug("[~] Fetching Historical S3 Report...")
+    report = get_object_stream(client, CONFIG.reports_bucket, CONFIG.reports_prefix,
+                               etag=etag, last_modified=last_modified,
+                               part_size=CONFIG.report_download_part_size,
+                               concurrency=CONFIG.report_download_concurrency, decompress=True)
+    if not report:
+        return
+
+    log.debug("[+] Successfully fetched Historical S3 Report...")
+
+    stream, etag, last_modified = report
+    try:
+        log.debug("[~] Deserializing the Historical S3 report data...")
+        table = load_bucket_table(stream)
+    finally:
+        stream.close()
+
+    return table, etag, last_modified
+
+
+def get_reports_client():
+    """
+    Gets the S3 client for fetching the Historical S3 report.
+    :return:
+    """
+    return CLIENT_FACTORY.client("s3", region=CONFIG.reports_region)
 
 
 class BucketTable:
@@ -37,43 +142,425 @@ class BucketTable:
 
     To use: `from bucket_snake.s3.models import BUCKET_TABLE`
     Then, `BUCKET_TABLE.buckets["bucket_name"]` to get the account that the bucket resides in
+
+    The table is cached on local disk (`CONFIG.report_cache_dir`) as a memory-mapped bucket index, along with the
+    report's ETag, so that subsequent loads (in warm containers, or other processes on the same host) do not need to
+    re-download or deserialize the report. Every `CONFIG.report_revalidate_interval` seconds, the report is
+    revalidated against S3 with a conditional GET. If it has not changed, this costs a single round trip -- otherwise
+    the new table is swapped in all at once.
+
+    If `CONFIG.bucket_index_path` is set, then that pre-compiled bucket index (see `bucket_snake.s3.index`) is
+    memory-mapped instead, and S3 is never consulted.
+
+    If `CONFIG.reports_shard_manifest` is set, then the report is sharded (see `bucket_snake.s3.shards`). Only the
+    manifest is fetched up front, and shards are fetched as buckets in them are looked up. Use
+    `BUCKET_TABLE.prefetch(bucket_names)` to fetch all of the shards needed for a request in parallel.
+
+    If `CONFIG.bucket_resolver` is set, then `BUCKET_TABLE.lookup("bucket_name")` looks up buckets that are missing
+    from the report (i.e. created since it was dumped) individually (see `bucket_snake.s3.resolvers`).
     """
     def __init__(self):
         self._buckets = None
+        self._etag = None
+        self._last_modified = None
+        self._last_checked = 0
+        self._lock = threading.Lock()
+        self._resolver = None
+        self._resolver_name = None
+        self.resolved = ResolvedBucketCache()
 
     @property
     def buckets(self):
-        if not self._buckets:
-            self._buckets = BucketTable.__get_bucket_table()
+        if CONFIG.bucket_index_path:
+            if self._buckets is None:
+                self.__load_bundled_index()
+
+        elif self._buckets is None or self.is_stale():
+            self.refresh()
 
         return self._buckets
 
+    def is_stale(self):
+        """Has the revalidation interval elapsed since the report was last checked?"""
+        return time.time() - self._last_checked >= CONFIG.report_revalidate_interval
+
+    @property
+    def loaded(self):
+        return self._buckets is not None
+
+    @property
+    def report_version(self):
+        """The ETag and last modified time of the loaded report (for conditional GETs)."""
+        return self._etag, self._last_modified
+
+    def load_report(self, report):
+        """
+        Swaps in a report that was fetched elsewhere (i.e. asynchronously -- see `bucket_snake.aio.fetch_report()`).
+        It is cached to local disk, just like a report that was fetched here.
+        :param report: Tuple of the table, the report's ETag, and its last modified time -- or `None` if the report
+                       has not changed.
+        :return:
+        """
+        with self._lock:
+            if report:
+                table, etag, last_modified = report
+                self._buckets = self.__write_cache(table, etag, last_modified)
+                self._etag, self._last_modified = etag, last_modified
+            else:
+                self.__touch_cache()
+
+            self._last_checked = time.time()
+
+    def refresh(self):
+        """
+        Loads the bucket table (from the local cache if possible), and revalidates it against S3 if it is stale.
+
+        If a table is already loaded, then a failed revalidation is logged and the (stale) table is kept -- it is
+        tried again after `REPORT_RETRY_INTERVAL` seconds. Other threads also keep using the loaded table while it is
+        being revalidated instead of waiting on it. Errors are only raised when there is no table to fall back on.
+        :return:
+        """
+        if not self._lock.acquire(blocking=self._buckets is None):
+            return
+
+        try:
+            if CONFIG.reports_shard_manifest:
+                self.__refresh_manifest()
+                return
+
+            if self._buckets is None:
+                self.__load_from_cache()
+
+            # Someone else may have refreshed it while we were waiting:
+            if self._buckets is not None and not self.is_stale():
+                return
+
+            try:
+                if self._buckets is None:
+                    report = BucketTable.__fetch_report_with_retries(self._etag, self._last_modified)
+                else:
+                    report = BucketTable.__fetch_report(self._etag, self._last_modified)
+
+            except Exception as e:
+                if self._buckets is None:
+                    raise
+
+                log.error("[X] Unable to revalidate the Historical S3 report -- continuing with the current "
+                          "table: {}".format(e))
+                self.__retry_later()
+                return
+
+            if not report:
+                log.debug("[+] The Historical S3 report has not changed.")
+                self._last_checked = time.time()
+                self.__touch_cache()
+                return
+
+            table, etag, last_modified = report
+            table = self.__write_cache(table, etag, last_modified)
+
+            self._buckets, self._etag, self._last_modified = table, etag, last_modified
+            self._last_checked = time.time()
+
+        finally:
+            self._lock.release()
+
+    def __retry_later(self):
+        """Marks the table to be revalidated again in `REPORT_RETRY_INTERVAL` seconds."""
+        self._last_checked = time.time() - max(0, CONFIG.report_revalidate_interval - REPORT_RETRY_INTERVAL)
+
+    def prefetch(self, names):
+        """
+        Makes sure that the supplied bucket names can be looked up without any further fetching. For sharded reports,
+        this fetches (in parallel) only the shards that cover the buckets.
+        :param names:
+        :return:
+        """
+        buckets = self.buckets
+        if isinstance(buckets, ShardedBucketTable):
+            buckets.prefetch(names, concurrency=CONFIG.report_shard_concurrency)
+
+        return buckets
+
+    def lookup(self, name):
+        """
+        Gets the account that the bucket resides in. Buckets that are missing from the report are looked up with the
+        configured resolver (if any), and the result (found or not) is cached.
+        :param name:
+        :return: The account ID, or `None` if the bucket does not exist.
+        :raises BucketLookupException: If the resolver failed (so it is unknown whether the bucket exists).
+        """
+        account = self.buckets.get(name)
+        if account or not CONFIG.bucket_resolver or not isinstance(name, str):
+            return account
+
+        cached, account = self.resolved.get(name)
+        if cached:
+            return account
+
+        resolver = self.__get_resolver()
+
+        log.debug("[~] Bucket: {} is not in the Historical S3 report. Looking it up...".format(name))
+        try:
+            account = resolver.resolve(name)
+
+        except Exception as e:
+            # Don't cache this -- it may be transient:
+            log.error("[X] Unable to look up bucket: {}: {}".format(name, e))
+            raise BucketLookupException("Unable to look up bucket: {}: {}".format(name, e)) from e
+
+        self.resolved.put(name, account)
+
+        return account
+
+    def __get_resolver(self):
+        """The configured resolver (re-created if the configuration has changed)."""
+        with self._lock:
+            if self._resolver is None or self._resolver_name != CONFIG.bucket_resolver:
+                self._resolver = get_resolver(CONFIG.bucket_resolver)
+                self._resolver_name = CONFIG.bucket_resolver
+                self.resolved.clear()
+
+            return self._resolver
+
     @staticmethod
-    def __get_bucket_table():
+    def cache_path(key=None):
         """
-        Fetches the Historical S3 data, and gets back the dictionary mapping of Bucket -> Account
+        The location of the local report cache. This is unique to the reports bucket and prefix (or shard key).
+        :param key:
         :return:
         """
-        log.debug("[~] Fetching the Historical S3 report data for deserialization...")
+        report_hash = hashlib.sha1("{}/{}".format(CONFIG.reports_bucket, key or CONFIG.reports_prefix).encode("utf-8"))
+        return os.path.join(CONFIG.report_cache_dir, "bucket-snake-report-{}.idx".format(report_hash.hexdigest()[:16]))
+
+    def __refresh_manifest(self):
+        """
+        Fetches (or revalidates) the shard manifest. If it has changed, a new sharded table is swapped in.
+        :return:
+        """
+        if isinstance(self._buckets, ShardedBucketTable) and not self.is_stale():
+            return
+
+        etag = self._etag if isinstance(self._buckets, ShardedBucketTable) else None
 
-        report = BucketTable.__fetch_from_s3()
+        try:
+            result = BucketTable.__fetch_manifest(etag)
 
-        return S3ReportSchema(strict=True).loads(report).data["buckets"]
+        except Exception as e:
+            if not isinstance(self._buckets, ShardedBucketTable):
+                raise
+
+            log.error("[X] Unable to revalidate the Historical S3 report shard manifest -- continuing with the "
+                      "current one: {}".format(e))
+            self.__retry_later()
+            return
+
+        if not result:
+            log.debug("[+] The Historical S3 report shard manifest has not changed.")
+
+        else:
+            manifest, etag = result
+            old_table = self._buckets
+            self._buckets = ShardedBucketTable(manifest, BucketTable.__fetch_shard)
+            self._etag, self._last_modified = etag, None
+
+            if isinstance(old_table, ShardedBucketTable):
+                BucketTable.__remove_cached_shards(set(old_table.manifest["shards"]) - set(manifest["shards"]))
+
+        self._last_checked = time.time()
 
     @staticmethod
-    @retry(stop_max_attempt_number=3, wait_exponential_multiplier=1000, wait_exponential_max=10000)
-    def __fetch_from_s3():
+    def __remove_cached_shards(keys):
         """
-        Fetches the Historical reports data from S3
+        Removes the locally cached shards for the given shard keys (i.e. the shards of a manifest that has been
+        replaced), so that old generations do not fill up the cache directory. Anything that still has one of
+        them mapped keeps its mapping.
+        :param keys:
         :return:
         """
-        log.debug("[~] Fetching Historical S3 Report...")
-        client = boto3.client("s3", region_name=CONFIG.reports_region)
+        if not CONFIG.report_cache_dir:
+            return
+
+        for key in keys:
+            try:
+                os.remove(BucketTable.cache_path(key))
+                log.debug("[-] Removed the locally cached shard: {}".format(key))
+
+            except FileNotFoundError:
+                pass
+
+            except OSError as oe:
+                log.error("[X] Unable to remove the locally cached shard {}: {}".format(key, oe))
+
+    @staticmethod
+    @lazy_decorator("retrying", "retry", stop_max_attempt_number=3, wait_exponential_multiplier=1000,
+                    wait_exponential_max=10000,
+                    retry_on_exception=lambda e: not isinstance(e, InvalidBucketIndexException))
+    def __fetch_manifest(etag=None):
+        """
+        Fetches the shard manifest from S3. If an ETag is supplied, this is a conditional GET -- and `None` is
+        returned if the manifest has not changed.
+        :param etag:
+        :return: A tuple of the manifest, and its ETag.
+        """
+        log.debug("[~] Fetching the Historical S3 report shard manifest...")
+
+        try:
+            s3_obj = get_reports_client().get_object(Bucket=CONFIG.reports_bucket, Key=CONFIG.reports_shard_manifest,
+                                                     **({"IfNoneMatch": etag} if etag else {}))
+
+        except ClientError as ce:
+            if ce.response["Error"]["Code"] in ["304", "NotModified"]:
+                return
+
+            raise ce
+
+        try:
+            manifest = json.loads(s3_obj["Body"].read().decode("utf-8"))
+        except ValueError as ve:
+            raise InvalidBucketIndexException("The shard manifest is not valid JSON: {}".format(ve))
+
+        verify_manifest(manifest)
+
+        # The shard keys are relative to the manifest:
+        manifest["shards"] = [posixpath.join(posixpath.dirname(CONFIG.reports_shard_manifest), key)
+                              for key in manifest["shards"]]
+
+        return manifest, s3_obj.get("ETag")
+
+    @staticmethod
+    @lazy_decorator("retrying", "retry", stop_max_attempt_number=3, wait_exponential_multiplier=1000,
+                    wait_exponential_max=10000,
+                    retry_on_exception=lambda e: not isinstance(e, InvalidBucketIndexException))
+    def __fetch_shard(key):
+        """
+        Fetches a report shard from S3 (or from the local cache). Shards are never modified in place (a new report
+        is a new set of shard keys), so a locally cached shard never needs revalidation.
+        :param key:
+        :return:
+        """
+        path = BucketTable.cache_path(key) if CONFIG.report_cache_dir else None
+        if path and os.path.exists(path):
+            try:
+                return MappedBucketTable.open(path)
+            except (OSError, InvalidBucketIndexException) as e:
+                log.debug("[-] Unable to load the locally cached shard {}: {}".format(key, e))
+
+        log.debug("[~] Fetching Historical S3 report shard: {}...".format(key))
+        s3_obj = get_reports_client().get_object(Bucket=CONFIG.reports_bucket, Key=key)
+        shard = s3_obj["Body"].read()
+
+        if path:
+            try:
+                write_atomically(path, lambda file_obj: file_obj.write(shard))
 
-        s3_obj = client.get_object(Bucket=CONFIG.reports_bucket, Key=CONFIG.reports_prefix)
-        log.debug("[+] Successfully fetched Historical S3 Report...")
+                return MappedBucketTable.open(path)
 
-        return s3_obj["Body"].read().decode()
+            except OSError as oe:
+                log.error("[X] Unable to cache the Historical S3 report shard {}: {}".format(key, oe))
+
+        return MappedBucketTable.from_buffer(shard, name=key)
+
+    def __load_bundled_index(self):
+        """
+        Memory-maps a pre-compiled bucket index (i.e. one shipped in a Lambda layer). This is never revalidated.
+        :return:
+        """
+        with self._lock:
+            if self._buckets is None:
+                log.debug("[~] Mapping the bucket index at: {}...".format(CONFIG.bucket_index_path))
+                self._buckets = MappedBucketTable.open(CONFIG.bucket_index_path)
+
+    def __load_from_cache(self):
+        """
+        Memory-maps the bucket table from the local cache (if present). The cache file's modified time is the last time
+        that the report was checked against S3.
+        :return:
+        """
+        if not CONFIG.report_cache_dir:
+            return
+
+        path = BucketTable.cache_path()
+
+        try:
+            table = MappedBucketTable.open(path)
+            last_checked = os.path.getmtime(path)
+
+        except (OSError, InvalidBucketIndexException) as e:
+            log.debug("[-] Unable to load the local Historical S3 report cache: {}".format(e))
+            return
+
+        log.debug("[+] Loaded the Historical S3 report from the local cache.")
+        self._buckets = table
+        self._etag = table.metadata.get("etag")
+        self._last_modified = datetime.fromtimestamp(table.metadata["last_modified"], tz=timezone.utc) \
+            if table.metadata.get("last_modified") else None
+        self._last_checked = last_checked
+
+    @staticmethod
+    def __write_cache(table, etag, last_modified):
+        """
+        Writes out the bucket table to the local cache (as a binary bucket index), and then memory-maps it back in.
+        This returns the mapped table -- or the original table if the cache could not be written.
+        :param table:
+        :param etag:
+        :param last_modified:
+        :return:
+        """
+        if not CONFIG.report_cache_dir:
+            return table
+
+        metadata = {
+            "etag": etag,
+            "last_modified": last_modified.timestamp() if last_modified else None
+        }
+
+        try:
+            write_bucket_index(table, BucketTable.cache_path(), metadata=metadata)
+            return MappedBucketTable.open(BucketTable.cache_path())
+
+        except (OSError, InvalidBucketIndexException) as e:
+            log.error("[X] Unable to write the local Historical S3 report cache: {}".format(e))
+            return table
+
+    @staticmethod
+    def __touch_cache():
+        """Marks the local cache as having just been revalidated."""
+        if not CONFIG.report_cache_dir:
+            return
+
+        try:
+            os.utime(BucketTable.cache_path())
+        except OSError:
+            pass
+
+    @staticmethod
+    @lazy_decorator("retrying", "retry", stop_max_attempt_number=3, wait_exponential_multiplier=1000,
+                    wait_exponential_max=10000,
+                    retry_on_exception=lambda e: not isinstance(e, InvalidS3ReportException))
+    def __fetch_report_with_retries(etag=None, last_modified=None):
+        """`__fetch_report()`, retried with backoff -- for when there is no table loaded to fall back on."""
+        return BucketTable.__fetch_report(etag=etag, last_modified=last_modified)
+
+    @staticmethod
+    def __fetch_report(etag=None, last_modified=None):
+        """
+        Fetches the Historical S3 report from S3 and gets back the mapping of Bucket -> Account, along with
+        the report's ETag and last modified time. The report body is parsed as it streams in from S3.
+
+        If an ETag or last modified time is supplied, this is a conditional GET -- if the report has not changed, then
+        nothing is downloaded and `None` is returned.
+
+        Large reports are downloaded with concurrent byte-range GETs (see `CONFIG.report_download_concurrency` and
+        `CONFIG.report_download_part_size`), which are fed in order into the parser.
+
+        Reports that are gzip or zstd compressed (by Content-Encoding, or a `.gz`/`.zst` key) are decompressed as they
+        stream in -- only the compressed bytes are transferred, and no decompressed copy is ever written out.
+        :param etag:
+        :param last_modified:
+        :return:
+        """
+        return download_report(get_reports_client(), etag=etag, last_modified=last_modified)
 
 
 # Use this for all S3 Historical Bucket related data:
@@ -42,7 +42,7 @@ S3_PERMISSIONS = {
 
 def check_if_cross_account(source_account_number, bucket):
     """Determine if the bucket resides in a different account than the source account"""
-    if BUCKET_TABLE.buckets[bucket] == source_account_number:
+    if BUCKET_TABLE.lookup(bucket) == source_account_number:
         return False
 
     return True
@@ -58,11 +58,13 @@ def build_bucket_account_mapping(request_data):
     buckets_same_account = {}
     buckets_cross_account = {}
 
+    BUCKET_TABLE.prefetch(request_data["buckets"].keys())
+
     for bucket, permissions in request_data["buckets"].items():
         # Determine which account the given bucket is in:
         if check_if_cross_account(request_data["account_number"], bucket):
             buckets_cross_account[bucket] = dict(permissions=permissions,
-                                                 account_number=BUCKET_TABLE.buckets[bucket])
+                                                 account_number=BUCKET_TABLE.lookup(bucket))
         else:
             buckets_same_account[bucket] = dict(permissions=permissions,
                                                 account_number=request_data["account_number"])
@@ -124,7 +126,7 @@ def create_s3_role_policies(collected_policies):
                 "Sid": perm.title(),
                 "Effect": "Allow",
                 "Action": S3_PERMISSIONS[perm],
-                "Resource": list(arns)
+                "Resource": sorted(arns)
             })
 
         account_iam_policies[account] = {
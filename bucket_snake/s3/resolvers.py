@@ -0,0 +1,133 @@
+"""
+.. module: bucket_snake.s3.resolvers
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Miss-path bucket resolvers.
+
+The Historical S3 report is a periodic dump, so buckets created since the last dump are not in it. Rather than
+waiting for (and reloading) a whole new report, a bucket that is missing from the report is looked up on its own
+with a `BucketResolver`. Set `BUCKET_RESOLVER` to the name of a registered resolver (see `RESOLVERS`), or to the
+`package.module:ClassName` of a custom `BucketResolver` subclass.
+
+Results are kept in a `ResolvedBucketCache` -- found buckets for `BUCKET_RESOLVER_TTL` seconds, and buckets that
+do not exist for `BUCKET_RESOLVER_NEGATIVE_TTL` seconds -- so repeated lookups of the same missing bucket are free.
+"""
+import importlib
+import threading
+import time
+from collections import OrderedDict
+
+from bucket_snake.config import CONFIG
+from bucket_snake.util.clients import CLIENT_FACTORY
+
+# The most resolved (or known missing) buckets to keep in the cache:
+RESOLVED_CACHE_SIZE = 10000
+
+
+class BucketResolver:
+    """
+    Base class for looking up the account of a single bucket outside of the Historical S3 report.
+    """
+    def resolve(self, name):
+        """
+        Looks up the account that the bucket resides in.
+        :param name: The bucket name.
+        :return: The account ID, or `None` if the bucket does not exist.
+        """
+        raise NotImplementedError
+
+
+class HistoricalResolver(BucketResolver):
+    """
+    Looks up buckets in the Historical S3 current table (DynamoDB), which is what the report is dumped from -- so it
+    has buckets as soon as Historical sees them.
+    """
+    def __init__(self, table=None, region=None):
+        self.table = table or CONFIG.historical_s3_table
+        self.client = CLIENT_FACTORY.client("dynamodb", region=region or CONFIG.historical_s3_table_region)
+
+    def resolve(self, name):
+        item = self.client.get_item(TableName=self.table, Key={"arn": {"S": "arn:aws:s3:::{}".format(name)}},
+                                    ProjectionExpression="accountId").get("Item")
+
+        if not item or not item.get("accountId"):
+            return None
+
+        return item["accountId"]["S"]
+
+
+# Resolvers that can be selected by name via `BUCKET_RESOLVER`:
+RESOLVERS = {
+    "historical": HistoricalResolver
+}
+
+
+def get_resolver(name):
+    """
+    Instantiates the resolver -- either a registered one (see `RESOLVERS`), or a `package.module:ClassName`.
+    :param name:
+    :return:
+    """
+    if name in RESOLVERS:
+        return RESOLVERS[name]()
+
+    module, _, class_name = name.partition(":")
+    if not class_name:
+        raise ValueError("Unknown bucket resolver: {}. Must be one of: {}, or a `package.module:ClassName`."
+                         .format(name, ", ".join(sorted(RESOLVERS))))
+
+    return getattr(importlib.import_module(module), class_name)()
+
+
+class ResolvedBucketCache:
+    """
+    Thread-safe cache of bucket lookups made by a resolver. Found buckets and missing buckets have separate TTLs.
+    The oldest entries are evicted once there are more than `max_size` of them.
+    """
+    def __init__(self, max_size=RESOLVED_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """
+        :param name:
+        :return: A tuple of whether or not the bucket is cached, and its account ID (`None` if it does not exist).
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return False, None
+
+            account, expiration = entry
+            if time.time() >= expiration:
+                del self._entries[name]
+                return False, None
+
+            return True, account
+
+    def put(self, name, account):
+        """
+        Caches the result of a lookup. `account` is `None` for buckets that do not exist.
+        :param name:
+        :param account:
+        :return:
+        """
+        ttl = CONFIG.bucket_resolver_ttl if account else CONFIG.bucket_resolver_negative_ttl
+
+        with self._lock:
+            self._entries.pop(name, None)
+            self._entries[name] = (account, time.time() + ttl)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,126 @@
+"""
+.. module: bucket_snake.s3.shards
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Sharded bucket tables.
+
+The Historical S3 report can be compiled (see `bucket_snake.s3.index`) into N small bucket index shards, split by
+a hash of the bucket name, plus a manifest that describes them:
+```
+{
+    "version": 1,
+    "hash": "crc32",
+    "shard_count": 64,
+    "bucket_count": 1234567,
+    "shards": ["20171122231730/shard-00000.idx", ...]   # Relative to the manifest
+}
+```
+With a sharded report, a request only needs to fetch the shards that cover the buckets it names.
+"""
+import threading
+import zlib
+from collections.abc import Mapping
+
+from bucket_snake.util.exceptions import InvalidBucketIndexException
+
+MANIFEST_VERSION = 1
+
+
+def shard_for_bucket(name, shard_count):
+    """
+    Determines which shard a bucket name belongs in.
+    :param name:
+    :param shard_count:
+    :return:
+    """
+    return zlib.crc32(name.encode("utf-8")) % shard_count
+
+
+def verify_manifest(manifest):
+    """
+    Verifies that the shard manifest is something that we understand.
+    :param manifest:
+    :return:
+    """
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION \
+            or manifest.get("hash") != "crc32":
+        raise InvalidBucketIndexException("The shard manifest is not a (version {}) shard manifest."
+                                          .format(MANIFEST_VERSION))
+
+    if not manifest.get("shard_count") or len(manifest.get("shards", [])) != manifest["shard_count"]:
+        raise InvalidBucketIndexException("The shard manifest does not list all of its shards.")
+
+
+class ShardedBucketTable(Mapping):
+    """
+    Read-only mapping of Bucket -> Account backed by a sharded report.
+
+    Shards are fetched (via the supplied `fetch_shard` function) the first time a bucket in them is looked up,
+    and are kept for the life of the table. Use `prefetch()` to fetch all of the shards for a set of buckets
+    in parallel.
+    """
+    def __init__(self, manifest, fetch_shard):
+        """
+        :param manifest: The (verified) shard manifest.
+        :param fetch_shard: Function that takes a shard key from the manifest, and returns the bucket table for it.
+        """
+        self.manifest = manifest
+        self._fetch_shard = fetch_shard
+        self._shards = {}
+        self._lock = threading.Lock()
+
+    def shard_for(self, name):
+        return shard_for_bucket(name, self.manifest["shard_count"])
+
+    def _shard(self, number):
+        table = self._shards.get(number)
+        if table is None:
+            table = self._fetch_shard(self.manifest["shards"][number])
+            with self._lock:
+                self._shards[number] = table
+
+        return table
+
+    def prefetch(self, names, concurrency=8):
+        """
+        Fetches all of the (not yet fetched) shards covering the supplied bucket names in parallel.
+        :param names:
+        :param concurrency: The most shards to fetch at once.
+        :return:
+        """
+        missing = sorted({self.shard_for(name) for name in names if isinstance(name, str)} - set(self._shards))
+
+        if len(missing) == 1 or concurrency <= 1:
+            for number in missing:
+                self._shard(number)
+
+        elif missing:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=min(concurrency, len(missing))) as executor:
+                list(executor.map(self._shard, missing))
+
+    @property
+    def fetched_shards(self):
+        """The shard numbers that have been fetched so far."""
+        return sorted(self._shards)
+
+    def __getitem__(self, name):
+        if not isinstance(name, str):
+            raise KeyError(name)
+
+        return self._shard(self.shard_for(name))[name]
+
+    def __contains__(self, name):
+        return isinstance(name, str) and name in self._shard(self.shard_for(name))
+
+    def __len__(self):
+        return self.manifest["bucket_count"]
+
+    def __iter__(self):
+        # This has to fetch every shard:
+        for number in range(self.manifest["shard_count"]):
+            yield from self._shard(number)
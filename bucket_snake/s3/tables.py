@@ -0,0 +1,288 @@
+"""
+.. module: bucket_snake.s3.tables
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from collections.abc import Mapping
+
+from bucket_snake.util.exceptions import InvalidBucketIndexException
+
+# The binary bucket index file format (all little-endian):
+#   - Header (see `INDEX_HEADER`): magic, version, number of accounts, number of buckets, the byte-lengths of the
+#     metadata, accounts, and names sections, and the array typecodes for the offsets and account indexes
+#   - Name offsets array (bucket count + 1 items)
+#   - Account index array (bucket count items), padded to 8 bytes
+#   - Metadata (JSON)
+#   - Accounts (UTF-8, newline separated)
+#   - Bucket names (UTF-8, sorted, concatenated)
+INDEX_MAGIC = b"BSNKIDX\x00"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<8sIIQQQQcc6x")
+
+
+class CompactBucketTable(Mapping):
+    """
+    Read-only, memory-compact mapping of Bucket -> Account.
+
+    A plain dictionary of millions of bucket names costs a full string object (plus a hash table slot) per bucket,
+    and another string object per account ID -- even though there are only a few thousand distinct accounts.
+    This instead keeps:
+        - All of the bucket names, UTF-8 encoded and sorted, concatenated into a single `bytes` blob
+        - An array of offsets into that blob for where each name starts
+        - An array of indexes into the (interned) list of distinct account IDs for each name
+
+    Lookups are a binary search over the sorted names, so they are O(log n).
+
+    This behaves like a (read-only) dictionary, so `table.get("bucket_name")` and `table["bucket_name"]` work
+    as expected.
+    """
+    def __init__(self, names, offsets, account_indexes, accounts, names_start=0):
+        """
+        :param names: All bucket names (UTF-8) in sorted order, concatenated together.
+        :param offsets: Where each name starts in `names`. This has one more item than there are names
+                        (the end of the last name).
+        :param account_indexes: For each name, the index of its account in `accounts`.
+        :param accounts: The distinct account IDs.
+        :param names_start: Where the names start within `names` (for when it is a larger buffer).
+        """
+        self._names = names
+        self._names_start = names_start
+        self._offsets = offsets
+        self._account_indexes = account_indexes
+        self._accounts = accounts
+
+    @classmethod
+    def from_items(cls, items):
+        """
+        Builds the table from an iterable of `(bucket_name, account_id)` pairs.
+        :param items:
+        :return:
+        """
+        accounts = []
+        account_lookup = {}
+        names = []
+        account_indexes = array("I")
+
+        for name, account in items:
+            index = account_lookup.get(account)
+            if index is None:
+                index = account_lookup[account] = len(accounts)
+                accounts.append(account)
+
+            names.append(name.encode("utf-8"))
+            account_indexes.append(index)
+
+        order = sorted(range(len(names)), key=names.__getitem__)
+
+        offsets = [0]
+        for i in order:
+            offsets.append(offsets[-1] + len(names[i]))
+
+        return cls(b"".join([names[i] for i in order]),
+                   array("I" if offsets[-1] < 2 ** 32 else "Q", offsets),
+                   array("H" if len(accounts) < 2 ** 16 else "I", (account_indexes[i] for i in order)),
+                   accounts)
+
+    def _name_at(self, index):
+        return self._names[self._names_start + self._offsets[index]:self._names_start + self._offsets[index + 1]]
+
+    def _find(self, name):
+        """
+        Binary search for the position of the bucket name.
+        :param name:
+        :return: The index of the name, or -1 if it is not in the table.
+        """
+        if not isinstance(name, str):
+            return -1
+
+        key = name.encode("utf-8")
+        low, high = 0, len(self)
+
+        while low < high:
+            middle = (low + high) // 2
+            if self._name_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < len(self) and self._name_at(low) == key:
+            return low
+
+        return -1
+
+    def __getitem__(self, name):
+        index = self._find(name)
+        if index < 0:
+            raise KeyError(name)
+
+        return self._accounts[self._account_indexes[index]]
+
+    def __contains__(self, name):
+        return self._find(name) >= 0
+
+    def __len__(self):
+        return len(self._account_indexes)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._name_at(index).decode("utf-8")
+
+    def items(self):
+        for index in range(len(self)):
+            yield self._name_at(index).decode("utf-8"), self._accounts[self._account_indexes[index]]
+
+    @property
+    def accounts(self):
+        """The distinct account IDs in the table."""
+        return list(self._accounts)
+
+    def write_index(self, file_obj, metadata=None):
+        """
+        Writes the table out in the binary bucket index format, which can be memory-mapped with
+        `MappedBucketTable.open()`.
+        :param file_obj: A binary file-like object to write to.
+        :param metadata: Optional dictionary of details to store with the index (i.e. the report's ETag).
+        :return:
+        """
+        offsets = array(self._offsets.typecode, self._offsets)
+        account_indexes = array(self._account_indexes.typecode, self._account_indexes)
+        if sys.byteorder != "little":
+            offsets.byteswap()
+            account_indexes.byteswap()
+
+        metadata = json.dumps(metadata or {}).encode("utf-8")
+        accounts = "\n".join(self._accounts).encode("utf-8")
+        names = self._names[self._names_start:self._names_start + self._offsets[-1]]
+
+        file_obj.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(self._accounts), len(self),
+                                         len(metadata), len(accounts), len(names),
+                                         offsets.typecode.encode("ascii"), account_indexes.typecode.encode("ascii")))
+        file_obj.write(offsets.tobytes())
+        file_obj.write(account_indexes.tobytes())
+        file_obj.write(b"\x00" * _padding(len(account_indexes) * account_indexes.itemsize))
+        file_obj.write(metadata)
+        file_obj.write(accounts)
+        file_obj.write(names)
+
+
+class MappedBucketTable(CompactBucketTable):
+    """
+    A `CompactBucketTable` that is memory-mapped directly from a binary bucket index file.
+
+    Nothing is deserialized when the index is opened (aside from the small list of account IDs), so opening it is
+    the same cost no matter how many buckets there are. Lookups binary-search the mapped file, and the pages are
+    shared (via the OS page cache) by every process on the host that maps the same file.
+    """
+    def __init__(self, buffer, metadata, offsets, account_indexes, accounts, names_start):
+        super().__init__(buffer, offsets, account_indexes, accounts, names_start=names_start)
+        self.metadata = metadata
+
+    @classmethod
+    def open(cls, path):
+        """
+        Memory-maps the binary bucket index file at the given path.
+        :param path:
+        :return:
+        """
+        with open(path, "rb") as index_file:
+            if os.fstat(index_file.fileno()).st_size < INDEX_HEADER.size:
+                raise InvalidBucketIndexException("{} is too small to be a bucket index.".format(path))
+
+            mapped = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            return cls.from_buffer(mapped, name=path)
+
+        except InvalidBucketIndexException:
+            mapped.close()
+            raise
+
+    @classmethod
+    def from_buffer(cls, buffer, name="<buffer>"):
+        """
+        Loads the bucket index from a buffer (an `mmap` or `bytes`) that holds the binary bucket index.
+        The buffer is used as-is -- nothing is copied out of it.
+        :param buffer:
+        :param name: What to call the index in error messages.
+        :return:
+        """
+        if sys.byteorder != "little":
+            raise InvalidBucketIndexException("Bucket indexes can only be mapped on little-endian hosts.")
+
+        try:
+            magic, version, account_count, bucket_count, metadata_length, accounts_length, names_length, \
+                offset_type, index_type = INDEX_HEADER.unpack_from(buffer)
+
+            if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                raise InvalidBucketIndexException("{} is not a (version {}) bucket index.".format(name, INDEX_VERSION))
+
+            offset_type, index_type = offset_type.decode("ascii"), index_type.decode("ascii")
+
+            position = INDEX_HEADER.size
+            offsets_end = position + (bucket_count + 1) * array(offset_type).itemsize
+            indexes_end = offsets_end + bucket_count * array(index_type).itemsize
+            metadata_start = indexes_end + _padding(indexes_end - offsets_end)
+            accounts_start = metadata_start + metadata_length
+            names_start = accounts_start + accounts_length
+
+            if names_start + names_length != len(buffer):
+                raise InvalidBucketIndexException("{} is truncated or corrupt.".format(name))
+
+            metadata = json.loads(bytes(buffer[metadata_start:accounts_start]).decode("utf-8"))
+            accounts = bytes(buffer[accounts_start:names_start]).decode("utf-8").split("\n") \
+                if accounts_length else []
+
+        except (struct.error, ValueError, TypeError) as e:
+            raise InvalidBucketIndexException("{} is not a valid bucket index: {}".format(name, e))
+
+        view = memoryview(buffer)
+        return cls(buffer, metadata, view[position:offsets_end].cast(offset_type),
+                   view[offsets_end:indexes_end].cast(index_type), accounts, names_start)
+
+
+def write_bucket_index(table, path, metadata=None):
+    """
+    Writes the table out to a binary bucket index file. This is written to a temporary file first, and then moved
+    into place, so that readers (which may have the old index mapped) never see a partially written index.
+    :param table: The `CompactBucketTable` to write out.
+    :param path:
+    :param metadata: Optional dictionary of details to store with the index.
+    :return:
+    """
+    write_atomically(path, lambda file_obj: table.write_index(file_obj, metadata=metadata))
+
+
+def write_atomically(path, write):
+    """
+    Writes a file by calling `write` with a temporary file (in the same directory), and then moving that into place.
+    The temporary file is removed if anything goes wrong.
+    :param path:
+    :param write: Function that takes a binary file-like object, and writes the contents to it.
+    :return:
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+
+    with tempfile.NamedTemporaryFile("wb", dir=directory, prefix=".bucket-snake-index-", delete=False) as temp:
+        try:
+            write(temp)
+
+        except Exception:
+            temp.close()
+            os.remove(temp.name)
+            raise
+
+    os.replace(temp.name, path)
+
+
+def _padding(length, alignment=8):
+    """How many bytes are needed to pad `length` out to the alignment."""
+    return -length % alignment
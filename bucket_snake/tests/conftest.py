@@ -10,14 +10,18 @@ import os
 
 import boto3
 import pytest
-from moto import mock_sts, mock_iam, mock_s3
+from moto import mock_sts, mock_iam, mock_s3, mock_dynamodb2
 
 import bucket_snake.iam.util
 import bucket_snake.config
+import bucket_snake.request_schemas
 from bucket_snake.config import CONFIG
+from bucket_snake.iam.inventory import ACCOUNT_INVENTORIES
 from bucket_snake.tests.conf import SWAG_BUCKET, HISTORICAL_REPORT_BUCKET, EXISTING_ASPD
 import bucket_snake.s3.models
 from bucket_snake.s3.models import BUCKET_TABLE, BucketTable
+from bucket_snake.util.accounts import AccountRegistry
+from bucket_snake.util.clients import CLIENT_FACTORY
 
 
 class MockContext:
@@ -43,6 +47,7 @@ def sts():
     yield client
 
     mock_sts().stop()
+    CLIENT_FACTORY.reset()
 
 
 @pytest.yield_fixture(scope="function")
@@ -68,8 +73,25 @@ def s3():
 
 
 @pytest.yield_fixture(scope="function")
-def config():
-    old_config = bucket_snake.config.CONFIG
+def historical_table():
+    """A stand-in for the Historical S3 current table, which the report is dumped from."""
+    mock_dynamodb2().start()
+
+    client = boto3.client("dynamodb", region_name="us-west-2")
+    client.create_table(TableName="HistoricalS3CurrentTable",
+                        KeySchema=[{"AttributeName": "arn", "KeyType": "HASH"}],
+                        AttributeDefinitions=[{"AttributeName": "arn", "AttributeType": "S"}],
+                        ProvisionedThroughput={"ReadCapacityUnits": 1, "WriteCapacityUnits": 1})
+
+    yield client
+
+    mock_dynamodb2().stop()
+
+
+@pytest.yield_fixture(scope="function")
+def config(tmpdir):
+    # Restored afterwards -- even if a test (or a fixture that uses this one) fails:
+    old_settings = dict(vars(CONFIG))
     CONFIG.app_reports_buckets = [HISTORICAL_REPORT_BUCKET]
     CONFIG.swag_region = "us-west-2"
     CONFIG.swag_data_file = "accounts.json"
@@ -78,16 +100,20 @@ def config():
     CONFIG.reports_region = "us-west-2"
     CONFIG.blacklisted_source_accounts = ["666666666666", "000000000000"]
     CONFIG.blacklisted_bucket_accounts = ["989898989898", "898989898989", "666666666666"]
+    CONFIG.report_cache_dir = str(tmpdir)
 
     yield
 
-    bucket_snake.config.CONFIG = old_config
+    vars(CONFIG).clear()
+    vars(CONFIG).update(old_settings)
 
 
 @pytest.yield_fixture(scope="function")
 def iam_client_dict():
     yield
-    bucket_snake.iam.util.IAM_CLIENTS = {}
+    bucket_snake.iam.util.IAM_CLIENTS.clear()
+    bucket_snake.iam.util.IAM_RATE_LIMITER.reset()
+    ACCOUNT_INVENTORIES.clear()
 
 
 @pytest.yield_fixture(scope="function")
@@ -103,6 +129,14 @@ def buckets(s3):
     for bucket, key in bucket_keys:
         s3.put_object(Bucket=bucket, Key=key, Body=get_json(key))
 
+    # The SWAG data is new -- so don't use what an earlier test loaded:
+    old_registry = bucket_snake.request_schemas.ACCOUNT_REGISTRY
+    bucket_snake.request_schemas.ACCOUNT_REGISTRY = AccountRegistry()
+
+    yield
+
+    bucket_snake.request_schemas.ACCOUNT_REGISTRY = old_registry
+
 
 @pytest.yield_fixture(scope="function")
 def bucket_table(buckets, config):
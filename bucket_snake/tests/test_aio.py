@@ -0,0 +1,179 @@
+"""
+.. module: bucket_snake.tests.test_aio
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+The asyncio engine is tested against a moto server (the in-process moto mocks don't intercept aiobotocore).
+"""
+import asyncio
+import copy
+import json
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import boto3
+import pytest
+
+import bucket_snake.aio
+import bucket_snake.entrypoints
+import bucket_snake.request_schemas
+import bucket_snake.s3.permissions
+from bucket_snake.config import CONFIG
+from bucket_snake.iam.inventory import AccountInventory
+from bucket_snake.iam.util import IAM_RATE_LIMITER, WRITE_STATS, format_role_arn
+from bucket_snake.s3.models import BucketTable
+from bucket_snake.tests.conf import SWAG_BUCKET, HISTORICAL_REPORT_BUCKET, EXISTING_ASPD
+from bucket_snake.tests.conftest import get_json
+from bucket_snake.util.accounts import AccountRegistry
+from bucket_snake.util.clients import CLIENT_FACTORY
+from bucket_snake.util.exceptions import SourceRoleDoesNotExistException
+
+pytest.importorskip("aiobotocore")
+pytest.importorskip("flask")  # For the moto server
+
+from bucket_snake.aio import AsyncEngine, check_for_role, create_destination_roles, create_iam_role, \
+    fetch_report, put_role_policy, update_aspd  # noqa: E402
+
+
+@pytest.yield_fixture(scope="module")
+def moto_server():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    server = subprocess.Popen([sys.executable, "-m", "moto.server", "-p", str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            break
+
+        except OSError:
+            time.sleep(0.1)
+
+    yield "http://127.0.0.1:{}".format(port)
+
+    server.terminate()
+    server.wait()
+
+
+@pytest.yield_fixture(scope="function")
+def server(moto_server, config, iam_client_dict, monkeypatch):
+    """Sets up the buckets and source role on the moto server, and points the (regular) clients at it."""
+    # Unlike the moto mocks, the server doesn't supply fake credentials:
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.delenv("AWS_SESSION_TOKEN", raising=False)
+
+    urllib.request.urlopen(urllib.request.Request("{}/moto-api/reset".format(moto_server), method="POST")).close()
+
+    s3 = boto3.client("s3", region_name="us-west-2", endpoint_url=moto_server)
+    for bucket, key in [(SWAG_BUCKET, "accounts.json"), (HISTORICAL_REPORT_BUCKET, "historical-s3-report.json")]:
+        s3.create_bucket(Bucket=bucket, CreateBucketConfiguration={"LocationConstraint": "us-west-2"})
+        s3.put_object(Bucket=bucket, Key=key, Body=get_json(key))
+
+    iam = boto3.client("iam", endpoint_url=moto_server)
+    iam.create_role(Path="/", RoleName="someAppInstanceProfile", AssumeRolePolicyDocument=json.dumps(EXISTING_ASPD))
+
+    # The SWAG data is loaded by the regular S3 client:
+    monkeypatch.setenv("AWS_ENDPOINT_URL", moto_server)
+    CLIENT_FACTORY.reset()
+
+    # The request state store uses the regular IAM clients (which assume roles with the regional STS endpoints):
+    monkeypatch.setattr(CONFIG, "request_state_store", "none")
+
+    table = BucketTable()
+    for module in [bucket_snake.entrypoints, bucket_snake.request_schemas, bucket_snake.s3.permissions]:
+        monkeypatch.setattr(module, "BUCKET_TABLE", table)
+    monkeypatch.setattr(bucket_snake.request_schemas, "ACCOUNT_REGISTRY", AccountRegistry())
+
+    yield iam
+
+    CLIENT_FACTORY.reset()
+
+
+def test_async_engine(server, moto_server, monkeypatch):
+    async def go():
+        async with AsyncEngine(endpoint_url=moto_server) as engine:
+            client = await engine.get_iam_client("012345678910")
+            assert await engine.get_iam_client("012345678910") is client
+
+            assert await check_for_role("someAppInstanceProfile", client)
+            assert not await check_for_role("notARole", client)
+
+            source_arn = format_role_arn("someAppInstanceProfile", "012345678910")
+            await create_iam_role(client, "someApp-012345678910", source_arn, "Test", path="/bucketsnake/")
+            role = await check_for_role("someApp-012345678910", client)
+            assert role["Role"]["Path"] == "/bucketsnake/"
+
+            # Nothing is written when nothing has changed:
+            assert not await update_aspd(client, "someApp-012345678910", source_arn, existing_role=role)
+            policy = {"Statement": [{"Effect": "Allow", "Action": "s3:GetObject", "Resource": "*"}]}
+            assert await put_role_policy(client, "someApp-012345678910", "BucketSnake", policy)
+            assert not await put_role_policy(client, "someApp-012345678910", "BucketSnake", policy)
+
+            # Many roles, in many accounts, at once (the moto server only has one account -- so the names differ):
+            errors = await create_destination_roles(engine, {
+                account: [(number, policy, "{}{}".format(app, number), "someAppInstanceProfile", "012345678910")
+                          for number in range(20)]
+                for account, app in [("012345678911", "app"), ("012345678912", "otherApp")]
+            })
+            assert not errors
+
+            # The calls went through the rate limiter:
+            assert set(IAM_RATE_LIMITER.stats()["accounts"]) == {"012345678910", "012345678911", "012345678912"}
+
+            # With the account inventories, the roles are looked up in them -- and they are kept up to date:
+            inventory = AccountInventory.sweep("012345678911", server)
+            monkeypatch.setattr(CONFIG, "account_inventory", True)
+            monkeypatch.setattr(bucket_snake.aio, "get_account_inventory", lambda account: inventory)
+            written, _ = WRITE_STATS.snapshot()
+            assert not await create_destination_roles(engine, {"012345678911": [
+                (number, policy, "app{}".format(number), "someAppInstanceProfile", "012345678910")
+                for number in [0, 20]]})
+            assert WRITE_STATS.written == written + 1
+            assert inventory.get_role("app20-012345678910")["Role"]["Path"] == "/"
+            assert inventory.get_role_policy("app20-012345678910", "BucketSnake")
+            monkeypatch.setattr(CONFIG, "account_inventory", False)
+
+            table, etag, _ = await fetch_report(engine)
+            assert "test-bucket-one" in table
+            assert await fetch_report(engine, etag=etag) is None
+
+            # Streamed in with byte-range GETs, like the regular path:
+            monkeypatch.setattr(CONFIG, "report_download_part_size", 100)
+            monkeypatch.setattr(CONFIG, "report_download_concurrency", 3)
+            assert (await fetch_report(engine))[0] == table
+
+    asyncio.run(go())
+
+    roles = [role["RoleName"] for role in server.list_roles()["Roles"]]
+    assert "app19-012345678910" in roles
+    assert "otherApp19-012345678910" in roles
+
+
+def test_async_handler(server, moto_server, s3_role_event):
+    other_app = dict(copy.deepcopy(s3_role_event), role_name="otherAppInstanceProfile", app_name="otherApp")
+    server.create_role(Path="/", RoleName="otherAppInstanceProfile", AssumeRolePolicyDocument=json.dumps(EXISTING_ASPD))
+
+    event = {"requests": [s3_role_event, other_app, "not a request"]}
+    results = asyncio.run(bucket_snake.entrypoints.async_handler(event, endpoint_url=moto_server))["results"]
+    assert [result["status"] for result in results] == ["updated", "updated", "failed"]
+
+    # Same as the regular path:
+    policies = server.list_role_policies(RoleName="someAppInstanceProfile")["PolicyNames"]
+    assert sorted(policies) == ["BucketSnake", "BucketSnakeAssumeRole"]
+    policy = server.get_role_policy(RoleName="someAppInstanceProfile", PolicyName=CONFIG.sts_policy_name)
+    assert policy["PolicyDocument"]["Statement"][0]["Resource"] == \
+        ["arn:aws:iam::012345678911:role/someApp-012345678910"]
+    assert server.get_role(RoleName="otherApp-012345678910")
+
+    with pytest.raises(SourceRoleDoesNotExistException):
+        asyncio.run(bucket_snake.entrypoints.async_handler(dict(s3_role_event, role_name="notARole"),
+                                                           endpoint_url=moto_server))
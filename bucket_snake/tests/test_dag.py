@@ -0,0 +1,58 @@
+"""
+.. module: bucket_snake.tests.test_dag
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+"""
+import time
+
+import pytest
+
+from bucket_snake.util.dag import SKIP, TaskGraph
+
+
+def slow(seconds, result):
+    def task(*args):
+        time.sleep(seconds)
+        return result
+
+    return task
+
+
+def test_task_graph():
+    graph = TaskGraph("test")
+    graph.add("one", slow(0.1, 1))
+    graph.add("two", slow(0.2, 2))
+    graph.add("sum", lambda one, two: one + two, "one", "two")
+    graph.add("double", lambda total: total * 2, "sum")
+
+    started = time.monotonic()
+    results = graph.run()
+
+    # The independent tasks overlapped:
+    assert time.monotonic() - started < 0.3
+    assert results == {"one": 1, "two": 2, "sum": 3, "double": 6}
+    assert [name for name, _ in graph.critical_path()] == ["two", "sum", "double"]
+
+    with pytest.raises(ValueError):
+        graph.add("missing", lambda: None, "not-a-task")
+
+    # Skipped tasks skip the tasks that depend on them:
+    graph = TaskGraph("test")
+    graph.add("check", lambda: SKIP)
+    graph.add("other", lambda: "done")
+    graph.add("write", lambda check: "written", "check")
+    graph.add("after", lambda write, other: "after", "write", "other")
+    assert graph.run() == {"check": SKIP, "other": "done", "write": SKIP, "after": SKIP}
+
+    # A failure stops the tasks that have not started yet:
+    ran = []
+    graph = TaskGraph("test")
+    graph.add("slow", slow(0.05, None))
+    graph.add("raises", lambda: 1 / 0)
+    graph.add("later", lambda *args: ran.append("later"), "slow", "raises")
+    with pytest.raises(ZeroDivisionError):
+        graph.run()
+    assert not ran
+    assert "slow" in graph.timings
@@ -5,12 +5,21 @@
     :license: Apache, see LICENSE for more details.
 .. author:: Mike Grima <mgrima@netflix.com>
 """
+import copy
+import json
+
 import pytest
 
+import bucket_snake.entrypoints
+import bucket_snake.iam.logic
 import bucket_snake.iam.util
+import bucket_snake.request_schemas
 from bucket_snake.config import CONFIG
-from bucket_snake.entrypoints import handler
-from bucket_snake.util.exceptions import SourceRoleDoesNotExistException
+from bucket_snake.entrypoints import handler, prefetch, wait_for_prefetch
+from bucket_snake.iam.util import WRITE_STATS
+from bucket_snake.tests.conf import EXISTING_ASPD
+from bucket_snake.util.exceptions import InvalidRequestException, SourceRoleDoesNotExistException
+from bucket_snake.util.state import REQUEST_HASH_TAG
 
 
 def test_create_successful(s3_role_event, existing_role, sts, config, buckets, mock_lambda_context, iam_client_dict):
@@ -62,3 +71,130 @@ def test_create_successful(s3_role_event, existing_role, sts, config, buckets, m
 def test_without_existing_role(s3_role_event, sts, iam, config, buckets, mock_lambda_context, iam_client_dict):
     with pytest.raises(SourceRoleDoesNotExistException):
         handler(s3_role_event, mock_lambda_context)
+
+
+def test_repeated_request(s3_role_event, existing_role, sts, config, buckets, mock_lambda_context, iam_client_dict,
+                          monkeypatch):
+    bucket_snake.iam.util.IAM_CLIENTS["012345678910"] = existing_role
+    handler(s3_role_event, mock_lambda_context)
+
+    role = existing_role.get_role(RoleName="someAppInstanceProfile")
+    assert [tag["Key"] for tag in role["Role"]["Tags"]] == [REQUEST_HASH_TAG]
+
+    # Record the accounts that the clients and inventories are fetched for:
+    touched = []
+
+    def record(function):
+        def wrapper(account, *args, **kwargs):
+            touched.append(account)
+            return function(account, *args, **kwargs)
+
+        return wrapper
+
+    for module in [bucket_snake.entrypoints, bucket_snake.iam.logic]:
+        monkeypatch.setattr(module, "get_iam_client", record(module.get_iam_client))
+        monkeypatch.setattr(module, "get_account_inventory", record(module.get_account_inventory))
+
+    # The same request again -- nothing is written, and the destination accounts are not touched:
+    s3_role_event["buckets"]["test-bucket-one"].reverse()
+    written, skipped = WRITE_STATS.snapshot()
+    handler(s3_role_event, mock_lambda_context)
+    assert WRITE_STATS.snapshot() == (written, skipped)
+    assert "012345678911" not in touched
+
+    # Unless forced:
+    handler(dict(s3_role_event, force=True), mock_lambda_context)
+    assert WRITE_STATS.skipped > skipped
+    assert "012345678911" in touched
+    assert WRITE_STATS.written == written
+
+    # Or changed:
+    s3_role_event["buckets"]["test-bucket-two"][0]["perms"].append("put")
+    handler(s3_role_event, mock_lambda_context)
+    assert WRITE_STATS.written == written + 1
+
+
+def test_prefetch(s3_role_event, sts, config, buckets, iam_client_dict, monkeypatch):
+    futures = prefetch(s3_role_event)
+    assert sorted(futures) == ["report", "source-012345678910", "swag"]
+
+    wait_for_prefetch(futures)
+    assert futures["report"].result()
+    assert "012345678910" in futures["swag"].result()
+    assert bucket_snake.request_schemas.ACCOUNT_REGISTRY._by_id is not None
+    assert futures["source-012345678910"].result() is bucket_snake.iam.util.IAM_CLIENTS["012345678910"]
+
+    # Every (plausible) source account in a batch:
+    futures = prefetch({"requests": [s3_role_event, dict(s3_role_event, account_number="012345678911"),
+                                     dict(s3_role_event, account_number="not-an-account"), "not a request"]})
+    assert sorted(futures) == ["report", "source-012345678910", "source-012345678911", "swag"]
+    wait_for_prefetch(futures)
+
+    # Failures are left for the steps that need them:
+    def fail(account):
+        raise Exception("Access Denied")
+
+    monkeypatch.setattr(bucket_snake.entrypoints, "get_iam_client", fail)
+    futures = prefetch(dict(s3_role_event, account_number="012345678912"))
+    wait_for_prefetch(futures)
+    with pytest.raises(Exception):
+        futures["source-012345678912"].result()
+
+    assert sorted(prefetch({"requests": "not a list"})) == ["report", "swag"]
+
+
+def test_warm_up(sts, iam, config, buckets, mock_lambda_context, iam_client_dict, monkeypatch):
+    monkeypatch.setattr(CONFIG, "warm_up_accounts", ["012345678911", "012345678912"])
+    written, skipped = WRITE_STATS.snapshot()
+
+    loaded = handler({"warmup": True}, mock_lambda_context)["warmup"]
+    assert loaded == {"report": "loaded", "swag": "loaded", "account-012345678911": "loaded",
+                      "account-012345678912": "loaded"}
+    assert "012345678911" in bucket_snake.iam.util.IAM_CLIENTS
+    assert "012345678912" in bucket_snake.iam.util.IAM_CLIENTS
+    assert bucket_snake.request_schemas.ACCOUNT_REGISTRY._by_id is not None
+
+    # Nothing was written:
+    assert WRITE_STATS.snapshot() == (written, skipped)
+    assert not iam.list_roles()["Roles"]
+
+    # Failures are reported (rather than raised):
+    def get_iam_client(account):
+        raise Exception("Access Denied")
+
+    monkeypatch.setattr(bucket_snake.entrypoints, "get_iam_client", get_iam_client)
+    monkeypatch.setattr(CONFIG, "warm_up_accounts", ["012345678913"])
+    loaded = handler({"warmup": True}, mock_lambda_context)["warmup"]
+    assert loaded["account-012345678913"] == "Access Denied"
+    assert loaded["report"] == "loaded"
+
+
+def test_batch_request(s3_role_event, existing_role, sts, config, buckets, mock_lambda_context, iam_client_dict):
+    bucket_snake.iam.util.IAM_CLIENTS["012345678910"] = existing_role
+    existing_role.create_role(Path="/", RoleName="otherAppInstanceProfile",
+                              AssumeRolePolicyDocument=json.dumps(EXISTING_ASPD))
+
+    other_app = dict(copy.deepcopy(s3_role_event), role_name="otherAppInstanceProfile", app_name="otherApp")
+    missing_bucket = dict(copy.deepcopy(s3_role_event), buckets={"not-a-bucket": [{"prefix": "*", "perms": ["get"]}]})
+    missing_role = dict(copy.deepcopy(s3_role_event), role_name="notARole", app_name="notAnApp")
+
+    event = {"requests": [s3_role_event, missing_bucket, other_app, missing_role, "not a request"]}
+    results = handler(event, mock_lambda_context)["results"]
+
+    assert [result["status"] for result in results] == ["updated", "failed", "updated", "failed", "failed"]
+    assert [result["index"] for result in results] == list(range(5))
+    assert results[1]["error_type"] == "S3BucketDoesNotExistException"
+    assert results[3]["error_type"] == "SourceRoleDoesNotExistException"
+    assert results[3]["role_name"] == "notARole"
+
+    # Both of the good requests got their destination roles:
+    destination = bucket_snake.iam.util.IAM_CLIENTS["012345678911"]
+    for app in ["someApp", "otherApp"]:
+        assert destination.list_role_policies(RoleName="{}-012345678910".format(app))["PolicyNames"] == ["BucketSnake"]
+
+    # Repeated, the good requests are already in place:
+    results = handler(event, mock_lambda_context)["results"]
+    assert [result["status"] for result in results] == ["unchanged", "failed", "unchanged", "failed", "failed"]
+
+    with pytest.raises(InvalidRequestException):
+        handler({"requests": s3_role_event}, mock_lambda_context)
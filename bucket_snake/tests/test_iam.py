@@ -5,14 +5,30 @@
     :license: Apache, see LICENSE for more details.
 .. author:: Mike Grima <mgrima@netflix.com>
 """
+import json
+import time
+from urllib.parse import quote
+
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+import bucket_snake.iam.logic
 import bucket_snake.iam.util
+import bucket_snake.util.ratelimit
 
 from bucket_snake.config import CONFIG
+from bucket_snake.iam.inventory import ACCOUNT_INVENTORIES, get_account_inventory
 from bucket_snake.iam.logic import create_destination_roles, update_instance_profile_s3_permissions, \
-    update_source_assume_role_policy
+    update_source_assume_role_policy, create_destination_roles_by_account
+from bucket_snake.iam.migrate import list_destination_roles, migrate_destination_roles, migrate_role
 from bucket_snake.iam.util import get_client, format_role_arn, get_iam_client, check_for_role, create_iam_role, \
-    update_aspd
+    update_aspd, ExpiringClientCache, canonicalize_policy, make_aspd, WRITE_STATS
+from bucket_snake.util.clients import ClientFactory
 from bucket_snake.s3.permissions import create_s3_role_policies, collect_policies
+from bucket_snake.tests.conf import EXISTING_ASPD
+from bucket_snake.util.exceptions import DestinationRoleException, RetryableException, RoleMigrationException, \
+    ThrottledException, classify_error, is_retryable_error
+from bucket_snake.util.ratelimit import TokenBucket
 
 
 def test_get_client(sts, config):
@@ -21,6 +37,80 @@ def test_get_client(sts, config):
     assert client
 
 
+def test_client_factory(sts, config, monkeypatch):
+    factory = ClientFactory()
+
+    # One STS client per region:
+    assert factory.sts("us-east-1") is factory.sts("us-east-1")
+    assert factory.sts("us-west-2") is not factory.sts("us-east-1")
+
+    # Every client comes off of the same session:
+    session = factory.session
+    factory.client("iam", region="us-east-1")
+    assert factory.session is session
+
+    # The connection settings are applied:
+    monkeypatch.setattr(CONFIG, "max_pool_connections", 25)
+    monkeypatch.setattr(CONFIG, "tcp_keepalive", False)
+    client = factory.client("iam", region="us-east-1", credentials={"AccessKeyId": "a", "SecretAccessKey": "b",
+                                                                    "SessionToken": "c"})
+    assert client.meta.config.max_pool_connections == 25
+    assert client.meta.config.tcp_keepalive is False
+    assert client._request_signer._credentials.access_key == "a"
+
+    sts_client = factory.sts("us-east-1")
+    factory.reset()
+    assert factory.sts("us-east-1") is not sts_client
+    assert factory.session is not session
+
+
+def test_sts_regional_fallback(sts, config, monkeypatch):
+    monkeypatch.setattr(CONFIG, "sts_regions", ["us-west-2", "us-east-1"])
+    factory = ClientFactory()
+    arn = format_role_arn(CONFIG.bucket_snake_role, "012345678910")
+
+    assert factory.sts("eu-west-1").meta.endpoint_url == "https://sts.eu-west-1.amazonaws.com"
+
+    # With another region to fail over to, the STS calls are not retried -- without one, they are:
+    assert ClientFactory.sts_client_options("us-west-2")[1]["retries"] == {"max_attempts": 1}
+    monkeypatch.setattr(CONFIG, "sts_regions", ["us-west-2"])
+    assert "retries" not in ClientFactory.sts_client_options("us-west-2")[1]
+    monkeypatch.setattr(CONFIG, "sts_regions", ["us-west-2", "us-east-1"])
+
+    # The runtime region is used first:
+    assert factory.assume_role(arn, "test")["Credentials"]
+    assert list(factory.sts_stats()) == ["us-west-2"]
+
+    # If it fails, the next region is used -- until the failed one has cooled down:
+    class UnreachableSTS:
+        def assume_role(self, **kwargs):
+            raise EndpointConnectionError(endpoint_url="https://sts.us-west-2.amazonaws.com")
+
+    regional_sts = factory.sts
+    monkeypatch.setattr(factory, "sts", lambda region: UnreachableSTS() if region == "us-west-2"
+                        else regional_sts(region))
+    assert factory.assume_role(arn, "test")["Credentials"]
+
+    stats = factory.sts_stats()
+    assert stats["us-west-2"]["errors"] == 1 and not stats["us-west-2"]["healthy"]
+    assert stats["us-east-1"]["calls"] == 1 and stats["us-east-1"]["healthy"]
+    assert factory.sts_regions() == ["us-east-1", "us-west-2"]
+
+    monkeypatch.setattr(CONFIG, "sts_endpoint_cooldown", 0)
+    assert factory.sts_regions() == ["us-west-2", "us-east-1"]
+
+    # Errors with the request itself are not retried in other regions:
+    class DeniedSTS:
+        def assume_role(self, **kwargs):
+            raise ClientError({"Error": {"Code": "AccessDenied", "Message": "Denied"},
+                               "ResponseMetadata": {"HTTPStatusCode": 403}}, "AssumeRole")
+
+    monkeypatch.setattr(factory, "sts", lambda region: DeniedSTS())
+    with pytest.raises(ClientError):
+        factory.assume_role(arn, "test")
+    assert factory.sts_stats()["us-east-1"]["errors"] == 0
+
+
 def test_get_iam_client(sts, config, iam_client_dict):
     client = get_iam_client("012345678910")
 
@@ -32,6 +122,35 @@ def test_get_iam_client(sts, config, iam_client_dict):
     assert len(bucket_snake.iam.util.IAM_CLIENTS) == 1
 
 
+def test_iam_client_expiration(sts, config, iam_client_dict, monkeypatch):
+    client = get_iam_client("012345678910")
+    assert get_iam_client("012345678910") is client
+
+    # Close to expiring -- so the role is assumed again:
+    monkeypatch.setattr(CONFIG, "credential_refresh_margin", 60 * 60 * 24)
+    new_client = get_iam_client("012345678910")
+    assert new_client is not client
+    assert len(bucket_snake.iam.util.IAM_CLIENTS) == 1
+
+    # Least recently used clients are evicted:
+    monkeypatch.setattr(CONFIG, "credential_refresh_margin", 300)
+    monkeypatch.setattr(CONFIG, "client_cache_size", 2)
+    cache = ExpiringClientCache()
+    cache.put("one", "client-one", time.time() + 3600)
+    cache.put("two", "client-two")
+    assert cache["one"] == "client-one"
+    cache.put("three", "client-three")
+    assert "two" not in cache
+    assert cache.get("one") == "client-one"
+    assert len(cache) == 2
+
+    # Expired clients are dropped:
+    cache.put("four", "client-four", time.time() + 60)
+    assert not cache.get("four")
+    with pytest.raises(KeyError):
+        cache["four"]
+
+
 def test_check_for_role(iam, existing_role):
     assert check_for_role("someAppInstanceProfile", iam)
     assert not check_for_role("Idontexist", iam)
@@ -74,6 +193,294 @@ def test_create_destination_roles(iam, sts, config, buckets_cross_account_mappin
     assert len(policies["PolicyDocument"]["Statement"]) == 2
 
 
+def test_create_destination_roles_isolates_failures(iam, sts, config, buckets_cross_account_mapping,
+                                                    iam_client_dict, monkeypatch):
+    role_policies = create_s3_role_policies(collect_policies(buckets_cross_account_mapping))
+    role_policies["012345678912"] = role_policies["012345678911"]
+    role_policies["012345678913"] = role_policies["012345678911"]
+
+    def get_iam_client(account):
+        if account == "012345678912":
+            raise Exception("Access Denied")
+
+        return bucket_snake.iam.util.get_iam_client(account)
+
+    monkeypatch.setattr(bucket_snake.iam.logic, "get_iam_client", get_iam_client)
+
+    with pytest.raises(DestinationRoleException) as exc:
+        create_destination_roles(role_policies, "someApp", "someAppInstanceProfile", "012345678910")
+
+    # The other accounts were still updated:
+    assert list(exc.value.errors) == ["012345678912"]
+    assert exc.value.updated == ["012345678911", "012345678913"]
+    assert "012345678912: Access Denied" in str(exc.value)
+    assert iam.get_role(RoleName="someApp-012345678910")
+
+    # Nothing to do:
+    assert create_destination_roles({}, "someApp", "someAppInstanceProfile", "012345678910") == []
+
+
+def throttle(client, calls, code="Throttling", status=400):
+    """Makes the client's next `calls` IAM calls fail with the error (without sending them)."""
+    from botocore.awsrequest import AWSResponse
+
+    class Raw:
+        def stream(self, **kwargs):
+            yield "<ErrorResponse><Error><Type>Sender</Type><Code>{}</Code><Message>Rate exceeded</Message></Error>" \
+                  "</ErrorResponse>".format(code).encode("utf-8")
+
+    sent = []
+
+    def before_send(request, **kwargs):
+        sent.append(request)
+        if len(sent) <= calls:
+            return AWSResponse(request.url, status, {}, Raw())
+
+    client.meta.events.register_first("before-send.iam", before_send)
+
+    return sent
+
+
+def test_iam_rate_limiter(iam, sts, config, iam_client_dict, monkeypatch):
+    monkeypatch.setattr(bucket_snake.util.ratelimit, "backoff", lambda attempt: 0)
+
+    # Tokens are handed out at the rate, which halves when throttled and then recovers:
+    bucket = TokenBucket(2)
+    bucket.acquire()
+    bucket.acquire()
+    bucket.throttled()
+    assert bucket.rate == 1
+    started = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - started >= 0.5
+    for _ in range(20):
+        bucket.succeeded()
+    assert bucket.rate == 2
+    assert bucket.throttles == 1
+
+    # Throttled calls are backed off and retried -- and lower the rate for the account (and overall):
+    client = get_iam_client("012345678911")
+    sent = throttle(client, 2)
+    assert client.list_roles()["Roles"] == []
+    assert len(sent) == 3
+
+    stats = bucket_snake.iam.util.IAM_RATE_LIMITER.stats()
+    assert stats["accounts"]["012345678911"]["throttles"] == 2
+    assert stats["accounts"]["012345678911"]["rate"] < CONFIG.iam_rate_limit
+    assert stats["global"]["throttles"] == 2
+
+    # Until the retries run out:
+    monkeypatch.setattr(CONFIG, "iam_max_retries", 1)
+    client = get_iam_client("012345678912")
+    sent = throttle(client, 5)
+    with pytest.raises(ClientError) as exc:
+        client.list_roles()
+    assert len(sent) == 2
+    assert isinstance(classify_error(exc.value), ThrottledException)
+
+    # Errors that would happen again are not retried:
+    client = get_iam_client("012345678913")
+    sent = throttle(client, 5, code="AccessDenied", status=403)
+    with pytest.raises(ClientError) as exc:
+        client.list_roles()
+    assert len(sent) == 1
+    assert classify_error(exc.value) is exc.value
+    assert not is_retryable_error(exc.value)
+
+    # Neither are AWS side errors:
+    assert isinstance(classify_error(ClientError({"Error": {"Code": "ServiceFailure"}}, "GetRole")),
+                      RetryableException)
+    assert is_retryable_error(EndpointConnectionError(endpoint_url="https://iam.amazonaws.com"))
+
+    # A destination role failure can be retried later only if every account's can be:
+    throttled = ThrottledException(exc.value)
+    assert DestinationRoleException({"012345678911": throttled}, []).retryable
+    assert not DestinationRoleException({"012345678911": throttled, "012345678912": exc.value}, []).retryable
+
+
+def test_canonicalize_policy():
+    policy = {
+        "Statement": [
+            {"Sid": "Get", "Effect": "Allow", "Action": ["s3:GetObject", "s3:GetObjectAcl"],
+             "Resource": ["arn:aws:s3:::b/*", "arn:aws:s3:::a/*"]},
+            {"Sid": "List", "Effect": "Allow", "Action": "s3:ListBucket", "Resource": "arn:aws:s3:::a"}
+        ]
+    }
+    same = {
+        "Statement": [
+            {"Resource": ["arn:aws:s3:::a"], "Action": ["s3:ListBucket"], "Effect": "Allow", "Sid": "List"},
+            {"Sid": "Get", "Effect": "Allow", "Action": ["s3:GetObjectAcl", "s3:GetObject"],
+             "Resource": ["arn:aws:s3:::a/*", "arn:aws:s3:::b/*"]}
+        ]
+    }
+
+    assert canonicalize_policy(policy) == canonicalize_policy(same)
+    assert canonicalize_policy(policy) == canonicalize_policy(quote(json.dumps(same)))
+    assert canonicalize_policy(policy) == canonicalize_policy(json.dumps(same, indent=4))
+
+    same["Statement"][0]["Resource"].append("arn:aws:s3:::c")
+    assert canonicalize_policy(policy) != canonicalize_policy(same)
+
+
+def test_create_destination_roles_skips_unchanged(iam, sts, config, buckets_cross_account_mapping, iam_client_dict):
+    role_policies = create_s3_role_policies(collect_policies(buckets_cross_account_mapping))
+    create_destination_roles(role_policies, "someApp", "someAppInstanceProfile", "012345678910")
+
+    # Running it again doesn't write anything:
+    written, skipped = WRITE_STATS.snapshot()
+    create_destination_roles(role_policies, "someApp", "someAppInstanceProfile", "012345678910")
+    assert WRITE_STATS.written == written
+    assert WRITE_STATS.skipped == skipped + 2
+
+    # But changes are written:
+    role_policies["012345678911"]["Statement"][0]["Resource"].append("arn:aws:s3:::test-bucket-five")
+    assert not update_aspd(iam, "someApp-012345678910", format_role_arn("someAppInstanceProfile", "012345678910"),
+                           existing_role=iam.get_role(RoleName="someApp-012345678910"))
+    create_destination_roles(role_policies, "someApp", "someAppInstanceProfile", "012345678910")
+    assert WRITE_STATS.written == written + 1
+
+    policy = iam.get_role_policy(RoleName="someApp-012345678910", PolicyName=CONFIG.bucket_snake_policy_name)
+    assert "arn:aws:s3:::test-bucket-five" in json.dumps(policy["PolicyDocument"])
+
+
+def test_account_inventory(iam, sts, config, buckets_cross_account_mapping, iam_client_dict, monkeypatch, tmpdir):
+    calls = []
+    iam.meta.events.register("before-call.iam.*", lambda model, **kwargs: calls.append(model.name))
+    bucket_snake.iam.util.IAM_CLIENTS["012345678911"] = iam
+
+    # One role already exists (with the policy), and the other is new:
+    role_policies = create_s3_role_policies(collect_policies(buckets_cross_account_mapping))
+    create_destination_roles(role_policies, "someApp", "someAppInstanceProfile", "012345678910")
+
+    monkeypatch.setattr(CONFIG, "account_inventory", True)
+    monkeypatch.setattr(CONFIG, "account_inventory_cache_dir", str(tmpdir))
+    calls.clear()
+
+    roles = create_destination_roles_by_account({"012345678911": [
+        (app, role_policies["012345678911"], app, "someAppInstanceProfile", "012345678910")
+        for app in ["someApp", "otherApp"]
+    ]})
+    assert not roles
+
+    # The account is swept once -- and nothing is looked up role by role:
+    assert calls == ["GetAccountAuthorizationDetails", "CreateRole", "PutRolePolicy"]
+    assert iam.get_role_policy(RoleName="otherApp-012345678910", PolicyName=CONFIG.bucket_snake_policy_name)
+
+    # The snapshot kept up with the writes (and was saved to disk) -- so doing it again makes no calls at all:
+    ACCOUNT_INVENTORIES.clear()
+    calls.clear()
+    written, skipped = WRITE_STATS.snapshot()
+    create_destination_roles(role_policies, "otherApp", "someAppInstanceProfile", "012345678910")
+    assert not calls
+    assert WRITE_STATS.snapshot() == (written, skipped + 2)
+
+    inventory = get_account_inventory("012345678911")
+    assert check_for_role("otherApp-012345678910", iam, inventory=inventory)["Role"]["RoleName"] == \
+        "otherApp-012345678910"
+    assert not check_for_role("notARole", iam, inventory=inventory)
+
+    # A role made after the sweep is picked up when creating it fails:
+    iam.create_role(RoleName="lateApp-012345678910", AssumeRolePolicyDocument=json.dumps({"Statement": []}))
+    create_destination_roles(role_policies, "lateApp", "someAppInstanceProfile", "012345678910")
+    assert iam.get_role(RoleName="lateApp-012345678910")["Role"]["AssumeRolePolicyDocument"]["Statement"]
+
+    # Without the inventory, the role is looked up directly:
+    monkeypatch.setattr(CONFIG, "account_inventory", False)
+    calls.clear()
+    create_destination_roles(role_policies, "otherApp", "someAppInstanceProfile", "012345678910")
+    assert calls == ["GetRole", "GetRolePolicy"]
+
+
+def test_destination_role_path(iam, sts, config, existing_role, buckets_cross_account_mapping, iam_client_dict,
+                               monkeypatch):
+    bucket_snake.iam.util.IAM_CLIENTS["012345678911"] = iam
+    role_policies = create_s3_role_policies(collect_policies(buckets_cross_account_mapping))
+
+    # Roles made before the path was set are at `/`:
+    create_destination_roles(role_policies, "someApp", "someAppInstanceProfile", "012345678910")
+    iam.tag_role(RoleName="someApp-012345678910", Tags=[{"Key": "owner", "Value": "someApp"}])
+    iam.create_role(RoleName="notBucketSnake-012345678910", AssumeRolePolicyDocument=json.dumps(EXISTING_ASPD))
+
+    monkeypatch.setattr(CONFIG, "destination_role_path", "bucketsnake")
+    assert CONFIG.destination_role_path == "/bucketsnake/"
+
+    # New roles are made under the path:
+    create_destination_roles(role_policies, "otherApp", "someAppInstanceProfile", "012345678910")
+    assert iam.get_role(RoleName="otherApp-012345678910")["Role"]["Path"] == "/bucketsnake/"
+    assert [role["RoleName"] for role in list_destination_roles(iam)] == ["otherApp-012345678910"]
+
+    # The source role may assume the role at either path, while it is moved:
+    update_source_assume_role_policy(role_policies, "someApp", "someAppInstanceProfile", "012345678910")
+    policy = iam.get_role_policy(RoleName="someAppInstanceProfile", PolicyName=CONFIG.sts_policy_name)
+    assert sorted(policy["PolicyDocument"]["Statement"][0]["Resource"]) == [
+        "arn:aws:iam::012345678911:role/bucketsnake/someApp-012345678910",
+        "arn:aws:iam::012345678911:role/someApp-012345678910"
+    ]
+
+    # Source roles whose requests were applied before the path was set may only assume the role at `/`:
+    bucket_snake.iam.util.IAM_CLIENTS["012345678910"] = existing_role
+    old_arn = "arn:aws:iam::012345678911:role/someApp-012345678910"
+    iam.put_role_policy(RoleName="someAppInstanceProfile", PolicyName=CONFIG.sts_policy_name,
+                        PolicyDocument=json.dumps({"Statement": [{"Effect": "Allow", "Action": "sts:AssumeRole",
+                                                                  "Resource": old_arn}]}))
+
+    # Move the old role:
+    assert migrate_destination_roles("012345678911", dry_run=True) == ["someApp-012345678910"]
+    assert iam.get_role(RoleName="someApp-012345678910")["Role"]["Path"] == "/"
+
+    before = iam.get_role_policy(RoleName="someApp-012345678910", PolicyName=CONFIG.bucket_snake_policy_name)
+    assert migrate_destination_roles("012345678911") == ["someApp-012345678910"]
+
+    # The source role may now assume it at its new ARN:
+    policy = iam.get_role_policy(RoleName="someAppInstanceProfile", PolicyName=CONFIG.sts_policy_name)
+    assert sorted(policy["PolicyDocument"]["Statement"][0]["Resource"]) == [
+        "arn:aws:iam::012345678911:role/bucketsnake/someApp-012345678910", old_arn
+    ]
+
+    role = iam.get_role(RoleName="someApp-012345678910")["Role"]
+    assert role["Path"] == "/bucketsnake/"
+    assert canonicalize_policy(role["AssumeRolePolicyDocument"]) == \
+        canonicalize_policy(make_aspd(format_role_arn("someAppInstanceProfile", "012345678910")))
+    assert canonicalize_policy(iam.get_role_policy(RoleName="someApp-012345678910",
+                                                   PolicyName=CONFIG.bucket_snake_policy_name)["PolicyDocument"]) \
+        == canonicalize_policy(before["PolicyDocument"])
+    assert iam.list_role_tags(RoleName="someApp-012345678910")["Tags"] == [{"Key": "owner", "Value": "someApp"}]
+
+    # Other roles are left alone:
+    assert iam.get_role(RoleName="notBucketSnake-012345678910")["Role"]["Path"] == "/"
+    assert sorted(role["RoleName"] for role in list_destination_roles(iam)) == \
+        ["otherApp-012345678910", "someApp-012345678910"]
+    assert not migrate_destination_roles("012345678911")
+
+
+def test_migrate_role_rollback(iam, sts, config, existing_role, iam_client_dict, caplog):
+    bucket_snake.iam.util.IAM_CLIENTS["012345678910"] = existing_role
+    create_iam_role(iam, "someApp-012345678910", format_role_arn("someAppInstanceProfile", "012345678910"), "Test")
+    iam.put_role_policy(RoleName="someApp-012345678910", PolicyName=CONFIG.bucket_snake_policy_name,
+                        PolicyDocument=json.dumps({"Statement": [{"Effect": "Allow", "Action": "s3:GetObject",
+                                                                  "Resource": "arn:aws:s3:::test-bucket-one/*"}]}))
+
+    class FailingCreates:
+        """The role can be deleted -- but not re-created, or put back."""
+        def __init__(self, client):
+            self.client = client
+
+        def create_role(self, **kwargs):
+            raise ClientError({"Error": {"Code": "LimitExceeded", "Message": "Too many roles"}}, "CreateRole")
+
+        def __getattr__(self, name):
+            return getattr(self.client, name)
+
+    role = iam.get_role(RoleName="someApp-012345678910")["Role"]
+    with pytest.raises(RoleMigrationException) as exc_info:
+        migrate_role(FailingCreates(iam), role, "/bucketsnake/", account="012345678911")
+
+    # The role is gone -- but its details were logged before it was deleted:
+    assert not check_for_role("someApp-012345678910", iam)
+    assert "test-bucket-one" in str(exc_info.value)
+    assert "arn:aws:s3:::test-bucket-one/*" in caplog.text
+
+
 def test_update_instance_profile_s3_permissions(iam, sts, existing_role, buckets_same_account_mapping, config):
     role_policies = create_s3_role_policies(collect_policies(buckets_same_account_mapping))
 
@@ -0,0 +1,56 @@
+"""
+.. module: bucket_snake.tests.test_imports
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+"""
+import os
+
+import bucket_snake
+from bucket_snake.util.imports import DEFERRED_IMPORTS, import_times, lazy_decorator
+
+# The most milliseconds that Bucket Snake's own modules may take to import (excluding their dependencies):
+IMPORT_BUDGET_MS = 150
+
+
+# The functions that `adding` has decorated:
+DECORATED = []
+
+
+def adding(amount):
+    """Decorator that adds `amount` to the result of the function."""
+    def decorator(function):
+        DECORATED.append(function)
+        return lambda *args, **kwargs: function(*args, **kwargs) + amount
+
+    return decorator
+
+
+def test_lazy_decorator():
+    @lazy_decorator("bucket_snake.tests.test_imports", "adding", 10)
+    def add(a, b):
+        """Adds."""
+        return a + b
+
+    # Not decorated until it is called:
+    assert not DECORATED
+    assert add.__doc__ == "Adds."
+
+    assert add(1, 2) == 13
+    assert add(2, 3) == 15
+    assert DECORATED == [add.__wrapped__]
+
+
+def test_entrypoints_import_budget(monkeypatch):
+    # Make sure the fresh interpreter imports this copy of Bucket Snake:
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(bucket_snake.__file__)))
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join(filter(None, [package_root, os.environ.get("PYTHONPATH")])))
+
+    times = import_times("bucket_snake.entrypoints")
+
+    deferred = sorted(name for name in times if name.split(".")[0] in DEFERRED_IMPORTS)
+    assert not deferred
+
+    own_time = sum(self_time for name, (self_time, _) in times.items() if name.split(".")[0] == "bucket_snake")
+    assert own_time / 1000 < IMPORT_BUDGET_MS
@@ -10,7 +10,11 @@ import json
 import pytest
 from marshmallow import ValidationError
 
+from bucket_snake.config import CONFIG
 from bucket_snake.request_schemas import bucket_permission, incoming_request
+from bucket_snake.tests.conf import SWAG_BUCKET
+from bucket_snake.tests.conftest import get_json
+from bucket_snake.util.accounts import AccountRegistry
 from bucket_snake.util.exceptions import BlacklistedAccountException, S3BucketDoesNotExistException
 
 BP_ONE = {
@@ -199,3 +203,31 @@ def test_incoming_request_schema(bucket_table):
 
     with pytest.raises(S3BucketDoesNotExistException):
         incoming_request.loads(nonexisting_bucket)
+
+
+def test_account_registry(config, buckets, s3, monkeypatch):
+    registry = AccountRegistry()
+
+    assert "012345678910" in registry
+    assert "012345678911" not in registry
+    assert registry.get("012345678910")["name"] == "myaccount"
+    assert registry.get_by_name("myaccount")["id"] == "012345678910"
+    assert registry.is_blacklisted_source("666666666666")
+    assert not registry.is_blacklisted_source("012345678910")
+    assert registry.is_blacklisted_bucket_account("989898989898")
+
+    # Within the revalidation interval, changes aren't seen:
+    accounts = json.loads(get_json("accounts.json"))
+    accounts.append(dict(accounts[0], id="012345678911", name="myotheraccount"))
+    s3.put_object(Bucket=SWAG_BUCKET, Key="accounts.json", Body=json.dumps(accounts))
+    assert "012345678911" not in registry
+
+    # After it, they are:
+    monkeypatch.setattr(CONFIG, "swag_revalidate_interval", 0)
+    assert "012345678911" in registry
+    assert registry.get_by_name("myotheraccount")["id"] == "012345678911"
+    assert len(registry) == 2
+
+    # And if the SWAG data can't be revalidated, the loaded accounts are kept:
+    s3.delete_object(Bucket=SWAG_BUCKET, Key="accounts.json")
+    assert "012345678911" in registry
@@ -5,6 +5,31 @@
     :license: Apache, see LICENSE for more details.
 .. author:: Mike Grima <mgrima@netflix.com>
 """
+import gzip
+import io
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+import bucket_snake.request_schemas
+import bucket_snake.s3.models
+from bucket_snake.config import CONFIG
+from bucket_snake.s3.models import load_bucket_table, BucketTable, REPORT_READ_SIZE
+from bucket_snake.s3.download import (
+    get_object_stream, RangedObjectReader, DecompressedStream, decompress_stream, get_compression
+)
+from bucket_snake.request_schemas import incoming_request
+from bucket_snake.s3.index import compile_bucket_index, compile_sharded_index, main as compile_index_main
+from bucket_snake.s3.resolvers import BucketResolver, ResolvedBucketCache
+from bucket_snake.s3.shards import ShardedBucketTable, shard_for_bucket
+from bucket_snake.s3.tables import CompactBucketTable, MappedBucketTable, write_bucket_index, write_atomically
 from bucket_snake.s3.permissions import (
     check_if_cross_account,
     build_bucket_account_mapping,
@@ -13,6 +38,21 @@ from bucket_snake.s3.permissions import (
     create_s3_role_policies,
     S3_PERMISSIONS
 )
+from bucket_snake.tests.conf import HISTORICAL_REPORT_BUCKET
+from bucket_snake.tests.conftest import get_json
+from bucket_snake.util.exceptions import InvalidS3ReportException, InvalidBucketIndexException, \
+    BucketLookupException
+
+
+class ChunkRecordingStream:
+    """File-like object (like the S3 StreamingBody) that records the size of every read made against it."""
+    def __init__(self, data):
+        self._data = io.BytesIO(data)
+        self.reads = []
+
+    def read(self, size=-1):
+        self.reads.append(size)
+        return self._data.read(size)
 
 
 def test_check_if_cross_account(bucket_table):
@@ -127,3 +167,506 @@ def test_create_access_to_reports(buckets_same_account_mapping, config):
     assert role_policies["012345678910"]["Statement"][0]["Action"] == "s3:GetObject"
     assert role_policies["012345678910"]["Statement"][0]["Resource"] == \
         ["arn:aws:s3:::historical-reports/historical-s3-report.json"]
+
+
+def test_load_bucket_table():
+    stream = ChunkRecordingStream(get_json("historical-s3-report.json").encode("utf-8"))
+    table = load_bucket_table(stream)
+
+    assert table == {
+        "test-bucket-one": "012345678910",
+        "test-bucket-two": "012345678910",
+        "test-bucket-three": "012345678911",
+        "test-bucket-four": "012345678911",
+        "blacklisted-bucket-one": "666666666666",
+        "blacklisted-bucket-two": "000000000000"
+    }
+
+
+def test_load_bucket_table_streams():
+    report = {
+        "buckets": {
+            "bucket-{}".format(i): {"AccountId": str(i % 7).zfill(12), "Details": "x" * 100} for i in range(2000)
+        }
+    }
+    stream = ChunkRecordingStream(json.dumps(report).encode("utf-8"))
+    table = load_bucket_table(stream)
+
+    assert len(table) == 2000
+    assert table["bucket-1337"] == "000000000000"
+
+    # The report was read in bounded chunks -- never all at once:
+    assert len(stream.reads) > 1
+    assert all(0 <= size <= REPORT_READ_SIZE for size in stream.reads)
+
+
+def test_load_bucket_table_skips_bucket_details():
+    report = {
+        "generated_date": "2017-11-22T23:17:30Z",
+        "buckets": {
+            "some.dotted.bucket": {
+                "Region": "us-east-1",
+                "Policy": {"Statement": [{"AccountId": "not-this-one"}]},
+                "Tags": {"AccountId": "nor-this-one"},
+                "AccountId": "012345678910"
+            },
+            "some-other-bucket": {
+                "AccountId": "012345678911",
+                "Grants": [["AccountId", "nope"]]
+            }
+        },
+        "AccountId": "not-a-bucket"
+    }
+    stream = ChunkRecordingStream(json.dumps(report).encode("utf-8"))
+
+    assert load_bucket_table(stream) == {
+        "some.dotted.bucket": "012345678910",
+        "some-other-bucket": "012345678911"
+    }
+
+    with pytest.raises(InvalidS3ReportException):
+        load_bucket_table(io.BytesIO(b'{"s3_report_version": 1}'))
+
+    with pytest.raises(InvalidS3ReportException):
+        load_bucket_table(io.BytesIO(b'{"buckets": []}'))
+
+
+def test_bucket_table_local_cache(config, s3, buckets):
+    table = BucketTable()
+    assert table.buckets["test-bucket-one"] == "012345678910"
+    assert os.path.exists(BucketTable.cache_path())
+    assert isinstance(table.buckets, MappedBucketTable)
+
+    # A new table (i.e. a new process) loads it from the local cache without needing S3:
+    s3.delete_object(Bucket=HISTORICAL_REPORT_BUCKET, Key="historical-s3-report.json")
+    table = BucketTable()
+    assert len(table.buckets) == 6
+    assert table.buckets["test-bucket-three"] == "012345678911"
+
+
+def test_bucket_table_revalidation(config, monkeypatch):
+    client = boto3.client("s3", region_name="us-west-2")
+    stubber = Stubber(client)
+    monkeypatch.setattr(bucket_snake.s3.models, "get_reports_client", lambda: client)
+    monkeypatch.setattr(CONFIG, "report_download_concurrency", 1)
+
+    def report_response(report, etag, last_modified):
+        body = json.dumps(report).encode("utf-8")
+        return {"Body": StreamingBody(io.BytesIO(body), len(body)), "ETag": etag, "LastModified": last_modified}
+
+    first_modified = datetime(2017, 11, 22, 23, 17, 30, tzinfo=timezone.utc)
+    second_modified = datetime(2017, 11, 23, 23, 17, 30, tzinfo=timezone.utc)
+    key = {"Bucket": HISTORICAL_REPORT_BUCKET, "Key": CONFIG.reports_prefix}
+
+    stubber.add_response("get_object", report_response({"buckets": {"one": {"AccountId": "012345678910"}}},
+                                                       '"etag-one"', first_modified), key)
+    stubber.add_client_error("get_object", service_error_code="304", http_status_code=304,
+                             expected_params=dict(IfNoneMatch='"etag-one"', IfModifiedSince=first_modified, **key))
+    stubber.add_response("get_object", report_response({"buckets": {"two": {"AccountId": "012345678911"}}},
+                                                       '"etag-two"', second_modified),
+                         dict(IfNoneMatch='"etag-one"', IfModifiedSince=first_modified, **key))
+
+    with stubber:
+        table = BucketTable()
+        first_table = table.buckets
+        assert first_table == {"one": "012345678910"}
+
+        # Within the revalidation interval -- no requests are made:
+        assert table.buckets is first_table
+
+        # Not modified -- the same table is kept:
+        monkeypatch.setattr(CONFIG, "report_revalidate_interval", 0)
+        assert table.buckets is first_table
+
+        # Modified -- the new table is swapped in, and is also what is in the local cache:
+        assert table.buckets == {"two": "012345678911"}
+        stubber.assert_no_pending_responses()
+
+    monkeypatch.setattr(CONFIG, "report_revalidate_interval", 300)
+    cached_table = BucketTable()
+    assert cached_table.buckets == {"two": "012345678911"}
+
+
+def test_bucket_table_revalidation_failure(config, monkeypatch):
+    client = boto3.client("s3", region_name="us-west-2")
+    stubber = Stubber(client)
+    monkeypatch.setattr(bucket_snake.s3.models, "get_reports_client", lambda: client)
+    monkeypatch.setattr(CONFIG, "report_download_concurrency", 1)
+
+    body = json.dumps({"buckets": {"one": {"AccountId": "012345678910"}}}).encode("utf-8")
+    stubber.add_response("get_object", {"Body": StreamingBody(io.BytesIO(body), len(body)), "ETag": '"etag-one"'})
+    stubber.add_client_error("get_object", service_error_code="InternalError", http_status_code=500)
+
+    with stubber:
+        table = BucketTable()
+        first_table = table.buckets
+
+        # The report could not be revalidated -- the loaded table is kept, and checked again a little later:
+        table._last_checked = 0
+        assert table.buckets is first_table
+        assert not table.is_stale()
+        assert time.time() - table._last_checked >= \
+            CONFIG.report_revalidate_interval - bucket_snake.s3.models.REPORT_RETRY_INTERVAL - 1
+        stubber.assert_no_pending_responses()
+
+    # Without a table to fall back on, the error is raised:
+    monkeypatch.setattr(bucket_snake.s3.models.BucketTable, "_BucketTable__fetch_report_with_retries",
+                        staticmethod(lambda etag, last_modified: BucketTable._BucketTable__fetch_report()))
+    monkeypatch.setattr(CONFIG, "report_cache_dir", None)
+    stubber.add_client_error("get_object", service_error_code="InternalError", http_status_code=500)
+    with stubber:
+        with pytest.raises(ClientError):
+            BucketTable().buckets
+
+
+def test_compact_bucket_table():
+    mapping = {
+        "test-bucket-one": "012345678910",
+        "test-bucket-two": "012345678910",
+        "test-bucket-three": "012345678911",
+        "some.dotted.bucket": "012345678911",
+        "a": "000000000000",
+        "zzzz": "012345678910"
+    }
+    table = CompactBucketTable.from_items(mapping.items())
+
+    assert len(table) == len(mapping)
+    assert table == mapping
+    assert sorted(table.accounts) == ["000000000000", "012345678910", "012345678911"]
+
+    for name, account in mapping.items():
+        assert table[name] == account
+        assert table.get(name) == account
+        assert name in table
+
+    # Names come back out in sorted order:
+    assert list(table) == sorted(mapping)
+
+    for missing in ["", "test-bucket", "test-bucket-one-", "0", "zzzzz", None, 12]:
+        assert missing not in table
+        assert not table.get(missing)
+
+        with pytest.raises(KeyError):
+            _ = table[missing]
+
+    empty = CompactBucketTable.from_items([])
+    assert len(empty) == 0
+    assert not empty.get("test-bucket-one")
+
+
+def test_mapped_bucket_table(tmpdir):
+    mapping = {"bucket-{}".format(i): str(i % 3).zfill(12) for i in range(1000)}
+    mapping["some.dotted.bucket"] = "012345678910"
+    path = str(tmpdir.join("buckets.idx"))
+
+    write_bucket_index(CompactBucketTable.from_items(mapping.items()), path, metadata={"etag": '"some-etag"'})
+    table = MappedBucketTable.open(path)
+
+    assert table.metadata == {"etag": '"some-etag"'}
+    assert len(table) == len(mapping)
+    assert table == mapping
+    assert table.get("bucket-999") == "000000000000"
+    assert not table.get("bucket-1000")
+    assert "some.dotted.bucket" in table
+
+    # Empty tables:
+    write_bucket_index(CompactBucketTable.from_items([]), path)
+    table = MappedBucketTable.open(path)
+    assert len(table) == 0
+    assert not table.get("bucket-1")
+
+    # Not an index:
+    with open(path, "wb") as bad_index:
+        bad_index.write(b"{}")
+
+    with pytest.raises(InvalidBucketIndexException):
+        MappedBucketTable.open(path)
+
+    with open(path, "wb") as bad_index:
+        bad_index.write(b"x" * 1024)
+
+    with pytest.raises(InvalidBucketIndexException):
+        MappedBucketTable.open(path)
+
+    # Truncated:
+    write_bucket_index(CompactBucketTable.from_items(mapping.items()), path)
+    with open(path, "r+b") as index_file:
+        index_file.truncate(os.path.getsize(path) - 1)
+
+    with pytest.raises(InvalidBucketIndexException):
+        MappedBucketTable.open(path)
+
+
+def test_compile_bucket_index(tmpdir, config, s3, buckets, monkeypatch):
+    path = str(tmpdir.join("compiled.idx"))
+    report = io.BytesIO(get_json("historical-s3-report.json").encode("utf-8"))
+    compiled = compile_bucket_index(report, path)
+
+    table = MappedBucketTable.open(path)
+    assert table == compiled
+    assert table["test-bucket-three"] == "012345678911"
+
+    # Via the command line, from S3:
+    compile_index_main(["s3://{}/historical-s3-report.json".format(HISTORICAL_REPORT_BUCKET), path,
+                        "--region", "us-west-2"])
+    table = MappedBucketTable.open(path)
+    assert len(table) == 6
+    assert table.metadata["source"] == "s3://{}/historical-s3-report.json".format(HISTORICAL_REPORT_BUCKET)
+    assert table.metadata["etag"]
+
+    # The bucket table will use the bundled index instead of fetching the report:
+    s3.delete_object(Bucket=HISTORICAL_REPORT_BUCKET, Key="historical-s3-report.json")
+    monkeypatch.setattr(CONFIG, "bucket_index_path", path)
+    bucket_table = BucketTable()
+    assert isinstance(bucket_table.buckets, MappedBucketTable)
+    assert bucket_table.buckets["test-bucket-one"] == "012345678910"
+
+
+def test_sharded_bucket_table(tmpdir, config, s3, buckets, monkeypatch):
+    output = tmpdir.mkdir("sharded")
+    report = io.BytesIO(get_json("historical-s3-report.json").encode("utf-8"))
+    manifest = compile_sharded_index(report, str(output), 4, generation="20171122231730")
+
+    assert manifest["shard_count"] == 4
+    assert manifest["bucket_count"] == 6
+    assert manifest["shards"][0] == "20171122231730/shard-00000.idx"
+
+    # Upload the shards (and then the manifest):
+    for key in manifest["shards"] + ["manifest.json"]:
+        with open(os.path.join(str(output), *key.split("/")), "rb") as shard:
+            s3.put_object(Bucket=HISTORICAL_REPORT_BUCKET, Key="sharded/" + key, Body=shard.read())
+
+    monkeypatch.setattr(CONFIG, "reports_shard_manifest", "sharded/manifest.json")
+    table = BucketTable()
+
+    # Only the manifest is fetched up front:
+    buckets = table.buckets
+    assert isinstance(buckets, ShardedBucketTable)
+    assert len(buckets) == 6
+    assert not buckets.fetched_shards
+
+    # Only the shards for the requested buckets are fetched:
+    requested = ["test-bucket-one", "test-bucket-three"]
+    table.prefetch(requested)
+    assert buckets.fetched_shards == sorted({shard_for_bucket(name, 4) for name in requested})
+    assert buckets["test-bucket-one"] == "012345678910"
+    assert buckets.get("test-bucket-three") == "012345678911"
+
+    # And all of them for everything else:
+    assert buckets.get("not-a-bucket") is None
+    assert dict(buckets.items()) == {
+        "test-bucket-one": "012345678910",
+        "test-bucket-two": "012345678910",
+        "test-bucket-three": "012345678911",
+        "test-bucket-four": "012345678911",
+        "blacklisted-bucket-one": "666666666666",
+        "blacklisted-bucket-two": "000000000000"
+    }
+    assert buckets.fetched_shards == [0, 1, 2, 3]
+
+    # Shards are cached locally, so a new table doesn't need to fetch them from S3:
+    for key in manifest["shards"]:
+        s3.delete_object(Bucket=HISTORICAL_REPORT_BUCKET, Key="sharded/" + key)
+
+    table = BucketTable()
+    table.prefetch(requested)
+    assert table.buckets["test-bucket-three"] == "012345678911"
+
+    # A new generation of shards -- the old ones are removed from the local cache:
+    old_paths = [BucketTable.cache_path("sharded/" + key) for key in manifest["shards"]]
+    assert all(os.path.exists(path) for path in old_paths)
+
+    report = io.BytesIO(get_json("historical-s3-report.json").encode("utf-8"))
+    new_manifest = compile_sharded_index(report, str(output), 4, generation="20171123231730")
+    for key in new_manifest["shards"] + ["manifest.json"]:
+        with open(os.path.join(str(output), *key.split("/")), "rb") as shard:
+            s3.put_object(Bucket=HISTORICAL_REPORT_BUCKET, Key="sharded/" + key, Body=shard.read())
+
+    table._last_checked = 0
+    assert table.buckets.manifest["shards"][0] == "sharded/20171123231730/shard-00000.idx"
+    assert not any(os.path.exists(path) for path in old_paths)
+    assert table.buckets["test-bucket-three"] == "012345678911"
+
+    # If the manifest can't be revalidated, the current one is kept:
+    monkeypatch.setattr(bucket_snake.s3.models.BucketTable, "_BucketTable__fetch_manifest",
+                        staticmethod(lambda etag: s3.get_object(Bucket=HISTORICAL_REPORT_BUCKET, Key="missing")))
+    current = table.buckets
+    table._last_checked = 0
+    assert table.buckets is current
+    assert not table.is_stale()
+
+    # Failed writes don't leave temporary files behind:
+    def failed_write(file_obj):
+        file_obj.write(b"partial")
+        raise OSError("No space left on device")
+
+    cache_files = sorted(os.listdir(CONFIG.report_cache_dir))
+    with pytest.raises(OSError):
+        write_atomically(os.path.join(CONFIG.report_cache_dir, "shard.idx"), failed_write)
+    assert sorted(os.listdir(CONFIG.report_cache_dir)) == cache_files
+
+
+def test_ranged_download(config, s3, buckets, monkeypatch):
+    report = {
+        "buckets": {
+            "bucket-{}".format(i): {"AccountId": str(i % 7).zfill(12), "Details": "x" * 100} for i in range(2000)
+        }
+    }
+    body = json.dumps(report).encode("utf-8")
+    s3.put_object(Bucket=HISTORICAL_REPORT_BUCKET, Key="big-report.json", Body=body)
+
+    # Small objects are a single (ranged) GET:
+    stream, etag, _ = get_object_stream(s3, HISTORICAL_REPORT_BUCKET, "historical-s3-report.json",
+                                        part_size=1024 * 1024, concurrency=4)
+    assert not isinstance(stream, RangedObjectReader)
+    assert json.loads(stream.read().decode("utf-8")) == json.loads(get_json("historical-s3-report.json"))
+
+    # Large objects are fetched in parts, and come back out in order:
+    stream, etag, _ = get_object_stream(s3, HISTORICAL_REPORT_BUCKET, "big-report.json", part_size=4096,
+                                        concurrency=4)
+    assert isinstance(stream, RangedObjectReader)
+    assert stream.read(10) == body[:10]
+    assert stream.read(5000) == body[10:5010]
+    assert stream.read() == body[5010:]
+    assert stream.read(10) == b""
+    stream.close()
+
+    # And straight into the report parser:
+    monkeypatch.setattr(CONFIG, "reports_prefix", "big-report.json")
+    monkeypatch.setattr(CONFIG, "report_download_part_size", 4096)
+    table = BucketTable()
+    assert len(table.buckets) == 2000
+    assert table.buckets["bucket-1337"] == "000000000000"
+
+
+def test_compressed_report(config, s3, buckets, monkeypatch):
+    body = get_json("historical-s3-report.json").encode("utf-8")
+    expected = load_bucket_table(io.BytesIO(body))
+
+    # By extension:
+    s3.put_object(Bucket=HISTORICAL_REPORT_BUCKET, Key="historical-s3-report.json.gz", Body=gzip.compress(body))
+
+    # By Content-Encoding:
+    s3.put_object(Bucket=HISTORICAL_REPORT_BUCKET, Key="encoded-report.json", Body=gzip.compress(body),
+                  ContentEncoding="gzip")
+
+    # Downloaded in parts:
+    big_body = gzip.compress(json.dumps({
+        "buckets": {"bucket-{}".format(i): {"AccountId": str(i % 7).zfill(12)} for i in range(5000)}
+    }).encode("utf-8"))
+    s3.put_object(Bucket=HISTORICAL_REPORT_BUCKET, Key="big-report.json.gz", Body=big_body)
+
+    monkeypatch.setattr(CONFIG, "reports_prefix", "historical-s3-report.json.gz")
+    assert dict(BucketTable().buckets.items()) == dict(expected.items())
+
+    stream, _, _ = get_object_stream(s3, HISTORICAL_REPORT_BUCKET, "encoded-report.json", decompress=True)
+    assert isinstance(stream, DecompressedStream)
+    assert stream.read() == body
+    stream.close()
+
+    monkeypatch.setattr(CONFIG, "reports_prefix", "big-report.json.gz")
+    monkeypatch.setattr(CONFIG, "report_download_part_size", 4096)
+    table = BucketTable()
+    assert len(table.buckets) == 5000
+    assert table.buckets["bucket-1337"] == "000000000000"
+
+    # Uncompressed objects are left alone:
+    assert get_compression("historical-s3-report.json") is None
+    assert get_compression("report.json.zst") == "zstd"
+    assert get_compression("report.json", content_encoding="identity, x-gzip") == "gzip"
+    assert decompress_stream(io.BytesIO(body), name="report.json").read() == body
+
+
+def test_zstd_compressed_report(config, s3, buckets, monkeypatch):
+    zstandard = pytest.importorskip("zstandard")
+    body = get_json("historical-s3-report.json").encode("utf-8")
+
+    s3.put_object(Bucket=HISTORICAL_REPORT_BUCKET, Key="historical-s3-report.json.zst",
+                  Body=zstandard.ZstdCompressor().compress(body))
+
+    monkeypatch.setattr(CONFIG, "reports_prefix", "historical-s3-report.json.zst")
+    assert dict(BucketTable().buckets.items()) == dict(load_bucket_table(io.BytesIO(body)).items())
+
+
+class CountingResolver(BucketResolver):
+    """Custom resolver (loaded by `package.module:ClassName`) that counts its lookups."""
+    lookups = []
+
+    def resolve(self, name):
+        CountingResolver.lookups.append(name)
+        if name == "throttled-bucket":
+            raise Exception("Rate exceeded")
+
+        return "012345678910" if name == "custom-bucket" else None
+
+
+def test_bucket_resolver(config, buckets, historical_table, monkeypatch):
+    historical_table.put_item(TableName="HistoricalS3CurrentTable", Item={
+        "arn": {"S": "arn:aws:s3:::brand-new-bucket"},
+        "accountId": {"S": "012345678911"},
+        "BucketName": {"S": "brand-new-bucket"}
+    })
+
+    table = BucketTable()
+
+    # Without a resolver, buckets missing from the report don't exist:
+    assert not table.lookup("brand-new-bucket")
+
+    monkeypatch.setattr(CONFIG, "bucket_resolver", "historical")
+    get_item_calls = []
+    original_get_item = historical_table.get_item
+
+    assert table.lookup("test-bucket-one") == "012345678910"
+    resolver = table._BucketTable__get_resolver()
+    monkeypatch.setattr(resolver.client, "get_item",
+                        lambda **kwargs: get_item_calls.append(kwargs) or original_get_item(**kwargs))
+
+    # Buckets in the report never hit the resolver:
+    assert table.lookup("test-bucket-one") == "012345678910"
+    assert not get_item_calls
+
+    # New buckets are resolved, and then cached:
+    assert table.lookup("brand-new-bucket") == "012345678911"
+    assert table.lookup("brand-new-bucket") == "012345678911"
+    assert len(get_item_calls) == 1
+
+    # As are buckets that don't exist at all:
+    assert not table.lookup("not-a-bucket")
+    assert not table.lookup("not-a-bucket")
+    assert len(get_item_calls) == 2
+
+    # Until the negative TTL runs out:
+    monkeypatch.setattr(CONFIG, "bucket_resolver_negative_ttl", 0)
+    table.resolved.put("not-a-bucket", None)
+    assert not table.lookup("not-a-bucket")
+    assert len(get_item_calls) == 3
+
+    # Requests for new buckets are now accepted:
+    monkeypatch.setattr(bucket_snake.request_schemas, "BUCKET_TABLE", table)
+    assert incoming_request.load({
+        "role_name": "someAppInstanceProfile",
+        "app_name": "someApp",
+        "account_number": "012345678910",
+        "buckets": {"brand-new-bucket": [{"prefix": "*", "perms": ["list"]}]}
+    }, partial=("account_number",)).data["buckets"] == {"brand-new-bucket": [{"prefix": "*", "perms": ["list"]}]}
+
+    # Custom resolvers:
+    monkeypatch.setattr(CONFIG, "bucket_resolver_negative_ttl", 300)
+    monkeypatch.setattr(CONFIG, "bucket_resolver", "bucket_snake.tests.test_s3:CountingResolver")
+    assert table.lookup("custom-bucket") == "012345678910"
+    assert not table.lookup("brand-new-bucket")
+    assert not table.lookup("brand-new-bucket")
+    assert CountingResolver.lookups == ["custom-bucket", "brand-new-bucket"]
+
+    # Resolver failures are not mistaken for (or cached as) buckets that don't exist:
+    for _ in range(2):
+        with pytest.raises(BucketLookupException):
+            table.lookup("throttled-bucket")
+    assert CountingResolver.lookups[-2:] == ["throttled-bucket", "throttled-bucket"]
+
+    # The cache is bounded:
+    cache = ResolvedBucketCache(max_size=2)
+    for name in ["one", "two", "three"]:
+        cache.put(name, None)
+    assert len(cache) == 2
+    assert cache.get("one") == (False, None)
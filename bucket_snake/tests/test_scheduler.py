@@ -0,0 +1,63 @@
+"""
+.. module: bucket_snake.tests.test_scheduler
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+"""
+import threading
+import time
+
+import pytest
+
+from bucket_snake.util.scheduler import AccountScheduler
+
+
+def test_account_scheduler():
+    lock = threading.Lock()
+    running = {}
+    most_running = {}
+    finished = []
+
+    def work(account, number):
+        with lock:
+            running[account] = running.get(account, 0) + 1
+            most_running[account] = max(most_running.get(account, 0), running[account])
+
+        time.sleep(0.02)
+
+        with lock:
+            running[account] -= 1
+            finished.append(account)
+
+        if number == 3:
+            raise ValueError("Failed")
+
+        return account, number
+
+    # The hot account has most of the work:
+    scheduler = AccountScheduler(4, 2)
+    with scheduler:
+        futures = [scheduler.submit("hot", work, "hot", number) for number in range(10)]
+        futures += [scheduler.submit(account, work, account, 0) for account in ["one", "two", "three"]]
+
+        depths = scheduler.queue_depths()
+        assert depths["hot"] >= 8
+
+    # It never ran more than 2 at once -- so the other accounts were not held up behind it:
+    assert most_running == {"hot": 2, "one": 1, "two": 1, "three": 1}
+    assert finished.index("three") < 7
+
+    assert futures[0].result() == ("hot", 0)
+    with pytest.raises(ValueError):
+        futures[3].result()
+
+    stats = scheduler.stats()
+    assert stats["hot"]["completed"] == 10
+    assert stats["hot"]["max_queued"] >= 8
+    assert not stats["hot"]["queued"] and not stats["hot"]["running"]
+    assert stats["one"]["completed"] == 1
+    assert scheduler.queue_depths() == {"hot": 0, "one": 0, "two": 0, "three": 0}
+
+    with pytest.raises(RuntimeError):
+        scheduler.submit("hot", work, "hot", 0)
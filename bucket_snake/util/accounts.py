@@ -0,0 +1,154 @@
+"""
+.. module: bucket_snake.util.accounts
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+"""
+import json
+import logging
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from bucket_snake.config import CONFIG
+from bucket_snake.util.clients import CLIENT_FACTORY
+
+log = logging.getLogger("bucket_snake")
+
+
+class AccountRegistry:
+    """
+    Indexed, cached copy of the SWAG account data.
+
+    To use: `from bucket_snake.util.accounts import ACCOUNT_REGISTRY`
+    Then, `"012345678910" in ACCOUNT_REGISTRY` or `ACCOUNT_REGISTRY.get("012345678910")` to look up an account.
+
+    The SWAG data file is loaded once, and indexed by account ID and name, so lookups are O(1) (instead of a JMESPath
+    scan over every account for every request). Every `CONFIG.swag_revalidate_interval` seconds, it is revalidated
+    against S3 with a conditional GET on its ETag. If that fails, the loaded accounts are kept.
+    """
+    def __init__(self):
+        self._by_id = None
+        self._by_name = None
+        self._etag = None
+        self._last_checked = 0
+        self._lock = threading.Lock()
+        self._blacklists = {}
+
+    @property
+    def accounts(self):
+        """Dictionary of account ID -> SWAG account."""
+        if self._by_id is None or self.is_stale():
+            self.refresh()
+
+        return self._by_id
+
+    def is_stale(self):
+        """Has the revalidation interval elapsed since the SWAG data was last checked?"""
+        return time.time() - self._last_checked >= CONFIG.swag_revalidate_interval
+
+    def refresh(self):
+        """
+        Loads (or revalidates) the SWAG data. Other threads keep using the loaded accounts while this happens.
+        :return:
+        """
+        if not self._lock.acquire(blocking=self._by_id is None):
+            return
+
+        try:
+            if self._by_id is not None and not self.is_stale():
+                return
+
+            try:
+                result = self.__fetch(self._etag if self._by_id is not None else None)
+
+            except Exception as e:
+                if self._by_id is None:
+                    raise
+
+                log.error("[X] Unable to revalidate the SWAG data -- continuing with the current accounts: {}"
+                          .format(e))
+                self._last_checked = time.time()
+                return
+
+            self._last_checked = time.time()
+            if not result:
+                log.debug("[+] The SWAG data has not changed.")
+                return
+
+            accounts, self._etag = result
+            self._by_name = {account["name"]: account for account in accounts if account.get("name")}
+            self._by_id = {account["id"]: account for account in accounts if account.get("id")}
+
+        finally:
+            self._lock.release()
+
+    def get(self, account_id):
+        """
+        :param account_id:
+        :return: The SWAG account, or `None` if it does not exist.
+        """
+        return self.accounts.get(account_id)
+
+    def get_by_name(self, name):
+        """
+        :param name:
+        :return: The SWAG account, or `None` if it does not exist.
+        """
+        if self._by_name is None or self.is_stale():
+            self.refresh()
+
+        return self._by_name.get(name)
+
+    def __contains__(self, account_id):
+        return account_id in self.accounts
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def is_blacklisted_source(self, account_id):
+        """Is the account in `CONFIG.blacklisted_source_accounts`?"""
+        return account_id in self.__blacklist("source", CONFIG.blacklisted_source_accounts)
+
+    def is_blacklisted_bucket_account(self, account_id):
+        """Is the account in `CONFIG.blacklisted_bucket_accounts`?"""
+        return account_id in self.__blacklist("bucket", CONFIG.blacklisted_bucket_accounts)
+
+    def __blacklist(self, name, accounts):
+        """The blacklist as a set -- rebuilt whenever the configured list is replaced."""
+        cached = self._blacklists.get(name)
+        if cached is None or cached[0] is not accounts:
+            cached = self._blacklists[name] = (accounts, frozenset(accounts))
+
+        return cached[1]
+
+    @staticmethod
+    def __fetch(etag=None):
+        """
+        Fetches the SWAG data file from S3. If an ETag is supplied, this is a conditional GET -- and `None` is
+        returned if the data has not changed.
+        :param etag:
+        :return: A tuple of the list of accounts, and the ETag.
+        """
+        log.debug("[~] Fetching the SWAG data...")
+
+        try:
+            s3_obj = CLIENT_FACTORY.client("s3", region=CONFIG.swag_region).get_object(
+                Bucket=CONFIG.swag_bucket, Key=CONFIG.swag_data_file, **({"IfNoneMatch": etag} if etag else {}))
+
+        except ClientError as ce:
+            if ce.response["Error"]["Code"] in ["304", "NotModified"]:
+                return
+
+            raise ce
+
+        accounts = json.loads(s3_obj["Body"].read().decode("utf-8"))
+
+        # An empty SWAG data file is an empty dictionary:
+        return accounts if isinstance(accounts, list) else [], s3_obj.get("ETag")
+
+
+# Use this for all SWAG account lookups:
+ACCOUNT_REGISTRY = AccountRegistry()
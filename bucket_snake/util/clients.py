@@ -0,0 +1,240 @@
+"""
+.. module: bucket_snake.util.clients
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+"""
+import logging
+import threading
+import time
+
+import botocore.session
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import BotoCoreError, ClientError
+
+from bucket_snake.config import CONFIG
+
+log = logging.getLogger("bucket_snake")
+
+# STS errors that are down to the endpoint (rather than the request), and so are worth trying in another region:
+STS_FALLBACK_ERRORS = ["Throttling", "ThrottlingException", "RequestLimitExceeded", "ServiceUnavailable",
+                       "InternalFailure", "InternalError", "RegionDisabledException"]
+
+# How much weight the latest call gets in the moving average of an endpoint's latency:
+LATENCY_WEIGHT = 0.3
+
+
+class EndpointStats:
+    """
+    Latency and error statistics for an STS endpoint. An endpoint is unhealthy for `CONFIG.sts_endpoint_cooldown`
+    seconds after it errors or is slower than `CONFIG.sts_slow_threshold`.
+    """
+    def __init__(self, region):
+        self.region = region
+        self.calls = 0
+        self.errors = 0
+        self.latency = None
+        self.last_latency = None
+        self.last_unhealthy = None
+        self._lock = threading.Lock()
+
+    def record(self, latency, error=False):
+        with self._lock:
+            self.calls += 1
+            self.last_latency = latency
+
+            if error:
+                self.errors += 1
+            else:
+                self.latency = latency if self.latency is None \
+                    else LATENCY_WEIGHT * latency + (1 - LATENCY_WEIGHT) * self.latency
+
+            if error or latency > CONFIG.sts_slow_threshold:
+                self.last_unhealthy = time.time()
+
+    @property
+    def healthy(self):
+        return self.last_unhealthy is None or time.time() - self.last_unhealthy >= CONFIG.sts_endpoint_cooldown
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "average_ms": round(self.latency * 1000, 2) if self.latency is not None else None,
+            "last_ms": round(self.last_latency * 1000, 2) if self.last_latency is not None else None,
+            "healthy": self.healthy
+        }
+
+
+class ClientFactory:
+    """
+    Makes boto3 clients off of a single, shared botocore session.
+
+    Making a new `boto3.Session` (or using `boto3.client()`) for every account reloads the service models and
+    opens fresh HTTPS connections each time. This instead:
+        - Keeps one base session, so the service models are only ever loaded once
+        - Keeps one STS client per region, so assume role calls reuse the same (kept-alive) connections
+        - Applies the connection pool size and TCP keep-alive settings from `CONFIG` to every client
+
+    Roles are assumed with the regional STS endpoints in `CONFIG.sts_regions` (the runtime region first). If an
+    endpoint errors or is slow, the next region is used instead until it has cooled down. See `sts_stats()` for the
+    latency of each endpoint.
+
+    To use: `from bucket_snake.util.clients import CLIENT_FACTORY`
+    """
+    def __init__(self):
+        self._session = None
+        self._sts_clients = {}
+        self._sts_stats = {}
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """The shared botocore session."""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = botocore.session.get_session()
+
+        return self._session
+
+    @staticmethod
+    def client_config():
+        """The botocore client configuration for every client."""
+        return BotoConfig(max_pool_connections=CONFIG.max_pool_connections, tcp_keepalive=CONFIG.tcp_keepalive)
+
+    def client(self, technology, region=None, credentials=None, endpoint_url=None, config=None):
+        """
+        Makes a client from the shared session.
+        :param technology:
+        :param region:
+        :param credentials: The (assumed role) credentials to use, in the same format as STS returns them. If not
+                            supplied, the default credentials are used.
+        :param endpoint_url:
+        :param config: Additional botocore client configuration.
+        :return:
+        """
+        credentials = credentials or {}
+        session = self.session
+
+        # Client creation is not thread-safe (it can load service models into the shared session):
+        with self._lock:
+            return session.create_client(technology, region_name=region,
+                                         aws_access_key_id=credentials.get("AccessKeyId"),
+                                         aws_secret_access_key=credentials.get("SecretAccessKey"),
+                                         aws_session_token=credentials.get("SessionToken"),
+                                         endpoint_url=endpoint_url,
+                                         config=self.client_config().merge(config) if config
+                                         else self.client_config())
+
+    def sts(self, region):
+        """
+        Gets the (shared) STS client for the region. This uses the regional STS endpoint, and times out after
+        `CONFIG.sts_timeout` seconds so that a slow endpoint can be failed over.
+        :param region:
+        :return:
+        """
+        client = self._sts_clients.get(region)
+        if client is None:
+            endpoint_url, options = self.sts_client_options(region)
+            client = self._sts_clients[region] = self.client("sts", region=region, endpoint_url=endpoint_url,
+                                                             config=BotoConfig(**options))
+
+        return client
+
+    @staticmethod
+    def sts_client_options(region):
+        """
+        The endpoint and configuration for the region's STS client (shared with `bucket_snake.aio`).
+        :param region:
+        :return: Tuple of the regional STS endpoint URL, and a dictionary of the botocore client configuration.
+        """
+        suffix = ".amazonaws.com.cn" if region.startswith("cn-") else ".amazonaws.com"
+        options = {
+            "connect_timeout": CONFIG.sts_timeout,
+            "read_timeout": CONFIG.sts_timeout
+        }
+
+        # Fail over to the next region rather than retrying -- but with no other region, keep botocore's retries:
+        if len(CONFIG.sts_regions) > 1:
+            options["retries"] = {"max_attempts": 1}
+
+        return "https://sts.{}{}".format(region, suffix), options
+
+    def sts_regions(self):
+        """The STS regions to try, in order: the healthy ones (in configured order), and then the rest by latency."""
+        regions = CONFIG.sts_regions
+        stats = {region: self._sts_stats.get(region) or EndpointStats(region) for region in regions}
+
+        healthy = [region for region in regions if stats[region].healthy]
+        unhealthy = sorted((region for region in regions if region not in healthy),
+                           key=lambda region: stats[region].latency or 0)
+
+        return healthy + unhealthy
+
+    def stats_for(self, region):
+        stats = self._sts_stats.get(region)
+        if stats is None:
+            stats = self._sts_stats.setdefault(region, EndpointStats(region))
+
+        return stats
+
+    def sts_stats(self):
+        """The latency and error statistics for each STS endpoint that has been used."""
+        return {region: stats.to_dict() for region, stats in sorted(self._sts_stats.items())}
+
+    def assume_role(self, arn, session_name):
+        """
+        Assumes the role, falling back to the next STS region if an endpoint errors or times out.
+        :param arn:
+        :param session_name:
+        :return: The `assume_role` response.
+        """
+        regions = self.sts_regions()
+
+        for number, region in enumerate(regions):
+            started = time.perf_counter()
+            try:
+                response = self.sts(region).assume_role(RoleArn=arn, RoleSessionName=session_name)
+
+            except (BotoCoreError, ClientError) as e:
+                self.sts_failed(regions, number, started, e)
+                continue
+
+            self.stats_for(region).record(time.perf_counter() - started)
+
+            return response
+
+    def sts_failed(self, regions, number, started, error):
+        """
+        Handles an assume role call that failed in `regions[number]`. Errors that are down to the request (rather than
+        the endpoint) are raised right away. Otherwise, the failure counts against the endpoint, and the error is
+        raised if there is no other region left to try.
+        :param regions: The regions being tried (see `sts_regions()`).
+        :param number: The index of the region that failed.
+        :param started: When the call was made (`time.perf_counter()`).
+        :param error:
+        :return:
+        """
+        if isinstance(error, ClientError) and error.response["Error"]["Code"] not in STS_FALLBACK_ERRORS \
+                and error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) < 500:
+            raise error
+
+        self.stats_for(regions[number]).record(time.perf_counter() - started, error=True)
+        if number == len(regions) - 1:
+            raise error
+
+        log.error("[X] Unable to assume role with STS in {} -- trying {}: {}".format(
+            regions[number], regions[number + 1], error))
+
+    def reset(self):
+        """Drops the shared session and clients (i.e. after the configuration or credentials have changed)."""
+        with self._lock:
+            self._session = None
+            self._sts_clients = {}
+            self._sts_stats = {}
+
+
+# Use this for making all clients:
+CLIENT_FACTORY = ClientFactory()
@@ -0,0 +1,141 @@
+"""
+.. module: bucket_snake.util.dag
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Small dependency graph executor.
+
+The steps of a request are mostly I/O against different accounts, and many of them do not depend on each other (i.e.
+the source role check and the bucket mapping). A `TaskGraph` runs each step as soon as the steps that it depends on
+are done, so independent steps overlap. Once it is done, the critical path (the chain of steps that set the total
+time) is logged.
+"""
+import logging
+import time
+from collections import OrderedDict
+
+log = logging.getLogger("bucket_snake")
+
+# Return this from a task to skip the tasks that depend on it (i.e. when there is nothing left to do):
+SKIP = object()
+
+
+class TaskGraph:
+    """
+    Runs tasks concurrently, in dependency order.
+
+    To use:
+        graph = TaskGraph("request")
+        graph.add("mapping", build_mapping)
+        graph.add("policies", build_policies, "mapping")   # Called with the result of `mapping`
+        results = graph.run()
+    """
+    def __init__(self, name):
+        """
+        :param name: What the graph is for (for the timing log).
+        """
+        self.name = name
+        self.timings = {}
+        self._tasks = OrderedDict()
+
+    def add(self, name, function, *dependencies):
+        """
+        Adds a task. It is called with the results of its dependencies (in the order given), once they are all done.
+        If any of them was skipped (or returned `SKIP`), then so is this task.
+        :param name:
+        :param function:
+        :param dependencies: The names of the tasks that must be done first (which must already have been added).
+        :return:
+        """
+        for dependency in dependencies:
+            if dependency not in self._tasks:
+                raise ValueError("Task {} depends on {}, which has not been added.".format(name, dependency))
+
+        self._tasks[name] = (function, dependencies)
+
+    def run(self, workers=None):
+        """
+        Runs all of the tasks. If one fails, no more are started -- the running ones are waited for, and then the
+        error is raised.
+        :param workers: The most tasks to run at once (defaults to one thread per task).
+        :return: Dictionary of task name -> result (`SKIP` for tasks that were skipped).
+        """
+        from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+        results = {}
+        running = {}
+        waiting = OrderedDict(self._tasks)
+        started = time.monotonic()
+        error = None
+
+        with ThreadPoolExecutor(max_workers=workers or max(1, len(self._tasks)),
+                                thread_name_prefix="bucket-snake-{}".format(self.name)) as executor:
+            while waiting or running:
+                if error is None:
+                    # Dependencies are always added first -- so a chain of skipped tasks is skipped in one pass:
+                    for name, (function, dependencies) in list(waiting.items()):
+                        if not all(dependency in results for dependency in dependencies):
+                            continue
+
+                        del waiting[name]
+                        arguments = [results[dependency] for dependency in dependencies]
+                        if any(argument is SKIP for argument in arguments):
+                            results[name] = SKIP
+                            continue
+
+                        running[executor.submit(self.__time, name, started, function, *arguments)] = name
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+
+                    except Exception as e:
+                        log.error("[X] The {} task {} failed: {}".format(self.name, name, e))
+                        error = error or e
+
+        if error is not None:
+            raise error
+
+        self.log_critical_path(time.monotonic() - started)
+
+        return results
+
+    def __time(self, name, started, function, *arguments):
+        start = time.monotonic() - started
+        try:
+            return function(*arguments)
+
+        finally:
+            self.timings[name] = (start, time.monotonic() - started)
+
+    def critical_path(self):
+        """
+        The chain of tasks that set the total time: starting from the task that finished last, each task's
+        dependency that finished last.
+        :return: List of (task name, seconds that it took), in the order that they ran.
+        """
+        if not self.timings:
+            return []
+
+        path = []
+        name = max(self.timings, key=lambda task: self.timings[task][1])
+        while name is not None:
+            start, end = self.timings[name]
+            path.append((name, end - start))
+
+            dependencies = [dependency for dependency in self._tasks[name][1] if dependency in self.timings]
+            name = max(dependencies, key=lambda task: self.timings[task][1]) if dependencies else None
+
+        return list(reversed(path))
+
+    def log_critical_path(self, total):
+        log.debug("[+] Ran the {} tasks in {:.0f}ms. Critical path: {}".format(
+            self.name, total * 1000, " -> ".join("{} ({:.0f}ms)".format(name, seconds * 1000)
+                                                 for name, seconds in self.critical_path())))
@@ -5,6 +5,15 @@
     :license: Apache, see LICENSE for more details.
 .. author:: Mike Grima <mgrima@netflix.com>
 """
+from botocore.exceptions import ClientError, ConnectionClosedError, ConnectionError, ReadTimeoutError
+
+# Error codes that mean that the call was throttled:
+THROTTLING_ERRORS = ["Throttling", "ThrottlingException", "ThrottledException", "RequestThrottled",
+                     "RequestThrottledException", "RequestLimitExceeded", "TooManyRequestsException", "SlowDown"]
+
+# Error codes for failures that are likely to go away if the call is made again:
+TRANSIENT_ERRORS = ["ServiceFailure", "ServiceUnavailable", "InternalFailure", "InternalError", "RequestTimeout",
+                    "RequestTimeoutException", "ConcurrentModification", "PriorRequestNotComplete"]
 
 
 class BucketSnakeException(Exception):
@@ -27,5 +36,105 @@ class S3BucketDoesNotExistException(BucketSnakeException):
     pass
 
 
+class BucketLookupException(BucketSnakeException):
+    """Raised when a bucket missing from the report could not be looked up (as opposed to it not existing)."""
+    pass
+
+
+class InvalidS3ReportException(BucketSnakeException):
+    pass
+
+
+class InvalidBucketIndexException(BucketSnakeException):
+    pass
+
+
+class DestinationRoleException(BucketSnakeException):
+    """Raised when the destination roles could not be created in some of the accounts."""
+    def __init__(self, errors, updated=None):
+        """
+        :param errors: Dictionary of account ID -> the exception raised for that account.
+        :param updated: The accounts that were successfully updated.
+        """
+        self.errors = errors
+        self.updated = updated or []
+
+        super().__init__("Unable to create the destination roles in {} account(s): {}".format(
+            len(errors), ", ".join("{}: {}".format(account, errors[account]) for account in sorted(errors))))
+
+    @property
+    def retryable(self):
+        """Would all of the failed accounts likely succeed if they were tried again later?"""
+        return all(isinstance(error, RetryableException) for error in self.errors.values())
+
+
 class MissingRequiredConfigurationItemException(BucketSnakeException):
     pass
+
+
+class RoleMigrationException(BucketSnakeException):
+    """Raised when a role that was being moved could not be put back -- it no longer exists, and must be restored."""
+    pass
+
+
+class RetryableException(BucketSnakeException):
+    """Raised when a call failed in a way that is likely to succeed if it is made again later."""
+    def __init__(self, error):
+        """
+        :param error: The original exception.
+        """
+        self.error = error
+
+        super().__init__(str(error))
+
+
+class ThrottledException(RetryableException):
+    """Raised when a call was throttled (even after backing off)."""
+    pass
+
+
+def error_code(error):
+    """
+    :param error:
+    :return: The AWS error code of the exception, or `None` if it is not an AWS error.
+    """
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code")
+
+    return None
+
+
+def is_throttling_error(error):
+    """Was the call throttled?"""
+    return isinstance(error, ThrottledException) or error_code(error) in THROTTLING_ERRORS
+
+
+def is_retryable_error(error):
+    """Is the call likely to succeed if it is made again (after backing off)?"""
+    if isinstance(error, RetryableException) or is_throttling_error(error):
+        return True
+
+    if isinstance(error, ClientError):
+        return error_code(error) in TRANSIENT_ERRORS or \
+            error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
+
+    return isinstance(error, (ConnectionError, ConnectionClosedError, ReadTimeoutError))
+
+
+def classify_error(error):
+    """
+    Wraps errors that are worth retrying later in a `ThrottledException` or `RetryableException` -- so that callers
+    can tell them apart from errors that will happen again. Other errors are returned as they are.
+    :param error:
+    :return:
+    """
+    if isinstance(error, RetryableException):
+        return error
+
+    if is_throttling_error(error):
+        return ThrottledException(error)
+
+    if is_retryable_error(error):
+        return RetryableException(error)
+
+    return error
@@ -0,0 +1,66 @@
+"""
+.. module: bucket_snake.util.imports
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Helpers for keeping heavy modules out of the cold start. Anything that is not needed just to import
+`bucket_snake.entrypoints` should be imported where it is first used -- see `benchmarks/import_time.py`.
+"""
+import importlib
+import subprocess
+import sys
+import threading
+from functools import wraps
+
+# Modules that importing `bucket_snake.entrypoints` must not pull in -- they are imported where they are first used:
+DEFERRED_IMPORTS = ["boto3", "ijson", "marshmallow", "raven", "raven_python_lambda", "retrying", "swag_client"]
+
+
+def lazy_decorator(module, name, *args, **kwargs):
+    """
+    Decorates a function with `module.name(*args, **kwargs)` -- but only imports the module (and applies the
+    decorator) the first time that the function is called.
+    :param module:
+    :param name:
+    :return:
+    """
+    def decorator(function):
+        decorated = []
+        lock = threading.Lock()
+
+        @wraps(function)
+        def wrapper(*call_args, **call_kwargs):
+            if not decorated:
+                with lock:
+                    if not decorated:
+                        decorated.append(getattr(importlib.import_module(module), name)(*args, **kwargs)(function))
+
+            return decorated[0](*call_args, **call_kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def import_times(module, python=None):
+    """
+    Imports the module in a fresh interpreter with `-X importtime`, and parses what it reports.
+    :param module:
+    :param python: The Python interpreter to use (defaults to this one).
+    :return: Dictionary of every module that was imported -> a tuple of its self and cumulative import time (in
+             microseconds).
+    """
+    result = subprocess.run([python or sys.executable, "-X", "importtime", "-c", "import {}".format(module)],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(self_time), int(cumulative))
+
+    return times
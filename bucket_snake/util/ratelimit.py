@@ -0,0 +1,277 @@
+"""
+.. module: bucket_snake.util.ratelimit
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Adaptive rate limiting for AWS calls.
+
+IAM has low per-account rate limits, and parallel destination role creation (and batches) can easily exceed them.
+A `RateLimiter` is attached to a client (see `RateLimiter.attach()`), and from then on, every call that the client
+makes (including each page of a paginator) first takes a token from both the client's account bucket and the global
+bucket. When a call is throttled, both rates are halved, and the call is retried after a jittered exponential
+backoff. As calls succeed, the rates climb back up to the configured limits. aiobotocore clients are attached with
+`RateLimiter.attach_async()` instead, which waits without blocking the event loop.
+"""
+import logging
+import random
+import threading
+import time
+from functools import partial
+
+from botocore.exceptions import ClientError
+
+from bucket_snake.config import CONFIG
+from bucket_snake.util.exceptions import is_retryable_error, is_throttling_error
+
+log = logging.getLogger("bucket_snake")
+
+# The slowest that a throttled rate is lowered to (calls per second):
+MIN_RATE = 0.5
+
+# How much of the configured rate is recovered with each successful call:
+RATE_RECOVERY = 0.05
+
+# Retries back off for a random time of up to BACKOFF_BASE * 2 ^ attempt seconds (capped at BACKOFF_MAX):
+BACKOFF_BASE = 0.25
+BACKOFF_MAX = 20
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket, whose rate lowers when calls are throttled and recovers as they succeed.
+    """
+    def __init__(self, rate):
+        """
+        :param rate: The most calls per second (also the most that can be made at once after being idle).
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.throttles = 0
+        self._tokens = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __refill(self):
+        now = time.monotonic()
+        self._tokens = min(max(self.rate, 1), self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self):
+        """
+        Takes a token, if there is one.
+        :return: 0 if a token was taken -- otherwise, how long to wait (in seconds) before trying again.
+        """
+        with self._lock:
+            self.__refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """Waits for (and takes) a token."""
+        wait = self.try_acquire()
+        while wait:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+    async def acquire_async(self):
+        """Waits for (and takes) a token -- without blocking the event loop."""
+        import asyncio
+
+        wait = self.try_acquire()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self.try_acquire()
+
+    def throttled(self):
+        """Halves the rate, and drops the tokens that have built up."""
+        with self._lock:
+            self.throttles += 1
+            self.rate = max(MIN_RATE, self.rate / 2)
+            self._tokens = min(self._tokens, 0)
+
+    def succeeded(self):
+        """Recovers a little of the rate."""
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_RECOVERY)
+
+    def to_dict(self):
+        return {
+            "rate": round(self.rate, 2),
+            "max_rate": self.max_rate,
+            "throttles": self.throttles
+        }
+
+
+def backoff(attempt):
+    """
+    How long to wait before retrying -- exponential in the number of attempts made so far, with full jitter (so
+    that throttled threads don't all retry at the same time).
+    :param attempt:
+    :return: Seconds.
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class RateLimiter:
+    """
+    Per-account and global token buckets, shared by every client that it is attached to.
+
+    To use: `from bucket_snake.iam.util import IAM_RATE_LIMITER`
+    """
+    def __init__(self, rate_setting, global_rate_setting, max_retries_setting):
+        """
+        :param rate_setting: The name of the `CONFIG` setting for the per-account rate.
+        :param global_rate_setting: The name of the `CONFIG` setting for the global rate.
+        :param max_retries_setting: The name of the `CONFIG` setting for how many times to retry a call.
+        """
+        self._rate_setting = rate_setting
+        self._global_rate_setting = global_rate_setting
+        self._max_retries_setting = max_retries_setting
+        self._accounts = {}
+        self._global = None
+        self._lock = threading.Lock()
+
+    def bucket(self, account):
+        """The account's token bucket."""
+        bucket = self._accounts.get(account)
+        if bucket is None:
+            with self._lock:
+                bucket = self._accounts.setdefault(account, TokenBucket(getattr(CONFIG, self._rate_setting)))
+
+        return bucket
+
+    @property
+    def global_bucket(self):
+        if self._global is None:
+            with self._lock:
+                if self._global is None:
+                    self._global = TokenBucket(getattr(CONFIG, self._global_rate_setting))
+
+        return self._global
+
+    def acquire(self, account):
+        """Waits for a token from the account's bucket, and then from the global one."""
+        self.bucket(account).acquire()
+        self.global_bucket.acquire()
+
+    async def acquire_async(self, account):
+        """`acquire()`, for the asyncio engine (see `bucket_snake.aio`)."""
+        await self.bucket(account).acquire_async()
+        await self.global_bucket.acquire_async()
+
+    def throttled(self, account):
+        self.bucket(account).throttled()
+        self.global_bucket.throttled()
+
+    def succeeded(self, account):
+        self.bucket(account).succeeded()
+        self.global_bucket.succeeded()
+
+    def attach(self, client, account):
+        """
+        Makes every call that the client makes go through the limiter -- and be retried (with backoff) if it is
+        throttled or fails on the AWS side. This replaces the client's own retries.
+        :param client:
+        :param account: The account that the client makes calls to.
+        :return: The client.
+        """
+        # botocore's own retry handler is registered for the service -- this must be ahead of it:
+        service = client.meta.service_model.service_id.hyphenize()
+        client.meta.events.register("before-call.{}".format(service), partial(self.__before_call, account))
+        client.meta.events.register_first("needs-retry.{}".format(service), partial(self.__needs_retry, account))
+
+        return client
+
+    def attach_async(self, client, account):
+        """
+        `attach()`, for an aiobotocore client (see `bucket_snake.aio`) -- the waits don't block the event loop.
+        :param client:
+        :param account: The account that the client makes calls to.
+        :return: The client.
+        """
+        service = client.meta.service_model.service_id.hyphenize()
+        client.meta.events.register("before-call.{}".format(service), partial(self.__before_call_async, account))
+        client.meta.events.register_first("needs-retry.{}".format(service),
+                                          partial(self.__needs_retry_async, account))
+
+        return client
+
+    def __before_call(self, account, **kwargs):
+        self.acquire(account)
+
+    async def __before_call_async(self, account, **kwargs):
+        await self.acquire_async(account)
+
+    def __needs_retry(self, account, **kwargs):
+        """
+        Decides whether or not the call should be retried.
+        :return: `False` to not retry, or the number of (additional) seconds to wait before retrying.
+        """
+        delay = self.__retry_delay(account, **kwargs)
+        if delay is None:
+            return False
+
+        # The retry waits for its own token:
+        time.sleep(delay)
+        self.acquire(account)
+
+        return 0
+
+    async def __needs_retry_async(self, account, **kwargs):
+        """`__needs_retry()`, for aiobotocore clients."""
+        import asyncio
+
+        delay = self.__retry_delay(account, **kwargs)
+        if delay is None:
+            return False
+
+        await asyncio.sleep(delay)
+        await self.acquire_async(account)
+
+        return 0
+
+    def __retry_delay(self, account, response=None, attempts=1, caught_exception=None, operation=None, **kwargs):
+        """
+        Records how the call went, and works out whether it should be retried.
+        :return: `None` to not retry, or how long to back off (in seconds) before retrying.
+        """
+        error = caught_exception
+        if error is None and response is not None:
+            http_response, parsed = response
+            if "Error" in parsed or http_response.status_code >= 500:
+                error = ClientError(parsed, operation.name if operation else "Unknown")
+
+        if error is None:
+            self.succeeded(account)
+            return None
+
+        if is_throttling_error(error):
+            self.throttled(account)
+
+        if not is_retryable_error(error) or attempts > getattr(CONFIG, self._max_retries_setting):
+            return None
+
+        delay = backoff(attempts)
+        log.debug("[-] {} in account {} failed ({}) -- retrying in {:.2f} seconds...".format(
+            operation.name if operation else "The call", account, error, delay))
+
+        return delay
+
+    def stats(self):
+        """The current rate and number of throttles for each account, and overall."""
+        return {
+            "global": self.global_bucket.to_dict(),
+            "accounts": {account: bucket.to_dict() for account, bucket in sorted(self._accounts.items())}
+        }
+
+    def reset(self):
+        """Drops the buckets (i.e. after the configured rates have changed)."""
+        with self._lock:
+            self._accounts = {}
+            self._global = None
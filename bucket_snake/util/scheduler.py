@@ -0,0 +1,170 @@
+"""
+.. module: bucket_snake.util.scheduler
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Fair scheduling of per-account work.
+
+In a batch, one popular destination account (i.e. a shared data lake account) can have most of the roles. With a
+plain thread pool, its work fills every thread -- and is throttled -- while the other accounts wait behind it. The
+`AccountScheduler` instead keeps a queue for each account, and its workers take work from the accounts in turn
+(round-robin), with at most `account_concurrency` operations running in any one account. A hot account only slows
+itself down, and the overall throughput is bounded by the sum of the per-account limits.
+"""
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+log = logging.getLogger("bucket_snake")
+
+
+class AccountScheduler:
+    """
+    Thread pool that runs work round-robin across accounts, with bounded concurrency per account.
+
+    To use:
+        with AccountScheduler(8, 2) as scheduler:
+            future = scheduler.submit(account, function, *args, **kwargs)
+
+    Leaving the `with` block waits for all of the work to finish.
+    """
+    def __init__(self, workers, account_concurrency):
+        """
+        :param workers: The most operations to run at once (overall).
+        :param account_concurrency: The most operations to run at once in any one account.
+        """
+        self.workers = max(1, workers)
+        self.account_concurrency = max(1, account_concurrency)
+        self._queues = OrderedDict()
+        self._running = {}
+        self._stats = {}
+        self._threads = []
+        self._shutdown = False
+        self._condition = threading.Condition()
+
+    def submit(self, account, function, *args, **kwargs):
+        """
+        Queues the function to be run for the account.
+        :param account:
+        :param function:
+        :return: A `concurrent.futures.Future` for the result.
+        """
+        future = Future()
+
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("Cannot schedule new work after shutdown.")
+
+            queue = self._queues.setdefault(account, deque())
+            queue.append((future, function, args, kwargs))
+
+            stats = self._stats.setdefault(account, {"completed": 0, "max_queued": 0})
+            stats["max_queued"] = max(stats["max_queued"], len(queue))
+
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self.__work, name="bucket-snake-scheduler-{}".format(
+                    len(self._threads)), daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+            self._condition.notify()
+
+        return future
+
+    def __next(self):
+        """
+        Takes the next piece of work -- from the first account (in turn) that has work queued, and is not already at
+        its concurrency limit. That account then goes to the back of the line. The condition must be held.
+        :return: The account and the work, or `None` if there is nothing that can run right now.
+        """
+        for account, queue in self._queues.items():
+            if queue and self._running.get(account, 0) < self.account_concurrency:
+                work = queue.popleft()
+                self._running[account] = self._running.get(account, 0) + 1
+                self._queues.move_to_end(account)
+
+                return account, work
+
+        return None
+
+    def __work(self):
+        while True:
+            with self._condition:
+                next_work = self.__next()
+                while next_work is None:
+                    if self._shutdown and not self.queued:
+                        return
+
+                    self._condition.wait()
+                    next_work = self.__next()
+
+            account, (future, function, args, kwargs) = next_work
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(function(*args, **kwargs))
+
+                    except BaseException as e:
+                        future.set_exception(e)
+
+            finally:
+                with self._condition:
+                    self._running[account] -= 1
+                    self._stats[account]["completed"] += 1
+                    self._condition.notify_all()
+
+    @property
+    def queued(self):
+        """How many operations are waiting to run (in all accounts)."""
+        return sum(len(queue) for queue in self._queues.values())
+
+    def queue_depths(self):
+        """
+        :return: Dictionary of account -> how many of its operations are waiting to run.
+        """
+        with self._condition:
+            return {account: len(queue) for account, queue in self._queues.items()}
+
+    def stats(self):
+        """
+        :return: Dictionary of account -> how many of its operations are queued, running, and completed -- and the
+                 deepest that its queue got.
+        """
+        with self._condition:
+            return {
+                account: {
+                    "queued": len(self._queues[account]),
+                    "running": self._running.get(account, 0),
+                    "completed": stats["completed"],
+                    "max_queued": stats["max_queued"]
+                } for account, stats in self._stats.items()
+            }
+
+    def shutdown(self, wait=True):
+        """
+        Stops taking new work. The work that is already queued still runs.
+        :param wait: Wait for all of the work to finish.
+        :return:
+        """
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+            if self._stats:
+                deepest = max(self._stats, key=lambda account: self._stats[account]["max_queued"])
+                log.debug("[+] Ran {} operations in {} account(s). The deepest queue was {} in account {}.".format(
+                    sum(stats["completed"] for stats in self._stats.values()), len(self._stats),
+                    self._stats[deepest]["max_queued"], deepest))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown(wait=True)
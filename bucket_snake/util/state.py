@@ -0,0 +1,134 @@
+"""
+.. module: bucket_snake.util.state
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Request state -- used to short-circuit repeated, identical requests.
+
+After a request is completed, a hash of it (see `request_hash()`) is saved in a `StateStore`. If the same request is
+made again, it is already in place, and nothing needs to be recomputed or rewritten. Set `REQUEST_STATE_STORE` to
+the name of a registered store (see `STATE_STORES`), to the `package.module:ClassName` of a custom `StateStore`
+subclass, or to `none` to disable this.
+"""
+import hashlib
+import importlib
+import json
+
+from bucket_snake.config import CONFIG
+from bucket_snake.iam.inventory import get_account_inventory
+from bucket_snake.iam.util import get_iam_client
+
+# Bump this whenever what Bucket Snake writes for a request changes, so that previously stored hashes no longer match:
+REQUEST_HASH_VERSION = 1
+
+# The source role tag that the `RoleTagStateStore` keeps the hash in:
+REQUEST_HASH_TAG = "BucketSnakeRequestHash"
+
+
+def request_hash(request_data, bucket_accounts):
+    """
+    Computes a canonical hash of the (validated) request, the accounts that the buckets reside in, and the
+    configuration that affects what is written for it.
+    :param request_data:
+    :param bucket_accounts: Dictionary of bucket name -> the account it resides in.
+    :return:
+    """
+    buckets = {
+        bucket: sorted(({"prefix": permission["prefix"], "perms": sorted(permission["perms"])}
+                        for permission in permissions), key=lambda permission: json.dumps(permission, sort_keys=True))
+        for bucket, permissions in request_data["buckets"].items()
+    }
+
+    canonical = {
+        "version": REQUEST_HASH_VERSION,
+        "role_name": request_data["role_name"],
+        "app_name": request_data["app_name"],
+        "account_number": request_data["account_number"],
+        "buckets": buckets,
+        "bucket_accounts": bucket_accounts,
+        "config": {
+            "bucket_snake_policy_name": CONFIG.bucket_snake_policy_name,
+            "sts_policy_name": CONFIG.sts_policy_name,
+            "dest_role_description": CONFIG.dest_role_description,
+            "destination_role_path": CONFIG.destination_role_path,
+            "app_reports_buckets": sorted(CONFIG.app_reports_buckets),
+            "reports_prefix": CONFIG.reports_prefix
+        }
+    }
+
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class StateStore:
+    """
+    Base class for storing the hash of the last completed request for a source role.
+    """
+    def get(self, account, role_name, role=None):
+        """
+        Gets the stored hash for the source role.
+        :param account:
+        :param role_name:
+        :param role: The `get_role` response for the source role (if it has already been fetched).
+        :return: The hash, or `None` if there isn't one.
+        """
+        raise NotImplementedError
+
+    def put(self, account, role_name, value):
+        """
+        Stores the hash for the source role.
+        :param account:
+        :param role_name:
+        :param value:
+        :return:
+        """
+        raise NotImplementedError
+
+
+class RoleTagStateStore(StateStore):
+    """
+    Keeps the hash as a tag on the source role. The tags come back with the `get_role` call that is already made to
+    verify the source role, so checking the hash costs no additional calls.
+    """
+    def get(self, account, role_name, role=None):
+        if role is None:
+            role = get_iam_client(account).get_role(RoleName=role_name)
+
+        for tag in role["Role"].get("Tags", []):
+            if tag["Key"] == REQUEST_HASH_TAG:
+                return tag["Value"]
+
+    def put(self, account, role_name, value):
+        tags = [{"Key": REQUEST_HASH_TAG, "Value": value}]
+        get_iam_client(account).tag_role(RoleName=role_name, Tags=tags)
+
+        inventory = get_account_inventory(account)
+        if inventory is not None:
+            inventory.put_tags(role_name, tags)
+
+
+# State stores that can be selected by name via `REQUEST_STATE_STORE`:
+STATE_STORES = {
+    "role_tag": RoleTagStateStore
+}
+
+
+def get_state_store(name):
+    """
+    Instantiates the state store -- either a registered one (see `STATE_STORES`), or a `package.module:ClassName`.
+    :param name:
+    :return: The state store, or `None` if they are disabled.
+    """
+    if not name or name.lower() == "none":
+        return None
+
+    if name in STATE_STORES:
+        return STATE_STORES[name]()
+
+    module, _, class_name = name.partition(":")
+    if not class_name:
+        raise ValueError("Unknown request state store: {}. Must be one of: {}, none, or a `package.module:ClassName`."
+                         .format(name, ", ".join(sorted(STATE_STORES))))
+
+    return getattr(importlib.import_module(module), class_name)()
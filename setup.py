@@ -20,6 +20,7 @@ with open(os.path.join(ROOT, "bucket_snake", "__about__.py")) as f:
 
 install_requires = [
     "boto3",
+    "ijson>=2.3",
     "swag-client",
     "retrying>=1.3.3",
     "raven_python_lambda"
@@ -44,8 +45,15 @@ setup(
     zip_safe=False,
     install_requires=install_requires,
     extras_require={
-        'tests': tests_require
+        'tests': tests_require,
+        'zstd': ['zstandard>=0.18'],
+        'async': ['aiobotocore>=2.5']
+    },
+    entry_points={
+        "console_scripts": [
+            "bucket-snake-compile-index = bucket_snake.s3.index:main",
+            "bucket-snake-migrate-roles = bucket_snake.iam.migrate:main"
+        ]
     },
-    entry_points={},
     keywords=['aws', 'account_management', "s3", "security", "iam", "lambda", "sss", "snake"]
 )